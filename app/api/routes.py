@@ -1,243 +1,701 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+import asyncio
+import base64
+import binascii
+import csv
+import io
+import json
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy import desc, func, distinct
+from sqlalchemy import and_, desc, func, distinct, literal_column, select, tuple_
 from typing import Optional, Literal
-from datetime import datetime
-from ..database import get_db
-from ..services.gmail import GmailService
+from datetime import date, datetime, time
+from ..cache import cached_json_async, response_cache
+from ..database import SessionLocal, get_async_db
+from ..metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, render_metrics
+from ..serialization import FastJSONResponse, encode_json
+from ..services.jobs import FINISHED_STATUSES, sync_jobs
 from ..services.analytics import AnalyticsService
-from ..models import EmailMessage
-from ..schemas import Analytics
+from ..services.dimensions import DECODED_KEYS, dimensions_for
+from ..services.search import search_matches
+from ..services.sketches import DISTINCT_ERROR, BucketSketch, SketchService, within
+from ..models import ALL_ACCOUNTS, Account, DomainStat, EmailMessage, Sender, SenderName, SenderStat
+from ..schemas import Analytics, EmailPage, GroupEmailPage, Timeseries
 
 router = APIRouter()
 
-@router.post("/sync")
-async def sync_emails(db: Session = Depends(get_db)):
-    """Syncs emails from Gmail to local database."""
-    gmail_service = GmailService()
-    service = gmail_service.get_service()
-    page_token = None
-    total_processed = 0
-    total_skipped = 0
-    
-    while True:
-        try:
-            results = service.users().messages().list(
-                userId='me',
-                pageToken=page_token,
-                maxResults=500
-            ).execute()
-            
-            messages = results.get('messages', [])
-
-            for message in messages:
-                # Check if email exists
-                existing = db.query(EmailMessage).filter_by(id=message['id']).first()
-                if existing:
-                    total_skipped += 1
-                    continue
-                
-                try:
-                    msg = service.users().messages().get(
-                        userId='me',
-                        id=message['id'],
-                        format='metadata',
-                        metadataHeaders=['From', 'Subject', 'Date']
-                    ).execute()
-                    
-                    email_msg = gmail_service.parse_message(msg)
-                    if email_msg:
-                        db.add(email_msg)
-                        total_processed += 1
-                        
-                        if total_processed % 100 == 0:
-                            db.commit()
-                except Exception as e:
-                    print(f"Error processing message {message['id']}: {str(e)}")
-                    continue
-            
-            try:
-                db.commit()
-            except Exception as e:
-                db.rollback()
-                print(f"Error committing batch: {str(e)}")
-            
-            page_token = results.get('nextPageToken')
-            if not page_token:
+SYNC_EVENT_INTERVAL = 1.0
+EXPORT_BATCH_SIZE = 1000
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+@router.get("/accounts")
+async def list_accounts(db: AsyncSession = Depends(get_async_db)):
+    """Returns the registered Gmail accounts."""
+    accounts = await db.scalars(select(Account).order_by(Account.id))
+    return [
+        {"id": account.id, "email": account.email, "created_at": account.created_at}
+        for account in accounts
+    ]
+
+@router.post("/sync", status_code=202)
+def sync_emails(full: bool = False, account_id: Optional[int] = None):
+    """Starts a background sync of one account, or all of them, from Gmail to the local database."""
+    try:
+        return sync_jobs.submit(full=full, account_id=account_id)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@router.get("/sync/{job_id}")
+def get_sync_job(job_id: str):
+    """Returns the progress of a sync job."""
+    job = sync_jobs.status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Sync job not found")
+    return job
+
+@router.get("/sync/{job_id}/events")
+async def stream_sync_job(job_id: str):
+    """Streams sync job progress as Server-Sent Events until the job finishes."""
+    if await run_in_threadpool(sync_jobs.status, job_id) is None:
+        raise HTTPException(status_code=404, detail="Sync job not found")
+
+    async def events():
+        while True:
+            job = await run_in_threadpool(sync_jobs.status, job_id)
+            finished = job["status"] in FINISHED_STATUSES
+            event = "done" if finished else "progress"
+            yield f"event: {event}\ndata: {encode_json(job).decode()}\n\n"
+            if finished:
                 break
-                
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
-    
-    return {
-        "message": f"Processed {total_processed} new messages, skipped {total_skipped} existing messages"
-    }
+            await asyncio.sleep(SYNC_EVENT_INTERVAL)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+# Selected for every email in a response, in the order Dimensions.decode
+# expects; it swaps the dimension IDs for the sender's name, address and domain
+EMAIL_COLUMNS = (
+    EmailMessage.account_id,
+    EmailMessage.id,
+    EmailMessage.sender_name_id,
+    EmailMessage.sender_id,
+    EmailMessage.domain_id,
+    EmailMessage.subject,
+    EmailMessage.received_date,
+)
+
+def filtered_query(
+    search: Optional[str],
+    after_date: Optional[str],
+    ranked: bool = False,
+    account_id: Optional[int] = None
+):
+    """Returns a select from email_messages with the account, search and date filters applied.
+
+    Callers choose its columns with ``with_only_columns``. Search uses the
+    full-text index when available, ordering by relevance first if
+    ``ranked``; otherwise it falls back to ILIKE.
+    """
+    base_query = select(EmailMessage).select_from(EmailMessage)
+    if account_id is not None:
+        base_query = base_query.filter(EmailMessage.account_id == account_id)
+
+    matches = search_matches(search) if search else None
+    if matches is not None:
+        base_query = base_query.join(matches, matches.c.rowid == literal_column('email_messages.rowid'))
+        if ranked:
+            base_query = base_query.order_by(matches.c.rank)
+    elif search:
+        search_filter = f"%{search}%"
+        # Matching the small dimension tables first keeps the scan of messages to integer lookups
+        base_query = base_query.filter(
+            EmailMessage.sender_id.in_(select(Sender.id).where(Sender.email.ilike(search_filter))) |
+            EmailMessage.sender_name_id.in_(select(SenderName.id).where(SenderName.name.ilike(search_filter))) |
+            EmailMessage.subject.ilike(search_filter)
+        )
+
+    if after_date:
+        base_query = base_query.filter(EmailMessage.received_date >= parse_after_date(after_date))
+
+    return base_query
+
+def parse_after_date(after_date: str) -> datetime:
+    try:
+        return datetime.fromisoformat(after_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format. Use ISO format (YYYY-MM-DD)")
+
+def filtered_sketch(
+    db: Session,
+    search: Optional[str],
+    after_date: Optional[str],
+    account_id: Optional[int],
+    max_error: Optional[float]
+) -> Optional[BucketSketch]:
+    """The merged sketch of the filtered emails, or None if sketches within ``max_error`` cannot stand in for them.
+
+    Sketches hold whole days, so they only answer for an ``after_date``
+    at midnight, without a search.
+    """
+    if search or not after_date or not within(max_error):
+        return None
+    after = parse_after_date(after_date)
+    if after.tzinfo is not None or after.time() != time.min:
+        return None
+    return SketchService(db).merged(account_id, after.date(), None)
+
+def latest_emails_by_group(db: Session, base_query, key_column, keys, limit: int):
+    """Returns up to ``limit`` most recent emails per group ID, in one windowed query."""
+    if not keys or limit == 0:
+        return {}
+
+    rank = func.row_number().over(
+        partition_by=key_column,
+        order_by=(desc(EmailMessage.received_date), desc(EmailMessage.id))
+    ).label('rank')
+    ranked = (
+        base_query
+        .filter(key_column.in_(keys))
+        .with_only_columns(*EMAIL_COLUMNS, rank)
+        .subquery()
+    )
+    rows = db.execute(
+        select(ranked.c[key_column.key], *(ranked.c[column.key] for column in EMAIL_COLUMNS))
+        .where(ranked.c.rank <= limit)
+        .order_by(ranked.c[key_column.key], ranked.c.rank)
+    ).all()
+
+    emails = {key: [] for key in keys}
+    decoded = dimensions_for(db).decode(db, [row[1:] for row in rows])
+    for row, email in zip(rows, decoded):
+        emails[row[0]].append(email)
+    return emails
+
+def latest_sender_names(db: Session, base_query, sender_ids) -> dict:
+    """Returns the name ID on each sender's most recent email, in one windowed query."""
+    if not sender_ids:
+        return {}
+
+    rank = func.row_number().over(
+        partition_by=EmailMessage.sender_id,
+        order_by=(desc(EmailMessage.received_date), desc(EmailMessage.id))
+    ).label('rank')
+    ranked = (
+        base_query
+        .filter(EmailMessage.sender_id.in_(sender_ids))
+        .with_only_columns(EmailMessage.sender_id, EmailMessage.sender_name_id, rank)
+        .subquery()
+    )
+    return dict(db.execute(
+        select(ranked.c.sender_id, ranked.c.sender_name_id).where(ranked.c.rank == 1)
+    ).all())
+
+def encode_cursor(*values) -> str:
+    """Packs the sort key of the last row on a page into an opaque cursor."""
+    payload = encode_json(values)
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+def decode_cursor(cursor: str, size: int) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, binascii.Error):
+        values = None
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def after_group(count_column, key_column, cursor_values):
+    """Keyset condition for groups ordered by count descending, then key ascending.
+
+    The leading ``count <=`` bound lets the rank index seek instead of scan.
+    """
+    count, key = cursor_values
+    return (count_column <= count) & ((count_column < count) | (key_column > key))
 
-@router.get("/emails")
+def before_email(received_date, message_id):
+    """Keyset condition for emails ordered by date then ID descending.
+
+    Dated positions seek on the (received_date, id) index; undated emails
+    sort last and are fetched separately once the dated range runs out.
+    """
+    if received_date is None:
+        return EmailMessage.received_date.is_(None) & (EmailMessage.id < message_id)
+    try:
+        received_date = datetime.fromisoformat(received_date)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return tuple_(EmailMessage.received_date, EmailMessage.id) < (received_date, message_id)
+
+@router.get("/emails", response_model=EmailPage)
 async def get_emails(
-    db: Session = Depends(get_db),
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
     page: int = Query(1, ge=1),
     page_size: int = Query(50, ge=1, le=100),
     search: Optional[str] = None,
     after_date: Optional[str] = None,
-    sort_by: Literal["date", "sender_frequency", "domain_frequency"] = "domain_frequency"
+    sort_by: Literal["date", "relevance", "sender_frequency", "domain_frequency"] = "domain_frequency",
+    emails_per_group: int = Query(10, ge=0, le=100),
+    cursor: Optional[str] = None,
+    include_total: bool = True,
+    account_id: Optional[int] = None,
+    max_error: Optional[float] = Query(None, gt=0, lt=1)
 ):
-    # Start with base query
-    base_query = db.query(EmailMessage)
-    
-    # Apply filters
-    if search:
-        search_filter = f"%{search}%"
-        base_query = base_query.filter(
-            (EmailMessage.sender_email.ilike(search_filter)) |
-            (EmailMessage.sender_name.ilike(search_filter)) |
-            (EmailMessage.subject.ilike(search_filter))
-        )
-    
-    if after_date:
-        try:
-            date_filter = datetime.fromisoformat(after_date)
-            base_query = base_query.filter(EmailMessage.received_date >= date_filter)
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid date format. Use ISO format (YYYY-MM-DD)")
+    """Returns a page of emails or sender/domain groups.
+
+    Pass the previous response's ``next_cursor`` as ``cursor`` to page by
+    keyset, which costs the same on every page; ``page`` is then ignored.
+    Set ``include_total=false`` to skip counting the filtered results.
+    Pass ``account_id`` to list one account's emails instead of all of them.
+    Pass ``max_error`` to accept a group total estimated from sketches
+    within that relative error, reported as ``total_error``.
+    Responses are cached until the next sync changes the data.
+    """
+    # Both search paths are case-insensitive
+    search = search.strip().lower() if search else None
+    key = (
+        "emails", page, page_size, search, after_date, sort_by,
+        emails_per_group, cursor, include_total, account_id, max_error
+    )
+    return await cached_json_async(request, key, lambda: db.run_sync(
+        list_emails, page, page_size, search, after_date, sort_by,
+        emails_per_group, cursor, include_total, account_id, max_error
+    ))
+
+def list_emails(
+    db: Session,
+    page: int,
+    page_size: int,
+    search: Optional[str],
+    after_date: Optional[str],
+    sort_by: str,
+    emails_per_group: int,
+    cursor: Optional[str],
+    include_total: bool,
+    account_id: Optional[int] = None,
+    max_error: Optional[float] = None
+):
+    """Builds the /emails response body; see ``get_emails``."""
+    if cursor and sort_by == "relevance":
+        raise HTTPException(status_code=400, detail="Cursor pagination is not supported when sorting by relevance")
+
+    base_query = filtered_query(search, after_date, ranked=sort_by == "relevance", account_id=account_id)
+    stats_account_id = ALL_ACCOUNTS if account_id is None else account_id
+    offset = 0 if cursor else (page - 1) * page_size
+    total = None
+    total_error = None
+    next_cursor = None
+
+    # Unfiltered group listings are served from the maintained aggregates
+    filtered = bool(search or after_date)
 
     # Handle different sort types
     if sort_by == "sender_frequency":
-        groups = (
-            base_query
-            .group_by(EmailMessage.sender_email, EmailMessage.sender_name)
-            .with_entities(
-                EmailMessage.sender_email,
-                EmailMessage.sender_name,
-                func.count().label('email_count'),
-                func.max(EmailMessage.received_date).label('latest_date')
-            )
-            .order_by(desc('email_count'))
-            .offset((page - 1) * page_size)
-            .limit(page_size)
-            .all()
-        )
-        
-        # Get emails for each group
-        result = []
-        for group in groups:
-            emails = (
+        if filtered:
+            email_count = func.count()
+            group_query = (
                 base_query
-                .filter(EmailMessage.sender_email == group.sender_email)
-                .order_by(desc(EmailMessage.received_date))
-                .all()
+                .group_by(EmailMessage.sender_id)
+                .with_only_columns(
+                    EmailMessage.sender_id,
+                    email_count.label('email_count'),
+                    func.max(EmailMessage.received_date).label('latest_date')
+                )
+                .order_by(desc(email_count), EmailMessage.sender_id)
+            )
+            if cursor:
+                group_query = group_query.having(
+                    after_group(email_count, EmailMessage.sender_id, decode_cursor(cursor, 2))
+                )
+            sketch = filtered_sketch(db, search, after_date, account_id, max_error) if include_total else None
+            if sketch is not None:
+                total, total_error = round(sketch.senders.estimate()), DISTINCT_ERROR
+            elif include_total:
+                total = db.scalar(base_query.with_only_columns(func.count(distinct(EmailMessage.sender_id))))
+        else:
+            group_query = (
+                select(
+                    SenderStat.sender_id,
+                    SenderStat.sender_name_id,
+                    SenderStat.count.label('email_count'),
+                    SenderStat.latest_date
+                )
+                .filter(SenderStat.account_id == stats_account_id)
+                .order_by(desc(SenderStat.count), SenderStat.sender_id)
             )
-            result.append({
+            if cursor:
+                group_query = group_query.filter(
+                    after_group(SenderStat.count, SenderStat.sender_id, decode_cursor(cursor, 2))
+                )
+            if include_total:
+                total = db.scalar(
+                    select(func.count())
+                    .select_from(SenderStat)
+                    .filter(SenderStat.account_id == stats_account_id)
+                )
+
+        groups = db.execute(group_query.offset(offset).limit(page_size)).all()
+        if len(groups) == page_size:
+            next_cursor = encode_cursor(groups[-1].email_count, groups[-1].sender_id)
+
+        # Most recent emails of each group; the rest load from /emails/group
+        emails = latest_emails_by_group(
+            db,
+            base_query,
+            EmailMessage.sender_id,
+            [group.sender_id for group in groups],
+            emails_per_group
+        )
+        dimensions = dimensions_for(db)
+        addresses = dimensions.senders.lookup(db, (group.sender_id for group in groups))
+        if filtered and emails_per_group:
+            # Each group's emails start with its most recent
+            latest_names = {
+                sender_id: group_emails[0]['sender_name'] for sender_id, group_emails in emails.items() if group_emails
+            }
+        else:
+            if filtered:
+                name_ids = latest_sender_names(db, base_query, [group.sender_id for group in groups])
+            else:
+                name_ids = {group.sender_id: group.sender_name_id for group in groups}
+            names = dimensions.names.lookup(db, name_ids.values())
+            latest_names = {sender_id: names.get(name_id) for sender_id, name_id in name_ids.items()}
+        result = [
+            {
                 "type": "sender",
-                "email": group.sender_email,
-                "name": group.sender_name,
+                "email": addresses.get(group.sender_id),
+                "name": latest_names.get(group.sender_id),
                 "count": group.email_count,
                 "latest_date": group.latest_date,
-                "emails": emails
-            })
-        
-        total = db.query(func.count(distinct(EmailMessage.sender_email))).scalar()
+                "emails": emails.get(group.sender_id, [])
+            }
+            for group in groups
+        ]
 
     elif sort_by == "domain_frequency":
-        groups = (
-            base_query
-            .group_by(EmailMessage.sender_domain)
-            .with_entities(
-                EmailMessage.sender_domain,
-                func.count().label('email_count'),
-                func.max(EmailMessage.received_date).label('latest_date')
-            )
-            .order_by(desc('email_count'))
-            .offset((page - 1) * page_size)
-            .limit(page_size)
-            .all()
-        )
-        
-        # Get emails for each group
-        result = []
-        for group in groups:
-            emails = (
+        if filtered:
+            email_count = func.count()
+            group_query = (
                 base_query
-                .filter(EmailMessage.sender_domain == group.sender_domain)
-                .order_by(desc(EmailMessage.received_date))
-                .all()
+                .group_by(EmailMessage.domain_id)
+                .with_only_columns(
+                    EmailMessage.domain_id,
+                    email_count.label('email_count'),
+                    func.max(EmailMessage.received_date).label('latest_date')
+                )
+                .order_by(desc(email_count), EmailMessage.domain_id)
             )
-            result.append({
-                "type": "domain",
-                "domain": group.sender_domain,
-                "count": group.email_count,
-                "latest_date": group.latest_date,
-                "emails": emails
-            })
-        
-        total = db.query(func.count(distinct(EmailMessage.sender_domain))).scalar()
-
-    else:  # date sorting
-        # Create subqueries for counts
-        sender_counts = (
-            db.query(
-                EmailMessage.sender_email,
-                func.count().label('sender_count')
+            if cursor:
+                group_query = group_query.having(
+                    after_group(email_count, EmailMessage.domain_id, decode_cursor(cursor, 2))
+                )
+            sketch = filtered_sketch(db, search, after_date, account_id, max_error) if include_total else None
+            if sketch is not None:
+                total, total_error = round(sketch.domains.estimate()), DISTINCT_ERROR
+            elif include_total:
+                total = db.scalar(base_query.with_only_columns(func.count(distinct(EmailMessage.domain_id))))
+        else:
+            group_query = (
+                select(
+                    DomainStat.domain_id,
+                    DomainStat.count.label('email_count'),
+                    DomainStat.latest_date
+                )
+                .filter(DomainStat.account_id == stats_account_id)
+                .order_by(desc(DomainStat.count), DomainStat.domain_id)
             )
-            .group_by(EmailMessage.sender_email)
-            .subquery()
-        )
+            if cursor:
+                group_query = group_query.filter(
+                    after_group(DomainStat.count, DomainStat.domain_id, decode_cursor(cursor, 2))
+                )
+            if include_total:
+                total = db.scalar(
+                    select(func.count())
+                    .select_from(DomainStat)
+                    .filter(DomainStat.account_id == stats_account_id)
+                )
 
-        domain_counts = (
-            db.query(
-                EmailMessage.sender_domain,
-                func.count().label('domain_count')
-            )
-            .group_by(EmailMessage.sender_domain)
-            .subquery()
+        groups = db.execute(group_query.offset(offset).limit(page_size)).all()
+        if len(groups) == page_size:
+            next_cursor = encode_cursor(groups[-1].email_count, groups[-1].domain_id)
+
+        # Most recent emails of each group; the rest load from /emails/group
+        emails = latest_emails_by_group(
+            db,
+            base_query,
+            EmailMessage.domain_id,
+            [group.domain_id for group in groups],
+            emails_per_group
         )
+        domains = dimensions_for(db).domains.lookup(db, (group.domain_id for group in groups))
+        result = [
+            {
+                "type": "domain",
+                "domain": domains.get(group.domain_id),
+                "count": group.email_count,
+                "latest_date": group.latest_date,
+                "emails": emails.get(group.domain_id, [])
+            }
+            for group in groups
+        ]
 
-        # Join with the main query
+    else:  # date sorting, after search relevance when sorting by relevance
+        # Join the per-sender and per-domain totals from the aggregates
         query = (
             base_query
-            .outerjoin(
-                sender_counts,
-                EmailMessage.sender_email == sender_counts.c.sender_email
-            )
-            .outerjoin(
-                domain_counts,
-                EmailMessage.sender_domain == domain_counts.c.sender_domain
+            .outerjoin(SenderStat, and_(
+                SenderStat.account_id == stats_account_id,
+                SenderStat.sender_id == EmailMessage.sender_id
+            ))
+            .outerjoin(DomainStat, and_(
+                DomainStat.account_id == stats_account_id,
+                DomainStat.domain_id == EmailMessage.domain_id
+            ))
+            .with_only_columns(
+                *EMAIL_COLUMNS,
+                func.coalesce(SenderStat.count, 0).label('sender_count'),
+                func.coalesce(DomainStat.count, 0).label('domain_count')
             )
-            .add_columns(
-                sender_counts.c.sender_count,
-                domain_counts.c.domain_count
-            )
-            .order_by(desc(EmailMessage.received_date))
+            .order_by(desc(EmailMessage.received_date).nulls_last(), desc(EmailMessage.id))
         )
+        undated_query = query.filter(EmailMessage.received_date.is_(None))
+        if cursor:
+            received_date, message_id = decode_cursor(cursor, 2)
+            query = query.filter(before_email(received_date, message_id))
+
+        emails = db.execute(query.offset(offset).limit(page_size)).all()
+        if cursor and received_date is not None and len(emails) < page_size:
+            emails += db.execute(undated_query.limit(page_size - len(emails))).all()
+        if len(emails) == page_size and sort_by == "date":
+            next_cursor = encode_cursor(emails[-1].received_date, emails[-1].id)
+
+        result = dimensions_for(db).decode(db, emails, extra=('sender_count', 'domain_count'))
+
+        if include_total and filtered:
+            total = db.scalar(base_query.with_only_columns(func.count()).order_by(None))
+        elif include_total:
+            total = db.scalar(
+                select(func.coalesce(func.sum(DomainStat.count), 0))
+                .filter(DomainStat.account_id == stats_account_id)
+            )
 
-        emails = query.offset((page - 1) * page_size).limit(page_size).all()
-        
-        # Format the results
-        result = [
-            {
-                "id": email[0].id,
-                "sender_name": email[0].sender_name,
-                "sender_email": email[0].sender_email,
-                "sender_domain": email[0].sender_domain,
-                "subject": email[0].subject,
-                "received_date": email[0].received_date,
-                "sender_count": email[1] or 0,
-                "domain_count": email[2] or 0
-            }
-            for email in emails
-        ]
-        
-        total = base_query.count()
-    
     return {
         "total": total,
+        "total_error": total_error,
         "page": page,
         "page_size": page_size,
+        "next_cursor": next_cursor,
         "results": result
     }
 
-@router.get("/analytics")
-async def get_analytics(db: Session = Depends(get_db)):
-    """Returns email analytics."""
-    analytics_service = AnalyticsService(db)
-    return analytics_service.get_analytics()
+@router.get("/emails/export")
+async def export_emails(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    search: Optional[str] = None,
+    after_date: Optional[str] = None,
+    sort_by: Literal["date", "relevance", "sender_frequency", "domain_frequency"] = "date",
+    account_id: Optional[int] = None
+):
+    """Streams every matching email as NDJSON or CSV, in ``/emails`` order.
+
+    Frequency sorts list each sender's or domain's emails together, the
+    largest groups first. Rows are read in batches from a server-side
+    cursor, so memory use does not grow with the mailbox.
+    """
+    search = search.strip().lower() if search else None
+    # Reject bad filters before the response starts
+    if after_date:
+        parse_after_date(after_date)
+
+    return StreamingResponse(
+        export_rows(format, search, after_date, sort_by, account_id),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="emails.{format}"'}
+    )
+
+def export_query(search: Optional[str], after_date: Optional[str], sort_by: str, account_id: Optional[int]):
+    """Returns the rows of an export, ordered as ``list_emails`` orders them."""
+    query = filtered_query(search, after_date, ranked=sort_by == "relevance", account_id=account_id)
+    filtered = bool(search or after_date)
+    stats_account_id = ALL_ACCOUNTS if account_id is None else account_id
+
+    group_counts = None
+    if sort_by == "sender_frequency":
+        key_column, stat, stat_key = EmailMessage.sender_id, SenderStat, SenderStat.sender_id
+    elif sort_by == "domain_frequency":
+        key_column, stat, stat_key = EmailMessage.domain_id, DomainStat, DomainStat.domain_id
+    else:
+        key_column = None
+
+    if key_column is not None:
+        if filtered:
+            # Group sizes within the filtered results, as the listing shows them
+            group_counts = (
+                query
+                .group_by(key_column)
+                .with_only_columns(key_column.label('key'), func.count().label('count'))
+                .subquery()
+            )
+            query = query.join(group_counts, group_counts.c.key == key_column)
+            group_count = group_counts.c['count']
+        else:
+            query = query.join(stat, and_(stat.account_id == stats_account_id, stat_key == key_column))
+            group_count = stat.count
+        query = query.order_by(desc(group_count), key_column)
+
+    return (
+        query
+        .with_only_columns(*EMAIL_COLUMNS)
+        .order_by(desc(EmailMessage.received_date).nulls_last(), desc(EmailMessage.id))
+    )
+
+def export_rows(format: str, search: Optional[str], after_date: Optional[str], sort_by: str, account_id: Optional[int]):
+    """Yields the encoded export a batch of rows at a time.
+
+    The response outlives the request's dependencies, so the export opens
+    and closes its own session.
+    """
+    with SessionLocal() as db:
+        query = export_query(search, after_date, sort_by, account_id)
+        result = db.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        dimensions = dimensions_for(db)
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if format == "csv":
+            writer.writerow(DECODED_KEYS)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+        for rows in result.partitions():
+            rows = dimensions.decode(db, rows)
+            if format != "csv":
+                # Encoded like every other response
+                yield b''.join(encode_json(row) + b'\n' for row in rows)
+                continue
+            for row in rows:
+                if row['received_date'] is not None:
+                    row['received_date'] = row['received_date'].isoformat()
+                writer.writerow(row.values())
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+@router.get("/emails/group/{group_type}/{key}", response_model=GroupEmailPage)
+async def get_group_emails(
+    group_type: Literal["sender", "domain"],
+    key: str,
+    db: AsyncSession = Depends(get_async_db),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(50, ge=1, le=100),
+    search: Optional[str] = None,
+    after_date: Optional[str] = None,
+    account_id: Optional[int] = None
+):
+    """Returns one sender's or domain's emails, newest first, for lazy group expansion."""
+    return FastJSONResponse(await db.run_sync(
+        list_group_emails, group_type, key, page, page_size, search, after_date, account_id
+    ))
+
+def list_group_emails(
+    db: Session,
+    group_type: str,
+    key: str,
+    page: int,
+    page_size: int,
+    search: Optional[str],
+    after_date: Optional[str],
+    account_id: Optional[int] = None
+):
+    """Builds the /emails/group response body; see ``get_group_emails``."""
+    dimensions = dimensions_for(db)
+    if group_type == "sender":
+        key_column, key_id = EmailMessage.sender_id, dimensions.senders.find(db, key)
+    else:
+        key_column, key_id = EmailMessage.domain_id, dimensions.domains.find(db, key)
+    if key_id is None:
+        return {"total": 0, "page": page, "page_size": page_size, "results": []}
+    query = filtered_query(search, after_date, account_id=account_id).filter(key_column == key_id)
+
+    emails = db.execute(
+        query
+        .with_only_columns(*EMAIL_COLUMNS)
+        .order_by(desc(EmailMessage.received_date), desc(EmailMessage.id))
+        .offset((page - 1) * page_size)
+        .limit(page_size)
+    ).all()
+
+    return {
+        "total": db.scalar(query.with_only_columns(func.count())),
+        "page": page,
+        "page_size": page_size,
+        "results": dimensions.decode(db, emails)
+    }
+
+@router.get("/analytics", response_model=Analytics)
+async def get_analytics(
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+    account_id: Optional[int] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    max_error: Optional[float] = Query(None, gt=0, lt=1)
+):
+    """Returns email analytics for one account, or across all of them.
+
+    ``start`` and ``end`` bound the range inclusively, by received date.
+    Pass ``max_error`` to accept a range's counts estimated from sketches
+    within that relative error, which costs the same however many
+    messages it holds; the response's ``error`` gives their bounds.
+    """
+    if start and end and start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+
+    key = ("analytics", account_id, start, end, max_error)
+    return await cached_json_async(request, key, lambda: db.run_sync(
+        lambda session: AnalyticsService(session).get_analytics(account_id, start, end, max_error)
+    ))
+
+@router.get("/analytics/timeseries", response_model=Timeseries)
+async def get_timeseries(
+    request: Request,
+    db: AsyncSession = Depends(get_async_db),
+    bucket: Literal["day", "week", "month"] = "day",
+    sender: Optional[str] = None,
+    domain: Optional[str] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    account_id: Optional[int] = None
+):
+    """Returns message volume per day, week or month for a sender, a domain or the whole mailbox.
+
+    ``start`` and ``end`` bound the range inclusively, by received date.
+    """
+    if sender and domain:
+        raise HTTPException(status_code=400, detail="Pass either sender or domain, not both")
+    if start and end and start > end:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+
+    # Addresses and domains are stored lowercased
+    sender = sender.strip().lower() if sender else None
+    domain = domain.strip().lower() if domain else None
+    key = ("timeseries", bucket, sender, domain, start, end, account_id)
+    return await cached_json_async(request, key, lambda: db.run_sync(
+        lambda session: AnalyticsService(session).get_timeseries(bucket, sender, domain, start, end, account_id)
+    ))
+
+@router.get("/cache")
+def get_cache_stats():
+    """Returns response cache hit, miss and eviction counters."""
+    return response_cache.stats()
+
+@router.get("/metrics")
+def get_metrics():
+    """Returns request, query and cache metrics in the Prometheus text format."""
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
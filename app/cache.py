@@ -0,0 +1,114 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from fastapi import Request, Response
+from .config import settings
+from .serialization import encode_json
+
+
+class ResponseCache:
+    """Size-bounded LRU of encoded JSON responses with a TTL.
+
+    Entries are keyed on the data version as well as the request, so
+    ``bump_version()`` (called whenever a sync commits changes) makes every
+    earlier entry unreachable; they are dropped at once to free memory.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get((self.version, key))
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[(self.version, key)]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end((self.version, key))
+            self.hits += 1
+            return value
+
+    def set(self, key, value, version: int):
+        with self._lock:
+            # A sync committed while this value was computed; it may be stale
+            if version != self.version:
+                return
+            self._entries[(version, key)] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end((version, key))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def bump_version(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "version": self.version,
+                "size": len(self._entries),
+                "max_size": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+response_cache = ResponseCache(settings.RESPONSE_CACHE_SIZE, settings.RESPONSE_CACHE_TTL)
+
+
+def _encode(key, value, version: int):
+    body = encode_json(value)
+    etag = '"%s"' % hashlib.blake2b(body, digest_size=12).hexdigest()
+    entry = (etag, body)
+    response_cache.set(key, entry, version)
+    return entry
+
+
+def _respond(request: Request, entry) -> Response:
+    etag, body = entry
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def cached_json(request: Request, key, compute) -> Response:
+    """Serves ``compute()`` as JSON from the response cache, honoring If-None-Match.
+
+    ``key`` must identify the response given the current data, e.g. the
+    endpoint name with its normalized query parameters.
+    """
+    version = response_cache.version
+    entry = response_cache.get(key)
+    if entry is None:
+        entry = _encode(key, compute(), version)
+    return _respond(request, entry)
+
+
+async def cached_json_async(request: Request, key, compute) -> Response:
+    """Like ``cached_json``, for handlers whose ``compute()`` is awaitable."""
+    version = response_cache.version
+    entry = response_cache.get(key)
+    if entry is None:
+        entry = _encode(key, await compute(), version)
+    return _respond(request, entry)
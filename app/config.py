@@ -1,10 +1,45 @@
+from typing import Optional
 from pydantic_settings import BaseSettings
 
 class Settings(BaseSettings):
     DATABASE_URL: str = "sqlite:///./gmail_analyzer.db"
+    # Defaults to DATABASE_URL on its async driver (aiosqlite or asyncpg)
+    ASYNC_DATABASE_URL: Optional[str] = None
+    DATABASE_POOL_SIZE: int = 5
+    DATABASE_MAX_OVERFLOW: int = 10
+    DATABASE_POOL_TIMEOUT: float = 30.0
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    # Negative sizes are in KiB, so -65536 is a 64 MiB page cache per connection
+    SQLITE_CACHE_SIZE: int = -65536
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    SQLITE_BUSY_TIMEOUT: int = 5000
     GMAIL_SCOPES: list = ['https://www.googleapis.com/auth/gmail.readonly']
     CREDENTIALS_FILE: str = "credentials.json"
+    # Token of the first account; accounts added later keep theirs in TOKENS_DIR
     TOKEN_FILE: str = "token.pickle"
+    TOKENS_DIR: str = "tokens"
     CORS_ORIGINS: list = ["http://localhost:3000"]
+    # Point at a local stand-in discovery service to run sync offline
+    GMAIL_DISCOVERY_URL: Optional[str] = None
+    # Local copy of the discovery document clients are built from, refetched
+    # once older than the TTL in seconds; a stale copy is used while offline
+    GMAIL_DISCOVERY_CACHE: str = "gmail_discovery.json"
+    GMAIL_DISCOVERY_CACHE_TTL: float = 7 * 24 * 3600
+    # Seconds before expiry at which cached credentials are refreshed
+    GMAIL_TOKEN_REFRESH_MARGIN: float = 300.0
+    SYNC_BATCH_SIZE: int = 50
+    SYNC_WORKERS: int = 4
+    SYNC_MAX_RETRIES: int = 5
+    # Accounts synced in parallel, each in its own process; 0 runs them on threads
+    SYNC_PROCESSES: int = 4
+    # Gmail's per-user quota, which each account's sync paces itself to; 0 disables pacing
+    GMAIL_QUOTA_UNITS_PER_SECOND: float = 250.0
+    RESPONSE_CACHE_SIZE: int = 256
+    RESPONSE_CACHE_TTL: float = 300.0
+    # "sql", or "columnar" to answer analytics from in-memory arrays (needs numpy)
+    ANALYTICS_ENGINE: str = "sql"
+    # Statements slower than this many seconds are logged, with their plan
+    SLOW_QUERY_THRESHOLD: float = 0.1
+    SLOW_QUERY_EXPLAIN: bool = True
 
 settings = Settings()
@@ -1,10 +1,85 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from .config import settings
+from .metrics import instrument_engine
+
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+def is_file_sqlite(url) -> bool:
+    url = make_url(url)
+    return (
+        url.get_backend_name() == 'sqlite'
+        and url.database not in (None, '', ':memory:')
+        and url.query.get('mode') != 'memory'
+    )
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Tunes each new SQLite connection: WAL so readers never wait on the writer, plus cache sizing."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA cache_size={int(settings.SQLITE_CACHE_SIZE)}")
+    cursor.execute(f"PRAGMA mmap_size={int(settings.SQLITE_MMAP_SIZE)}")
+    cursor.execute(f"PRAGMA busy_timeout={int(settings.SQLITE_BUSY_TIMEOUT)}")
+    cursor.close()
+
+def begin_immediately(engine):
+    """Makes SQLite transactions on ``engine`` take the write lock as they begin.
+
+    A deferred transaction that reads before it writes fails outright with
+    "database is locked" if another process committed in between, which
+    ``busy_timeout`` cannot wait out; ``BEGIN IMMEDIATE`` waits for the lock
+    up front instead, so transactions on it must be kept short.
+    """
+    @event.listens_for(engine, "connect")
+    def disable_implicit_begin(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def begin(conn):
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return engine
+
+def engine_options(url, pool_size: int = None, max_overflow: int = None) -> dict:
+    """Pool sizing for ``create_engine``; in-memory SQLite keeps its single-connection pool."""
+    if make_url(url).get_backend_name() == 'sqlite' and not is_file_sqlite(url):
+        return {}
+    return {
+        "pool_size": settings.DATABASE_POOL_SIZE if pool_size is None else pool_size,
+        "max_overflow": settings.DATABASE_MAX_OVERFLOW if max_overflow is None else max_overflow,
+        "pool_timeout": settings.DATABASE_POOL_TIMEOUT,
+    }
+
+def tune_engine(engine):
+    """Applies the SQLite pragmas where they matter and installs the query metrics hooks."""
+    if is_file_sqlite(engine.url):
+        event.listen(engine, "connect", set_sqlite_pragmas)
+    return instrument_engine(engine)
+
+# Reads (every API request) share a pool; on SQLite, sync writes go through
+# a dedicated single-connection engine so SQLite's one writer is never
+# contended for within a process, and WAL lets the readers proceed while it
+# commits. Sync worker processes each have their own, so its transactions
+# begin immediately and objects are not expired on commit, which would
+# start another transaction just to reload them.
+engine = tune_engine(create_engine(settings.DATABASE_URL, **engine_options(settings.DATABASE_URL)))
+if is_file_sqlite(settings.DATABASE_URL):
+    writer_engine = begin_immediately(tune_engine(create_engine(
+        settings.DATABASE_URL,
+        **engine_options(settings.DATABASE_URL, pool_size=1, max_overflow=0)
+    )))
+else:
+    writer_engine = engine
 
-engine = create_engine(settings.DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+WriterSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=writer_engine)
 Base = declarative_base()
 
 def get_db():
@@ -13,3 +88,35 @@ def get_db():
         yield db
     finally:
         db.close()
+
+def async_database_url() -> str:
+    if settings.ASYNC_DATABASE_URL:
+        return settings.ASYNC_DATABASE_URL
+    url = make_url(settings.DATABASE_URL)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername)).render_as_string(hide_password=False)
+
+_async_sessionmaker = None
+
+def get_async_sessionmaker() -> async_sessionmaker:
+    """Builds the async engine on first use, so its driver is only imported when needed."""
+    global _async_sessionmaker
+    if _async_sessionmaker is None:
+        url = async_database_url()
+        async_engine = create_async_engine(url, **engine_options(url))
+        tune_engine(async_engine.sync_engine)
+        _async_sessionmaker = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    return _async_sessionmaker
+
+async def get_async_db():
+    async with get_async_sessionmaker()() as db:
+        yield db
+
+def dialect_insert(bind):
+    """Returns the dialect's ``insert`` construct when it supports ON CONFLICT, else None."""
+    if bind.dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert
+    if bind.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert
+    return None
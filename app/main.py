@@ -1,13 +1,20 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from .config import settings
-from .database import engine, Base
+from .database import writer_engine
 from .api.routes import router
+from .metrics import MetricsMiddleware
+from .migrations import migrate
+from .serialization import FastJSONResponse
+from .services.jobs import sync_jobs
+from .services.search import ensure_search_index
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+# Create database tables and bring existing ones up to date
+migrate(writer_engine)
+ensure_search_index(writer_engine)
+sync_jobs.fail_interrupted()
 
-app = FastAPI(title="Gmail Analyzer API")
+app = FastAPI(title="Gmail Analyzer API", default_response_class=FastJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -17,5 +24,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Added last so it is outermost and times the whole request
+app.add_middleware(MetricsMiddleware)
 
 app.include_router(router, prefix="/api")
@@ -0,0 +1,204 @@
+"""Maintenance commands, run as ``python -m app.manage <command>``."""
+import argparse
+import os
+import sys
+import uuid
+from datetime import datetime
+from sqlalchemy import desc, func, select, tuple_
+from .config import settings
+from .database import SessionLocal, WriterSessionLocal, engine, writer_engine
+from .migrations import migrate
+from .models import ALL_ACCOUNTS, Account, DomainStat, EmailMessage, SenderDailyStat, SenderStat, Sketch
+from .services.gmail import GmailService
+from .services.search import ensure_search_index, rebuild_search_index, search_index_enabled
+from .services.sketches import SketchService
+from .services.stats import StatsService
+
+
+def migrate_database(args):
+    """Creates missing tables and applies pending schema migrations."""
+    print("Database is up to date")
+
+
+def query_plan_checks():
+    """Representative statements for each hot query path, with the index each must use."""
+    newest_first = (desc(EmailMessage.received_date).nulls_last(), desc(EmailMessage.id))
+    return [
+        (
+            "date listing",
+            select(EmailMessage).order_by(*newest_first).limit(50),
+            'ix_email_messages_date_id'
+        ),
+        (
+            "date listing after cursor",
+            select(EmailMessage)
+            .where(tuple_(EmailMessage.received_date, EmailMessage.id) < (datetime(2024, 1, 1), 'id'))
+            .order_by(*newest_first)
+            .limit(50),
+            'ix_email_messages_date_id'
+        ),
+        (
+            "account date listing",
+            select(EmailMessage)
+            .where(EmailMessage.account_id == 1)
+            .order_by(*newest_first)
+            .limit(50),
+            'ix_email_messages_account_date'
+        ),
+        (
+            "sender previews",
+            select(
+                EmailMessage.id,
+                func.row_number().over(
+                    partition_by=EmailMessage.sender_id,
+                    order_by=newest_first
+                )
+            )
+            .where(EmailMessage.sender_id.in_([1, 2])),
+            'ix_email_messages_sender_date'
+        ),
+        (
+            "domain expansion",
+            select(EmailMessage)
+            .where(EmailMessage.domain_id == 1)
+            .order_by(*newest_first)
+            .limit(50),
+            'ix_email_messages_domain_date'
+        ),
+        (
+            "sender ranking after cursor",
+            select(SenderStat)
+            .where(
+                SenderStat.account_id == ALL_ACCOUNTS,
+                (SenderStat.count <= 10) & ((SenderStat.count < 10) | (SenderStat.sender_id > 1))
+            )
+            .order_by(desc(SenderStat.count), SenderStat.sender_id)
+            .limit(50),
+            'ix_sender_stats_rank'
+        ),
+        (
+            "domain ranking",
+            select(DomainStat)
+            .where(DomainStat.account_id == 1)
+            .order_by(desc(DomainStat.count), DomainStat.domain_id)
+            .limit(50),
+            'ix_domain_stats_rank'
+        ),
+        (
+            "sender timeseries",
+            select(SenderDailyStat.day, SenderDailyStat.count)
+            .where(
+                SenderDailyStat.account_id == ALL_ACCOUNTS,
+                SenderDailyStat.sender_id == 1,
+                SenderDailyStat.day >= datetime(2024, 1, 1).date()
+            )
+            .order_by(SenderDailyStat.day),
+            'sqlite_autoindex_sender_daily_stats_1'
+        ),
+        (
+            "sketch range",
+            select(Sketch)
+            .where(Sketch.bucket == 'month', Sketch.start >= datetime(2024, 1, 1).date()),
+            'ix_sketches_bucket_start'
+        ),
+    ]
+
+
+def query_plan(conn, statement) -> str:
+    """The SQLite query plan of ``statement`` on ``conn``, as one line."""
+    compiled = statement.compile(dialect=conn.dialect, compile_kwargs={"render_postcompile": True})
+    params = compiled.construct_params()
+    plan = conn.exec_driver_sql(
+        'EXPLAIN QUERY PLAN ' + compiled.string,
+        tuple(params[key] for key in compiled.positiontup)
+    ).all()
+    return '; '.join(row[-1] for row in plan)
+
+
+def explain_queries(args):
+    """Checks with EXPLAIN QUERY PLAN that each hot query uses its index (SQLite only)."""
+    if engine.dialect.name != 'sqlite':
+        print("explain-queries only supports SQLite")
+        return
+
+    failures = 0
+    with engine.connect() as conn:
+        for name, statement, index in query_plan_checks():
+            details = query_plan(conn, statement)
+            ok = index in details
+            failures += not ok
+            print(f"{'ok  ' if ok else 'FAIL'} {name}: {details}")
+
+    if failures:
+        sys.exit(1)
+
+
+def rebuild_stats(args):
+    """Recomputes the sender and domain aggregates and sketches from email_messages."""
+    with WriterSessionLocal() as db:
+        StatsService(db).rebuild()
+        SketchService(db).rebuild()
+        db.commit()
+    print("Rebuilt sender and domain stats and sketches")
+
+
+def rebuild_search(args):
+    """Reindexes every message in the full-text search index."""
+    ensure_search_index(writer_engine)
+    if not search_index_enabled():
+        print("Full-text search is not available for this database")
+        return
+    with writer_engine.begin() as conn:
+        rebuild_search_index(conn)
+    print("Rebuilt search index")
+
+
+def add_account(args):
+    """Authorizes another Gmail account in the browser and registers it for syncing."""
+    os.makedirs(settings.TOKENS_DIR, exist_ok=True)
+    token_file = os.path.join(settings.TOKENS_DIR, f"{uuid.uuid4().hex}.pickle")
+    gmail_service = GmailService(token_file)
+    profile = gmail_service.get_service().users().getProfile(userId='me').execute()
+
+    with WriterSessionLocal() as db:
+        existing = db.scalars(select(Account).where(Account.email == profile['emailAddress'])).first()
+        if existing:
+            os.remove(token_file)
+            print(f"{existing.email} is already account {existing.id}")
+            return
+        account = Account(email=profile['emailAddress'], token_file=token_file, created_at=datetime.utcnow())
+        db.add(account)
+        db.commit()
+        print(f"Added {account.email} as account {account.id}")
+
+
+def list_accounts(args):
+    """Lists the registered Gmail accounts."""
+    with SessionLocal() as db:
+        for account in db.scalars(select(Account).order_by(Account.id)):
+            print(f"{account.id}\t{account.email or '(not synced yet)'}\t{account.token_file}")
+
+
+COMMANDS = {
+    'migrate': migrate_database,
+    'explain-queries': explain_queries,
+    'rebuild-stats': rebuild_stats,
+    'rebuild-search': rebuild_search,
+    'add-account': add_account,
+    'list-accounts': list_accounts,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m app.manage')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, command in COMMANDS.items():
+        subparsers.add_parser(name, help=command.__doc__)
+    args = parser.parse_args(argv)
+
+    migrate(writer_engine)
+    COMMANDS[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""Request and database instrumentation, exposed in Prometheus text format.
+
+``MetricsMiddleware`` times each request and, through a context variable,
+collects the queries it runs: the engine hooks installed by
+``instrument_engine`` add every statement's duration to the current
+request and to the global histograms, and log statements slower than
+``SLOW_QUERY_THRESHOLD`` with their query plan. Each response carries a
+``Server-Timing`` header splitting its time between the database and
+the rest, so a slow request shows where its time went.
+"""
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from typing import Optional
+from sqlalchemy import event
+from .cache import response_cache
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# Seconds; the Prometheus client's defaults
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+# Parameter sets of a slow executemany logged before the rest are elided
+LOGGED_PARAMETER_SETS = 3
+# Route label of requests no route matched, so arbitrary paths cannot add series
+UNMATCHED_ROUTE = 'unmatched'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    )
+    return '{' + pairs + '}'
+
+
+class Histogram:
+    """Cumulative-bucket histogram with one series per combination of label values."""
+
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket..., total count, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[index] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        bucket_labels = self.labels + ('le',)
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets + ('+Inf',), series):
+                    lines.append(f"{self.name}_bucket{format_labels(bucket_labels, label_values + (bound,))} {count}")
+                labels = format_labels(self.labels, label_values)
+                lines.append(f"{self.name}_sum{labels} {series[-1]}")
+                lines.append(f"{self.name}_count{labels} {series[-2]}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter", f"{self.name} {self.value}"]
+
+
+def render_value(name: str, help: str, kind: str, value) -> list:
+    return [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {value}"]
+
+
+request_duration = Histogram(
+    'http_request_duration_seconds', "Time to serve a request, including streaming its body.",
+    labels=('method', 'route', 'status')
+)
+request_queries = Histogram(
+    'http_request_db_queries', "Database statements run per request.",
+    labels=('method', 'route'), buckets=QUERY_COUNT_BUCKETS
+)
+request_db_duration = Histogram(
+    'http_request_db_duration_seconds', "Time per request spent executing database statements.",
+    labels=('method', 'route')
+)
+query_duration = Histogram(
+    'db_query_duration_seconds', "Time to execute a database statement, by its leading keyword.",
+    labels=('operation',)
+)
+slow_queries = Counter('db_slow_queries_total', "Statements slower than SLOW_QUERY_THRESHOLD.")
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in (request_duration, request_queries, request_db_duration, query_duration, slow_queries):
+        lines.extend(metric.render())
+    cache = response_cache.stats()
+    for key in ('hits', 'misses', 'evictions', 'expirations'):
+        lines.extend(render_value(
+            f'response_cache_{key}_total', f"Response cache {key}.", 'counter', cache[key]
+        ))
+    lines.extend(render_value('response_cache_entries', "Responses currently cached.", 'gauge', cache['size']))
+    lines.extend(render_value(
+        'response_cache_version', "Data version, bumped by every sync commit that changed data.", 'gauge', cache['version']
+    ))
+    return '\n'.join(lines) + '\n'
+
+
+class RequestStats:
+    """Database work done on behalf of one request."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+
+# Mutable, so statements run on threads or greenlets that copied the
+# request's context are still counted towards it
+current_request: ContextVar[Optional[RequestStats]] = ContextVar('current_request', default=None)
+
+
+def explain(conn, statement: str, parameters) -> Optional[str]:
+    """The plan of a statement that has just run on ``conn``, as one line, or None if unavailable."""
+    if conn.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    elif conn.dialect.name == 'postgresql':
+        prefix = 'EXPLAIN '
+    else:
+        return None
+    # A raw cursor, so the EXPLAIN itself is not timed or logged
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return '; '.join(str(row[-1]) for row in cursor.fetchall())
+    except Exception as e:
+        return f"unavailable: {e}"
+    finally:
+        cursor.close()
+
+
+def loggable_parameters(parameters, executemany: bool):
+    """The statement's parameters as logged; bulk inserts can carry thousands of rows."""
+    if executemany and len(parameters) > LOGGED_PARAMETER_SETS:
+        return f"{list(parameters[:LOGGED_PARAMETER_SETS])!r} and {len(parameters) - LOGGED_PARAMETER_SETS} more"
+    return repr(parameters)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started_at'].pop()
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'UNKNOWN'
+    query_duration.observe(elapsed, operation)
+
+    stats = current_request.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += elapsed
+
+    if elapsed >= settings.SLOW_QUERY_THRESHOLD:
+        slow_queries.inc()
+        plan = None
+        if settings.SLOW_QUERY_EXPLAIN and not executemany and operation in ('SELECT', 'WITH'):
+            plan = explain(conn, statement, parameters)
+        logger.warning(
+            "Slow query (%.1f ms): %s\nParameters: %s\nPlan: %s",
+            elapsed * 1000, statement, loggable_parameters(parameters, executemany), plan or 'not explained'
+        )
+
+
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute. Errors raised
+    # before an execution context exists never reached before_cursor_execute
+    # either; ExceptionContext has no cursor to tell them apart by.
+    if context.connection is not None and context.execution_context is not None:
+        started = context.connection.info.get('query_started_at')
+        if started:
+            started.pop()
+
+
+def instrument_engine(engine):
+    """Times every statement ``engine`` runs; pass an async engine's ``sync_engine``."""
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    event.listen(engine, 'handle_error', _handle_error)
+    return engine
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording each HTTP request's latency and database work.
+
+    Written against raw ASGI rather than ``BaseHTTPMiddleware`` so streamed
+    responses are timed until their last chunk is sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                elapsed = time.perf_counter() - started
+                timing = (
+                    f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries", '
+                    f'app;dur={(elapsed - stats.db_time) * 1000:.1f}'
+                )
+                message['headers'] = list(message.get('headers', [])) + [(b'server-timing', timing.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_request.reset(token)
+            # The router records the matched route on the scope
+            route = scope.get('route')
+            route = getattr(route, 'path', UNMATCHED_ROUTE)
+            method = scope['method']
+            request_duration.observe(time.perf_counter() - started, method, route, status)
+            request_queries.observe(stats.queries, method, route)
+            request_db_duration.observe(stats.db_time, method, route)
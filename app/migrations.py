@@ -0,0 +1,252 @@
+"""Versioned, in-place schema migrations.
+
+``create_all`` only creates missing tables, so anything an existing
+database needs beyond that (new indexes, backfills, rewritten data) is
+a numbered migration here. Each runs once in its own transaction and is
+recorded in ``schema_migrations``; append new ones to ``MIGRATIONS``.
+"""
+import logging
+from datetime import datetime
+from sqlalchemy import (
+    Column, DateTime, Index, Integer, MetaData, String, Table, column, func, inspect, insert, select, table, text,
+    update
+)
+from sqlalchemy.orm import Session
+from .config import settings
+from .database import Base
+from .models import (
+    Account, DailyStat, Domain, DomainDailyStat, DomainStat, EmailMessage, SchemaMigration, Sender,
+    SenderDailyStat, SenderName, SenderStat, SyncState
+)
+from .services.search import FTS_TABLE
+from .services.sketches import SketchService
+from .services.stats import StatsService
+
+logger = logging.getLogger(__name__)
+
+
+# email_messages as it was before senders moved into dimension tables
+legacy_messages = table(
+    'email_messages',
+    column('account_id'), column('id'), column('sender_name'), column('sender_email'), column('sender_domain'),
+    column('received_date'), column('subject'),
+)
+
+
+def column_names(conn, table_name):
+    return {column['name'] for column in inspect(conn).get_columns(table_name)}
+
+
+def is_normalized(conn) -> bool:
+    """Whether email_messages refers to its senders by dimension ID yet."""
+    return 'sender_id' in column_names(conn, 'email_messages')
+
+
+def build_sender_domain_stats(conn):
+    """Fills the aggregate tables for databases synced before they existed."""
+    if not is_normalized(conn):
+        # Older tables are rebuilt, with their stats, by normalize_senders
+        return
+    with Session(bind=conn) as db:
+        StatsService(db).rebuild()
+        db.flush()
+
+
+def add_query_indexes(conn):
+    """Adds the composite indexes behind the listing, grouping and keyset queries."""
+    if not is_normalized(conn):
+        # Older tables are rebuilt with these indexes by normalize_senders
+        return
+    # Replaced by the (count desc, key) rank indexes
+    existing = {index['name'] for index in inspect(conn).get_indexes('sender_stats')}
+    if 'ix_sender_stats_count' in existing:
+        Index('ix_sender_stats_count', SenderStat.count).drop(conn)
+    existing = {index['name'] for index in inspect(conn).get_indexes('domain_stats')}
+    if 'ix_domain_stats_count' in existing:
+        Index('ix_domain_stats_count', DomainStat.count).drop(conn)
+
+    for indexed in (EmailMessage.__table__, SenderStat.__table__, DomainStat.__table__):
+        for index in indexed.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def lowercase_sender_addresses(conn):
+    """Lowercases stored addresses and domains to match parse_message."""
+    if is_normalized(conn):
+        # Dimension tables were only ever filled with parse_message's lowercased values
+        return
+    conn.execute(
+        update(legacy_messages)
+        .where(
+            (legacy_messages.c.sender_email != func.lower(legacy_messages.c.sender_email)) |
+            (legacy_messages.c.sender_domain != func.lower(legacy_messages.c.sender_domain))
+        )
+        .values(
+            sender_email=func.lower(legacy_messages.c.sender_email),
+            sender_domain=func.lower(legacy_messages.c.sender_domain)
+        )
+    )
+
+
+def add_accounts(conn):
+    """Keys messages and aggregates by account, assigning existing rows to a first account.
+
+    The first account keeps using TOKEN_FILE, and takes the address of the
+    single mailbox synced so far, if any.
+    """
+    if conn.scalar(select(func.count()).select_from(Account)) == 0:
+        synced = list(conn.scalars(select(SyncState.account)))
+        conn.execute(insert(Account).values(
+            id=1,
+            email=synced[0] if len(synced) == 1 else None,
+            token_file=settings.TOKEN_FILE,
+            created_at=datetime.utcnow()
+        ))
+
+    if 'account_id' not in column_names(conn, 'sync_jobs'):
+        conn.execute(text("ALTER TABLE sync_jobs ADD COLUMN account_id INTEGER"))
+
+    if 'account_id' in column_names(conn, 'email_messages'):
+        return
+
+    # Primary keys cannot be altered in place on SQLite, so copy into a new
+    # table, still with the sender columns normalize_senders later moves out
+    messages = Table(
+        'email_messages_new', MetaData(),
+        Column('account_id', Integer, primary_key=True),
+        Column('id', String, primary_key=True),
+        Column('sender_name', String),
+        Column('sender_email', String),
+        Column('sender_domain', String),
+        Column('received_date', DateTime),
+        Column('subject', String),
+    )
+    messages.create(conn)
+    copied = [column.name for column in messages.columns if column.name != 'account_id']
+    conn.execute(
+        messages.insert().from_select(
+            ['account_id'] + copied,
+            select(text('1'), *[text(name) for name in copied]).select_from(text('email_messages'))
+        )
+    )
+    # Dropping the table drops its search triggers; the search index is
+    # recreated and backfilled at startup
+    conn.execute(text("DROP TABLE email_messages"))
+    if conn.dialect.name == 'sqlite':
+        conn.execute(text(f"DROP TABLE IF EXISTS {FTS_TABLE}"))
+    conn.execute(text("ALTER TABLE email_messages_new RENAME TO email_messages"))
+
+
+def build_daily_stats(conn):
+    """Fills the daily rollup tables from the messages synced before they existed."""
+    if not is_normalized(conn):
+        # Built by normalize_senders
+        return
+    with Session(bind=conn) as db:
+        StatsService(db).rebuild_daily()
+        db.flush()
+
+
+def add_sync_resume_columns(conn):
+    """Adds the columns recording where an interrupted full listing resumes."""
+    existing = column_names(conn, 'sync_state')
+    for column in ('listing_page_token', 'listing_history_id'):
+        if column not in existing:
+            conn.execute(text(f"ALTER TABLE sync_state ADD COLUMN {column} VARCHAR"))
+
+
+def normalize_senders(conn):
+    """Moves sender addresses, domains and names into dimension tables, keying messages and stats by ID.
+
+    The message table is copied into its new layout, and the aggregate and
+    rollup tables keyed by address or domain are rebuilt.
+    """
+    if is_normalized(conn):
+        return
+
+    old = legacy_messages
+    conn.execute(insert(Domain).from_select(
+        ['name'],
+        select(old.c.sender_domain).where(old.c.sender_domain.is_not(None)).distinct()
+    ))
+    conn.execute(insert(Sender).from_select(
+        ['email', 'domain_id'],
+        select(old.c.sender_email, func.min(Domain.id))
+        .join(Domain, Domain.name == old.c.sender_domain)
+        .where(old.c.sender_email.is_not(None))
+        .group_by(old.c.sender_email)
+    ))
+    conn.execute(insert(SenderName).from_select(
+        ['name'],
+        select(old.c.sender_name).where(old.c.sender_name.is_not(None)).distinct()
+    ))
+
+    metadata = MetaData()
+    for model in (Account, Domain, Sender, SenderName):
+        model.__table__.to_metadata(metadata)
+    messages = EmailMessage.__table__.to_metadata(metadata, name='email_messages_new')
+    messages.indexes.clear()
+    messages.create(conn)
+    conn.execute(messages.insert().from_select(
+        ['account_id', 'id', 'sender_id', 'sender_name_id', 'domain_id', 'received_date', 'subject'],
+        select(old.c.account_id, old.c.id, Sender.id, SenderName.id, Domain.id, old.c.received_date, old.c.subject)
+        .select_from(old)
+        .outerjoin(Sender, Sender.email == old.c.sender_email)
+        .outerjoin(SenderName, SenderName.name == old.c.sender_name)
+        .outerjoin(Domain, Domain.name == old.c.sender_domain)
+    ))
+    # As in add_accounts, the search index is recreated and backfilled at startup
+    conn.execute(text("DROP TABLE email_messages"))
+    if conn.dialect.name == 'sqlite':
+        conn.execute(text(f"DROP TABLE IF EXISTS {FTS_TABLE}"))
+    conn.execute(text("ALTER TABLE email_messages_new RENAME TO email_messages"))
+    for index in EmailMessage.__table__.indexes:
+        index.create(conn)
+
+    for model in (SenderStat, DomainStat, SenderDailyStat, DomainDailyStat, DailyStat):
+        model.__table__.drop(conn, checkfirst=True)
+        model.__table__.create(conn)
+    with Session(bind=conn) as db:
+        StatsService(db).rebuild()
+        db.flush()
+
+
+def build_sketches(conn):
+    """Fills the sender and domain sketches from the messages synced before they existed."""
+    with Session(bind=conn) as db:
+        SketchService(db).rebuild()
+        db.flush()
+
+
+MIGRATIONS = [
+    (1, build_sender_domain_stats),
+    (2, add_query_indexes),
+    (3, lowercase_sender_addresses),
+    (4, add_accounts),
+    (5, build_daily_stats),
+    (6, add_sync_resume_columns),
+    (7, normalize_senders),
+    (8, build_sketches),
+]
+
+
+def migrate(engine):
+    """Creates missing tables, then applies pending migrations in order."""
+    Base.metadata.create_all(bind=engine)
+
+    with engine.connect() as conn:
+        applied = set(conn.scalars(select(SchemaMigration.version)))
+
+    for version, upgrade in MIGRATIONS:
+        if version in applied:
+            continue
+        logger.info("Applying migration %d: %s", version, upgrade.__name__)
+        with engine.begin() as conn:
+            upgrade(conn)
+            conn.execute(
+                SchemaMigration.__table__.insert().values(
+                    version=version,
+                    name=upgrade.__name__,
+                    applied_at=datetime.utcnow()
+                )
+            )
@@ -1,12 +1,173 @@
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Boolean, Column, Date, DateTime, Float, ForeignKey, Index, Integer, LargeBinary, String
 from .database import Base
 
+# account_id of the sender_stats and domain_stats rows totalled over every account
+ALL_ACCOUNTS = 0
+
+class Account(Base):
+    __tablename__ = 'accounts'
+
+    id = Column(Integer, primary_key=True)
+    # Filled in from the Gmail profile on the account's first sync
+    email = Column(String, unique=True)
+    token_file = Column(String, nullable=False)
+    created_at = Column(DateTime)
+
+# Dimension tables: each distinct sender address, domain and display name
+# is stored once, and messages and aggregates refer to it by integer ID.
+# Rows are only ever inserted, so an ID always means the same value.
+class Domain(Base):
+    __tablename__ = 'domains'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+
+class Sender(Base):
+    __tablename__ = 'senders'
+
+    id = Column(Integer, primary_key=True)
+    email = Column(String, nullable=False, unique=True)
+    domain_id = Column(Integer, ForeignKey('domains.id'), nullable=False)
+
+class SenderName(Base):
+    __tablename__ = 'sender_names'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+
 class EmailMessage(Base):
     __tablename__ = 'email_messages'
-    
-    id = Column(String, primary_key=True, unique=True)
-    sender_name = Column(String)
-    sender_email = Column(String)
-    sender_domain = Column(String)
+
+    # Gmail message IDs are only unique within a mailbox
+    account_id = Column(Integer, ForeignKey('accounts.id'), primary_key=True)
+    id = Column(String, primary_key=True)
+    sender_id = Column(Integer, ForeignKey('senders.id'))
+    # The sender's display name on this message, which can change between messages
+    sender_name_id = Column(Integer, ForeignKey('sender_names.id'))
+    # The sender's domain, repeated here so domains group without a join
+    domain_id = Column(Integer, ForeignKey('domains.id'))
     received_date = Column(DateTime)
     subject = Column(String)
+
+    __table_args__ = (
+        # Per-group grouping, previews and lazy expansion, newest first
+        Index('ix_email_messages_sender_date', 'sender_id', 'received_date', 'id'),
+        Index('ix_email_messages_domain_date', 'domain_id', 'received_date', 'id'),
+        # Date-sorted listing and its keyset cursor, across and within accounts
+        Index('ix_email_messages_date_id', 'received_date', 'id'),
+        Index('ix_email_messages_account_date', 'account_id', 'received_date', 'id'),
+    )
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+
+    account = Column(String, primary_key=True)
+    history_id = Column(String)
+    # Where an unfinished full listing resumes: the page after the last one
+    # stored in full, and the historyId read before the listing began
+    listing_page_token = Column(String)
+    listing_history_id = Column(String)
+    updated_at = Column(DateTime)
+
+class SyncJob(Base):
+    __tablename__ = 'sync_jobs'
+
+    id = Column(String, primary_key=True)
+    # None for a job syncing every account
+    account_id = Column(Integer)
+    status = Column(String, nullable=False, default='pending')
+    full = Column(Boolean, nullable=False, default=False)
+    mode = Column(String)
+    listed = Column(Integer, nullable=False, default=0)
+    fetched = Column(Integer, nullable=False, default=0)
+    inserted = Column(Integer, nullable=False, default=0)
+    skipped = Column(Integer, nullable=False, default=0)
+    deleted = Column(Integer, nullable=False, default=0)
+    errors = Column(Integer, nullable=False, default=0)
+    rate = Column(Float)
+    error = Column(String)
+    created_at = Column(DateTime)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+# Totals per account, plus ALL_ACCOUNTS rows summing every account, so
+# both views are read from the rank index without grouping at query time
+class SenderStat(Base):
+    __tablename__ = 'sender_stats'
+
+    account_id = Column(Integer, primary_key=True)
+    sender_id = Column(Integer, primary_key=True)
+    # Display name on the sender's latest message
+    sender_name_id = Column(Integer)
+    count = Column(Integer, nullable=False, default=0)
+    latest_date = Column(DateTime)
+
+    __table_args__ = (
+        # Matches the per-account (count desc, key) listing order and its keyset cursor
+        Index('ix_sender_stats_rank', 'account_id', count.desc(), 'sender_id'),
+    )
+
+class DomainStat(Base):
+    __tablename__ = 'domain_stats'
+
+    account_id = Column(Integer, primary_key=True)
+    domain_id = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+    latest_date = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_domain_stats_rank', 'account_id', count.desc(), 'domain_id'),
+    )
+
+# Message counts per day of received_date, with ALL_ACCOUNTS rows like the
+# totals above; a time series reads one key's days from the primary key
+class DailyStat(Base):
+    __tablename__ = 'daily_stats'
+
+    account_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class SenderDailyStat(Base):
+    __tablename__ = 'sender_daily_stats'
+
+    account_id = Column(Integer, primary_key=True)
+    sender_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class DomainDailyStat(Base):
+    __tablename__ = 'domain_daily_stats'
+
+    account_id = Column(Integer, primary_key=True)
+    domain_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+# Mergeable sketches of each account's senders and domains per year, per
+# month and per day, behind approximate date-ranged analytics; see
+# services.sketches
+class Sketch(Base):
+    __tablename__ = 'sketches'
+
+    account_id = Column(Integer, primary_key=True)
+    # 'year', 'month' or 'day'
+    bucket = Column(String, primary_key=True)
+    start = Column(Date, primary_key=True)
+    # HyperLogLogs of the sender and domain IDs, and Space-Saving summaries of them
+    sender_hll = Column(LargeBinary, nullable=False)
+    domain_hll = Column(LargeBinary, nullable=False)
+    top_senders = Column(LargeBinary, nullable=False)
+    top_domains = Column(LargeBinary, nullable=False)
+
+    __table_args__ = (
+        # Ranges over every account
+        Index('ix_sketches_bucket_start', 'bucket', 'start'),
+    )
+
+class SchemaMigration(Base):
+    __tablename__ = 'schema_migrations'
+
+    version = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    applied_at = Column(DateTime)
@@ -1,20 +1,58 @@
 from pydantic import BaseModel
-from datetime import datetime
-from typing import List, Optional
+from datetime import date, datetime
+from typing import List, Literal, Optional, Union
+
+# The /emails models document the response shape; handlers build the
+# equivalent dicts, which are encoded without being validated against them
 
 class EmailMessageBase(BaseModel):
-    sender_name: str
-    sender_email: str
-    sender_domain: str
+    sender_name: Optional[str]
+    sender_email: Optional[str]
+    sender_domain: Optional[str]
     subject: Optional[str]
-    received_date: datetime
+    received_date: Optional[datetime]
 
 class EmailMessage(EmailMessageBase):
+    account_id: int
     id: str
 
     class Config:
         from_attributes = True
 
+class RankedEmailMessage(EmailMessage):
+    sender_count: int
+    domain_count: int
+
+class SenderGroup(BaseModel):
+    type: Literal["sender"]
+    email: Optional[str]
+    name: Optional[str]
+    count: int
+    latest_date: Optional[datetime]
+    emails: List[EmailMessage]
+
+class DomainGroup(BaseModel):
+    type: Literal["domain"]
+    domain: Optional[str]
+    count: int
+    latest_date: Optional[datetime]
+    emails: List[EmailMessage]
+
+class EmailPage(BaseModel):
+    total: Optional[int]
+    # Relative standard error of a total estimated from sketches; None when exact
+    total_error: Optional[float] = None
+    page: int
+    page_size: int
+    next_cursor: Optional[str]
+    results: List[Union[SenderGroup, DomainGroup, RankedEmailMessage]]
+
+class GroupEmailPage(BaseModel):
+    total: int
+    page: int
+    page_size: int
+    results: List[EmailMessage]
+
 class SenderStats(BaseModel):
     email: str
     name: str
@@ -24,6 +62,26 @@ class DomainStats(BaseModel):
     domain: str
     count: int
 
+class ErrorBound(BaseModel):
+    # Relative standard error of the distinct counts
+    distinct: float
+    # Most any of the listed counts may exceed its true count by
+    count: int
+
 class Analytics(BaseModel):
+    total: int
+    distinct_senders: int
+    distinct_domains: int
     top_senders: List[SenderStats]
     top_domains: List[DomainStats]
+    # Bounds of the counts estimated from sketches; None when exact
+    error: Optional[ErrorBound] = None
+
+class TimeseriesPoint(BaseModel):
+    start: date
+    count: int
+
+class Timeseries(BaseModel):
+    bucket: str
+    total: int
+    points: List[TimeseriesPoint]
@@ -0,0 +1,46 @@
+"""JSON encoding of API responses.
+
+The dicts, lists, dates and datetimes handlers return are encoded
+natively by orjson, without first being copied by FastAPI's
+``jsonable_encoder`` and then encoded by ``json``. Where orjson is not
+installed, responses are encoded that way instead.
+"""
+import json
+from decimal import Decimal
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    """Encodes the values orjson does not handle itself."""
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if isinstance(value, Decimal):
+        # PostgreSQL sums arrive as Decimal
+        return int(value) if value == value.to_integral_value() else float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_json(value) -> bytes:
+    if orjson is not None:
+        # Per-account progress is keyed by the integer account ID
+        return orjson.dumps(value, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(jsonable_encoder(value)).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response encoded by ``encode_json``.
+
+    FastAPI still runs ``jsonable_encoder`` over a handler's return value
+    before rendering it; handlers on a hot path construct this response
+    themselves to skip that too.
+    """
+
+    def render(self, content) -> bytes:
+        return encode_json(content)
@@ -1,43 +1,259 @@
+from datetime import date, datetime, timedelta
+from typing import Optional
+from sqlalchemy import func, select
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from ..models import EmailMessage
-from ..schemas import Analytics, SenderStats, DomainStats
+from ..models import (
+    ALL_ACCOUNTS, DailyStat, DomainDailyStat, DomainStat, EmailMessage, SenderDailyStat, SenderStat
+)
+from ..schemas import Analytics, ErrorBound, SenderStats, DomainStats, Timeseries, TimeseriesPoint
+from .columnar import ColumnarSnapshot, RangeTotals, columnar_snapshot
+from .dimensions import dimensions_for
+from .sketches import DISTINCT_ERROR, SketchService, within
+
+TOP_LIMIT = 20
+
+def bucket_start(day: date, bucket: str) -> date:
+    """First day of the day, ISO week (Monday) or month bucket containing ``day``."""
+    if bucket == 'week':
+        return day - timedelta(days=day.weekday())
+    if bucket == 'month':
+        return day.replace(day=1)
+    return day
 
 class AnalyticsService:
-    def __init__(self, db: Session):
+    """Mailbox analytics from the aggregate and daily rollup tables.
+
+    Date-ranged totals, which the aggregates cannot answer, group the
+    messages themselves, or with ``ANALYTICS_ENGINE=columnar`` scan the
+    in-memory columnar snapshot instead. Requests that accept some error
+    merge the range's sketches instead.
+    """
+
+    def __init__(self, db: Session, snapshot: Optional[ColumnarSnapshot] = columnar_snapshot):
         self.db = db
+        self.snapshot = snapshot
 
-    def get_analytics(self) -> Analytics:
-        top_senders = (
-            self.db.query(
-                EmailMessage.sender_email,
-                EmailMessage.sender_name,
-                func.count(EmailMessage.id).label('count')
-            )
-            .group_by(EmailMessage.sender_email)
-            .order_by(func.count(EmailMessage.id).desc())
-            .limit(20)
-            .all()
+    def get_analytics(
+        self,
+        account_id: Optional[int] = None,
+        start: Optional[date] = None,
+        end: Optional[date] = None,
+        max_error: Optional[float] = None
+    ) -> Analytics:
+        """Totals and top senders and domains of one account, or of all accounts when ``account_id`` is None.
+
+        ``start`` and ``end`` restrict it to messages received in that
+        inclusive range. A range is estimated from sketches if they are
+        within ``max_error``, the relative error the caller accepts;
+        unbounded totals are always exact.
+        """
+        if start is None and end is None:
+            return self._get_all_time_analytics(account_id)
+        if within(max_error):
+            return self._get_sketch_analytics(account_id, start, end)
+        if self.snapshot is not None:
+            self.snapshot.ensure_current(self.db)
+            totals = self.snapshot.get_totals(account_id, start, end, TOP_LIMIT)
+        else:
+            totals = self._get_range_totals(account_id, start, end)
+        return self._to_analytics(ALL_ACCOUNTS if account_id is None else account_id, totals)
+
+    def _get_all_time_analytics(self, account_id: Optional[int]) -> Analytics:
+        stats_account_id = ALL_ACCOUNTS if account_id is None else account_id
+        top_senders = self.db.execute(
+            select(SenderStat.sender_id, SenderStat.count)
+            .where(SenderStat.account_id == stats_account_id)
+            .order_by(SenderStat.count.desc(), SenderStat.sender_id)
+            .limit(TOP_LIMIT)
+        ).all()
+        top_domains = self.db.execute(
+            select(DomainStat.domain_id, DomainStat.count)
+            .where(DomainStat.account_id == stats_account_id)
+            .order_by(DomainStat.count.desc(), DomainStat.domain_id)
+            .limit(TOP_LIMIT)
+        ).all()
+
+        distinct_senders = self.db.scalar(
+            select(func.count()).select_from(SenderStat).where(SenderStat.account_id == stats_account_id)
+        )
+        distinct_domains, total = self.db.execute(
+            select(func.count(), func.coalesce(func.sum(DomainStat.count), 0))
+            .where(DomainStat.account_id == stats_account_id)
+        ).one()
+
+        return self._to_analytics(stats_account_id, RangeTotals(
+            total=total,
+            distinct_senders=distinct_senders,
+            distinct_domains=distinct_domains,
+            top_senders=top_senders,
+            top_domains=top_domains
+        ))
+
+    def _get_range_totals(self, account_id: Optional[int], start: Optional[date], end: Optional[date]) -> RangeTotals:
+        criteria = []
+        if account_id is not None:
+            criteria.append(EmailMessage.account_id == account_id)
+        if start is not None:
+            criteria.append(EmailMessage.received_date >= datetime.combine(start, datetime.min.time()))
+        if end is not None:
+            criteria.append(EmailMessage.received_date < datetime.combine(end + timedelta(days=1), datetime.min.time()))
+
+        sender_counts = (
+            select(EmailMessage.sender_id, func.count().label('count'))
+            .where(*criteria)
+            .group_by(EmailMessage.sender_id)
+            .subquery()
+        )
+        domain_counts = (
+            select(EmailMessage.domain_id, func.count().label('count'))
+            .where(*criteria)
+            .group_by(EmailMessage.domain_id)
+            .subquery()
+        )
+
+        top_senders = self.db.execute(
+            select(sender_counts.c.sender_id, sender_counts.c['count'])
+            .where(sender_counts.c.sender_id.is_not(None))
+            .order_by(sender_counts.c['count'].desc(), sender_counts.c.sender_id)
+            .limit(TOP_LIMIT)
+        ).all()
+        top_domains = self.db.execute(
+            select(domain_counts.c.domain_id, domain_counts.c['count'])
+            .where(domain_counts.c.domain_id.is_not(None))
+            .order_by(domain_counts.c['count'].desc(), domain_counts.c.domain_id)
+            .limit(TOP_LIMIT)
+        ).all()
+
+        distinct_senders = self.db.scalar(
+            select(func.count()).select_from(sender_counts).where(sender_counts.c.sender_id.is_not(None))
         )
+        distinct_domains, total = self.db.execute(
+            select(func.count(domain_counts.c.domain_id), func.coalesce(func.sum(domain_counts.c['count']), 0))
+        ).one()
 
-        top_domains = (
-            self.db.query(
-                EmailMessage.sender_domain,
-                func.count(EmailMessage.id).label('count')
+        return RangeTotals(
+            total=total,
+            distinct_senders=distinct_senders,
+            distinct_domains=distinct_domains,
+            top_senders=top_senders,
+            top_domains=top_domains
+        )
+
+    def _get_sketch_analytics(self, account_id: Optional[int], start: Optional[date], end: Optional[date]) -> Analytics:
+        """Estimates the range's distinct counts and top senders and domains by merging its sketches.
+
+        The total is exact, summed from the daily rollups.
+        """
+        stats_account_id = ALL_ACCOUNTS if account_id is None else account_id
+        criteria = []
+        if start is not None:
+            criteria.append(DailyStat.day >= start)
+        if end is not None:
+            criteria.append(DailyStat.day <= end)
+        total = self.db.scalar(
+            select(func.coalesce(func.sum(DailyStat.count), 0))
+            .where(DailyStat.account_id == stats_account_id, *criteria)
+        )
+
+        sketch = SketchService(self.db).merged(account_id, start, end)
+        top_senders = sketch.top_senders.top(TOP_LIMIT)
+        top_domains = sketch.top_domains.top(TOP_LIMIT)
+        analytics = self._to_analytics(stats_account_id, RangeTotals(
+            total=total,
+            distinct_senders=round(sketch.senders.estimate()),
+            distinct_domains=round(sketch.domains.estimate()),
+            top_senders=top_senders,
+            top_domains=top_domains
+        ))
+        analytics.error = ErrorBound(
+            distinct=DISTINCT_ERROR,
+            count=max(
+                sketch.top_senders.error(sender_id for sender_id, _ in top_senders),
+                sketch.top_domains.error(domain_id for domain_id, _ in top_domains)
             )
-            .group_by(EmailMessage.sender_domain)
-            .order_by(func.count(EmailMessage.id).desc())
-            .limit(20)
-            .all()
         )
+        return analytics
+
+    def _to_analytics(self, stats_account_id: int, totals: RangeTotals) -> Analytics:
+        """Resolves the top sender and domain IDs to their addresses, names and domains.
+
+        Names come from the aggregates, so they are of each sender's latest
+        message, whatever range the counts cover.
+        """
+        sender_ids = [sender_id for sender_id, _ in totals.top_senders]
+        name_ids = dict(self.db.execute(
+            select(SenderStat.sender_id, SenderStat.sender_name_id)
+            .where(SenderStat.account_id == stats_account_id, SenderStat.sender_id.in_(sender_ids))
+        ).all()) if sender_ids else {}
+        dimensions = dimensions_for(self.db)
+        emails = dimensions.senders.lookup(self.db, sender_ids)
+        names = dimensions.names.lookup(self.db, name_ids.values())
+        domains = dimensions.domains.lookup(self.db, (domain_id for domain_id, _ in totals.top_domains))
 
         return Analytics(
+            total=totals.total,
+            distinct_senders=totals.distinct_senders,
+            distinct_domains=totals.distinct_domains,
             top_senders=[
-                SenderStats(email=s[0], name=s[1], count=s[2]) 
-                for s in top_senders
+                SenderStats(email=emails[sender_id], name=names.get(name_ids.get(sender_id)), count=count)
+                for sender_id, count in totals.top_senders
             ],
             top_domains=[
-                DomainStats(domain=d[0], count=d[1]) 
-                for d in top_domains
+                DomainStats(domain=domains[domain_id], count=count)
+                for domain_id, count in totals.top_domains
             ]
         )
+
+    def get_timeseries(
+        self,
+        bucket: str = 'day',
+        sender_email: Optional[str] = None,
+        sender_domain: Optional[str] = None,
+        start: Optional[date] = None,
+        end: Optional[date] = None,
+        account_id: Optional[int] = None
+    ) -> Timeseries:
+        """Message volume per bucket for a sender, a domain or the whole mailbox.
+
+        Reads the daily rollups, so the cost is bounded by the days in range
+        rather than the number of messages. Buckets without messages are
+        omitted, as are messages without a date.
+        """
+        stats_account_id = ALL_ACCOUNTS if account_id is None else account_id
+        dimensions = dimensions_for(self.db)
+        if sender_email is not None:
+            model, key_column = SenderDailyStat, SenderDailyStat.sender_id
+            key_id = dimensions.senders.find(self.db, sender_email)
+        elif sender_domain is not None:
+            model, key_column = DomainDailyStat, DomainDailyStat.domain_id
+            key_id = dimensions.domains.find(self.db, sender_domain)
+        else:
+            model, key_column, key_id = DailyStat, None, None
+
+        criteria = []
+        if key_column is not None:
+            if key_id is None:
+                # Never seen, so it has no messages
+                return Timeseries(bucket=bucket, total=0, points=[])
+            criteria.append(key_column == key_id)
+        if start is not None:
+            criteria.append(model.day >= start)
+        if end is not None:
+            criteria.append(model.day <= end)
+
+        days = self.db.execute(
+            select(model.day, model.count)
+            .where(model.account_id == stats_account_id, *criteria)
+            .order_by(model.day)
+        )
+
+        counts = {}
+        for day, count in days:
+            key = bucket_start(day, bucket)
+            counts[key] = counts.get(key, 0) + count
+
+        return Timeseries(
+            bucket=bucket,
+            total=sum(counts.values()),
+            points=[TimeseriesPoint(start=key, count=count) for key, count in counts.items()]
+        )
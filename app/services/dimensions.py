@@ -0,0 +1,176 @@
+"""In-process interning of sender addresses, domains and names to their dimension IDs.
+
+Messages store integer keys into the ``senders``, ``domains`` and
+``sender_names`` tables. ``Dimensions`` caches both directions of those
+mappings, per database: ingest turns a batch of parsed rows into keys
+with at most a lookup and an insert per dimension for values it has not
+seen yet, and the read paths turn keys back into strings mostly without
+touching the database. Dimension rows are never updated or deleted, so
+cached entries stay valid, except for IDs assigned by a transaction that
+is then rolled back, or left uncommitted when its session is closed,
+which are forgotten again.
+"""
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import event, insert, select
+from sqlalchemy.orm import Session
+from ..database import dialect_insert
+from ..models import Domain, Sender, SenderName
+
+CHUNK_SIZE = 500
+# Keys of a decoded message, in order
+DECODED_KEYS = ('account_id', 'id', 'sender_name', 'sender_email', 'sender_domain', 'subject', 'received_date')
+# Session.info key of the (dimension, value, id) entries cached by its open transaction
+PENDING_KEY = 'interned_dimensions'
+
+
+class Dimension:
+    """Thread-safe two-way cache of one dimension table's (id, value) rows."""
+
+    def __init__(self, model, column: str):
+        self.model = model
+        self.id_column = model.__table__.c.id
+        self.value_column = model.__table__.c[column]
+        self.ids = {}
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def intern(self, db: Session, values: Iterable[str], extra=None) -> Dict[str, int]:
+        """Returns the ID of each value, inserting rows for values not stored yet.
+
+        ``extra`` maps a new value to the other columns of its row.
+        """
+        values = set(values)
+        values.discard(None)
+        missing = [value for value in values if value not in self.ids]
+        if missing:
+            self._load(db, self.value_column, missing)
+            missing = [value for value in missing if value not in self.ids]
+        if missing:
+            rows = [{self.value_column.key: value, **(extra(value) if extra else {})} for value in missing]
+            conflict_insert = dialect_insert(db.get_bind())
+            if conflict_insert is not None:
+                # Another process may have stored some of them since the lookup
+                stmt = conflict_insert(self.model).on_conflict_do_nothing(index_elements=[self.value_column.key])
+            else:
+                stmt = insert(self.model)
+            db.execute(stmt, rows)
+            pending = db.info.setdefault(PENDING_KEY, [])
+            for value, id in self._load(db, self.value_column, missing):
+                pending.append((self, value, id))
+        return {value: self.ids[value] for value in values}
+
+    def lookup(self, db: Session, ids: Iterable[int]) -> Dict[int, str]:
+        """Returns the value of each ID; unknown IDs are left out."""
+        ids = set(ids)
+        ids.discard(None)
+        missing = [id for id in ids if id not in self.values]
+        if missing:
+            self._load(db, self.id_column, missing)
+        return {id: self.values[id] for id in ids if id in self.values}
+
+    def find(self, db: Session, value: str) -> Optional[int]:
+        """Returns the ID of a stored value, or None, without inserting it."""
+        if value not in self.ids:
+            self._load(db, self.value_column, [value])
+        return self.ids.get(value)
+
+    def forget(self, value: str, id: int):
+        with self._lock:
+            if self.ids.get(value) == id:
+                del self.ids[value]
+            if self.values.get(id) == value:
+                del self.values[id]
+
+    def _load(self, db: Session, column, keys: List) -> list:
+        """Caches the rows whose ``column`` is one of ``keys``, returning their (value, id) pairs."""
+        loaded = []
+        for start in range(0, len(keys), CHUNK_SIZE):
+            loaded += db.execute(
+                select(self.value_column, self.id_column).where(column.in_(keys[start:start + CHUNK_SIZE]))
+            ).all()
+        with self._lock:
+            for value, id in loaded:
+                self.ids[value] = id
+                self.values[id] = value
+        return loaded
+
+
+class Dimensions:
+    """The sender, domain and sender name dimensions of one database."""
+
+    def __init__(self):
+        self.senders = Dimension(Sender, 'email')
+        self.domains = Dimension(Domain, 'name')
+        self.names = Dimension(SenderName, 'name')
+
+    def encode(self, db: Session, rows: List[dict]) -> List[dict]:
+        """Turns parsed message rows into ``email_messages`` rows keyed by dimension IDs."""
+        domain_ids = self.domains.intern(db, (row['sender_domain'] for row in rows))
+        domain_of = {row['sender_email']: row['sender_domain'] for row in rows}
+        sender_ids = self.senders.intern(
+            db, domain_of, extra=lambda email: {'domain_id': domain_ids[domain_of[email]]}
+        )
+        name_ids = self.names.intern(db, (row['sender_name'] for row in rows))
+
+        encoded = []
+        for row in rows:
+            row = dict(row)
+            row['sender_id'] = sender_ids.get(row.pop('sender_email'))
+            row['domain_id'] = domain_ids.get(row.pop('sender_domain'))
+            row['sender_name_id'] = name_ids.get(row.pop('sender_name'))
+            encoded.append(row)
+        return encoded
+
+    def decode(self, db: Session, rows, extra: Tuple[str, ...] = ()) -> List[dict]:
+        """Turns message rows back into their API shape.
+
+        Each row is an (account_id, id, sender_name_id, sender_id,
+        domain_id, subject, received_date) tuple, followed by a value for
+        each key in ``extra``, like per-row group counts, which are passed
+        through after the message's own fields.
+        """
+        rows = rows if isinstance(rows, list) else list(rows)
+        names = self.names.lookup(db, (row[2] for row in rows))
+        emails = self.senders.lookup(db, (row[3] for row in rows))
+        domains = self.domains.lookup(db, (row[4] for row in rows))
+
+        keys = DECODED_KEYS + extra
+        return [
+            dict(zip(keys, (
+                account_id, id, names.get(name_id), emails.get(sender_id), domains.get(domain_id),
+                subject, received_date, *values
+            )))
+            for account_id, id, name_id, sender_id, domain_id, subject, received_date, *values in rows
+        ]
+
+
+_dimensions = {}
+_dimensions_lock = threading.Lock()
+
+
+def dimensions_for(db: Session) -> Dimensions:
+    """The dimension caches of the database ``db`` is bound to, shared across its engines."""
+    url = db.get_bind().engine.url
+    # The async engine reaches the same database through another driver
+    key = url.set(drivername=url.get_backend_name()).render_as_string(hide_password=False)
+    with _dimensions_lock:
+        dimensions = _dimensions.get(key)
+        if dimensions is None:
+            dimensions = _dimensions[key] = Dimensions()
+    return dimensions
+
+
+@event.listens_for(Session, 'after_commit')
+def _confirm_interned(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _forget_interned(session, transaction):
+    # Entries still pending when the outermost transaction ends were not
+    # committed: it was rolled back, or the session closed with it open.
+    # A later insert may reuse the IDs their rows were given
+    if transaction.parent is None:
+        for dimension, value, id in session.info.pop(PENDING_KEY, ()):
+            dimension.forget(value, id)
@@ -1,66 +1,394 @@
-from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.http import build_http
+from googleapiclient.model import JsonModel
+import json
 import pickle
 import os
-from datetime import datetime
+import re
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from typing import List, Optional, Tuple
 import email.utils
+from email.errors import HeaderParseError
+from email.header import decode_header, make_header
+import httplib2
+import uritemplate
 from ..config import settings
-from ..models import EmailMessage
 
-class GmailService:
+logger = logging.getLogger(__name__)
+
+API_NAME = 'gmail'
+API_VERSION = 'v1'
+DEFAULT_DISCOVERY_URL = 'https://gmail.googleapis.com/$discovery/rest?version=v1'
+
+
+def load_credentials(token_file: str, scopes=None, credentials_file: Optional[str] = None):
+    """Reads the credentials stored in ``token_file``, refreshing or obtaining them as needed.
+
+    Without a usable token, and given a ``credentials_file``, runs the
+    browser consent flow. Credentials that changed are written back.
+    """
+    creds = None
+    if os.path.exists(token_file):
+        with open(token_file, 'rb') as token:
+            creds = pickle.load(token)
+
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+        elif credentials_file is not None:
+            flow = InstalledAppFlow.from_client_secrets_file(credentials_file, scopes)
+            creds = flow.run_local_server(port=0)
+        else:
+            raise ValueError(f"No usable credentials in {token_file}")
+        save_credentials(token_file, creds)
+
+    return creds
+
+
+def save_credentials(token_file: str, creds):
+    # Written aside and renamed, so a concurrent reader never sees half a token
+    partial = f"{token_file}.{os.getpid()}.tmp"
+    with open(partial, 'wb') as token:
+        pickle.dump(creds, token)
+    os.replace(partial, token_file)
+
+
+class TransferCounter:
+    """Thread-safe tally of the response bodies received from Gmail.
+
+    Bodies are counted as decoded: the JSON that is parsed, after any gzip
+    transfer encoding is undone.
+    """
+
     def __init__(self):
+        self.bytes = 0
+        self.responses = 0
+        self._lock = threading.Lock()
+
+    def add(self, size: int):
+        with self._lock:
+            self.bytes += size
+            self.responses += 1
+
+
+class CountingJsonModel(JsonModel):
+    """JSON model that adds every response body to a ``TransferCounter``, batch parts included."""
+
+    def __init__(self, counter: TransferCounter):
+        super().__init__(data_wrapper=False)
+        self.counter = counter
+
+    def response(self, resp, content):
+        self.counter.add(len(content or b''))
+        return super().response(resp, content)
+
+
+class GmailClients:
+    """Process-wide source of Gmail API clients.
+
+    ``build('gmail', 'v1')`` fetches or re-reads the discovery document,
+    and the old per-sync setup unpickled the token as well. Here the
+    discovery document is parsed once per process, from a copy kept at
+    ``GMAIL_DISCOVERY_CACHE``. That copy is refetched once it is older than
+    ``GMAIL_DISCOVERY_CACHE_TTL``, and a stale copy is used when the fetch
+    fails, so clients are built offline. Credentials are loaded once per
+    token file and refreshed ``GMAIL_TOKEN_REFRESH_MARGIN`` seconds before
+    they expire, by one thread, rather than by whichever request first
+    finds them expired.
+
+    ``httplib2.Http`` is not thread-safe, so each thread gets its own
+    client per token file. The client wraps a keep-alive transport that
+    lives as long as the thread, and later batches reuse its open
+    connection to Gmail. Response bodies are tallied per token file in a
+    ``TransferCounter``.
+    """
+
+    def __init__(
+        self,
+        discovery_url: Optional[str] = settings.GMAIL_DISCOVERY_URL,
+        discovery_cache: Optional[str] = settings.GMAIL_DISCOVERY_CACHE,
+        discovery_cache_ttl: float = settings.GMAIL_DISCOVERY_CACHE_TTL,
+        refresh_margin: float = settings.GMAIL_TOKEN_REFRESH_MARGIN,
+    ):
+        self.discovery_url = discovery_url
+        self.discovery_cache = discovery_cache
+        self.discovery_cache_ttl = discovery_cache_ttl
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self._document = None
+        self._credentials = {}
+        self._transfers = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def client(self, token_file: str, credentials_file: Optional[str] = None):
+        """The calling thread's client for the account whose token is ``token_file``.
+
+        Cheap enough to call before every request: it only builds a client
+        on a thread's first call, and only refreshes credentials near expiry.
+        """
+        creds = self.credentials(token_file, credentials_file)
+        clients = getattr(self._local, 'clients', None)
+        if clients is None:
+            clients = self._local.clients = {}
+        built_for, client = clients.get(token_file, (None, None))
+        if built_for is not creds:
+            client = build_from_document(
+                self.discovery_document(),
+                http=AuthorizedHttp(creds, http=build_http()),
+                model=CountingJsonModel(self.transfer(token_file)),
+            )
+            clients[token_file] = (creds, client)
+        return client
+
+    def transfer(self, token_file: str) -> TransferCounter:
+        """The running tally of responses received by the clients of ``token_file``."""
+        with self._lock:
+            counter = self._transfers.get(token_file)
+            if counter is None:
+                counter = self._transfers[token_file] = TransferCounter()
+        return counter
+
+    def credentials(self, token_file: str, credentials_file: Optional[str] = None):
+        """The in-memory credentials of ``token_file``, refreshed if they expire within the margin."""
+        creds = self._credentials.get(token_file)
+        if creds is not None and not self._expiring(creds):
+            return creds
+        with self._lock:
+            creds = self._credentials.get(token_file)
+            if creds is None:
+                creds = self._credentials[token_file] = load_credentials(
+                    token_file, settings.GMAIL_SCOPES, credentials_file
+                )
+            if self._expiring(creds) and creds.refresh_token:
+                logger.info("Refreshing credentials of %s", token_file)
+                creds.refresh(Request())
+                save_credentials(token_file, creds)
+        return creds
+
+    def forget(self, token_file: str):
+        """Drops the cached credentials of ``token_file``, e.g. after it was replaced on disk."""
+        with self._lock:
+            self._credentials.pop(token_file, None)
+
+    def discovery_document(self) -> dict:
+        document = self._document
+        if document is None:
+            with self._lock:
+                if self._document is None:
+                    self._document = self._load_discovery_document()
+                document = self._document
+        return document
+
+    def _expiring(self, creds) -> bool:
+        # google-auth keeps expiry as a naive UTC datetime
+        return creds.expiry is not None and creds.expiry - self.refresh_margin <= datetime.utcnow()
+
+    def _load_discovery_document(self) -> dict:
+        url = self.discovery_url or DEFAULT_DISCOVERY_URL
+        cached = self._read_cached_document(url)
+        if cached is not None:
+            document, age = cached
+            if age < self.discovery_cache_ttl:
+                return document
+        try:
+            document = self._fetch_discovery_document(url)
+        except (OSError, ValueError, httplib2.HttpLib2Error) as e:
+            if cached is None:
+                raise
+            logger.warning("Could not refresh the Gmail discovery document, using the cached copy: %s", e)
+            return cached[0]
+        self._write_cached_document(url, document)
+        return document
+
+    def _fetch_discovery_document(self, url: str) -> dict:
+        if self.discovery_url is None:
+            # Recent client libraries ship the document
+            static = get_static_doc(API_NAME, API_VERSION)
+            if static is not None:
+                return json.loads(static)
+        expanded = uritemplate.expand(url, {'api': API_NAME, 'apiVersion': API_VERSION})
+        response, content = build_http().request(expanded)
+        if response.status >= 400:
+            raise ValueError(f"Fetching {expanded} failed with HTTP {response.status}")
+        return json.loads(content)
+
+    def _read_cached_document(self, url: str):
+        """The cached document for ``url`` and its age in seconds, or None."""
+        if not self.discovery_cache:
+            return None
+        try:
+            with open(self.discovery_cache) as cache:
+                cached = json.load(cache)
+            age = time.time() - os.path.getmtime(self.discovery_cache)
+        except (OSError, ValueError):
+            return None
+        if cached.get('url') != url:
+            return None
+        return cached['document'], age
+
+    def _write_cached_document(self, url: str, document: dict):
+        if not self.discovery_cache:
+            return
+        partial = f"{self.discovery_cache}.{os.getpid()}.tmp"
+        try:
+            with open(partial, 'w') as cache:
+                json.dump({'url': url, 'document': document}, cache)
+            os.replace(partial, self.discovery_cache)
+        except OSError as e:
+            logger.warning("Could not cache the Gmail discovery document: %s", e)
+
+
+gmail_clients = GmailClients()
+
+
+class GmailService:
+    def __init__(self, token_file: Optional[str] = None, clients: GmailClients = gmail_clients):
         self.scopes = settings.GMAIL_SCOPES
         self.credentials_file = settings.CREDENTIALS_FILE
-        self.token_file = settings.TOKEN_FILE
+        self.token_file = token_file or settings.TOKEN_FILE
+        self.clients = clients
+
+    def get_credentials(self):
+        return self.clients.credentials(self.token_file, self.credentials_file)
 
     def get_service(self):
-        creds = None
-        if os.path.exists(self.token_file):
-            with open(self.token_file, 'rb') as token:
-                creds = pickle.load(token)
+        """The calling thread's client for this account."""
+        return self.clients.client(self.token_file, self.credentials_file)
 
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    self.credentials_file, self.scopes)
-                creds = flow.run_local_server(port=0)
-            with open(self.token_file, 'wb') as token:
-                pickle.dump(creds, token)
+    def transfer(self) -> TransferCounter:
+        return self.clients.transfer(self.token_file)
+
+    def service_factory(self):
+        """Returns a callable giving the calling thread its client for this account.
 
-        return build('gmail', 'v1', credentials=creds)
+        Credentials are loaded, or obtained through the consent flow, up front.
+        """
+        self.get_credentials()
+        return self.get_service
 
     def parse_message(self, msg_data):
-        headers = msg_data['payload']['headers']
-        from_header = next((h for h in headers if h['name'] == 'From'), None)
-        subject_header = next((h for h in headers if h['name'] == 'Subject'), None)
-        date_header = next((h for h in headers if h['name'] == 'Date'), None)
-
-        if from_header:
-            sender = from_header['value']
-            sender_name = sender.split('<')[0].strip().strip('"')
-            sender_email = sender.split('<')[-1].strip('>')
-            sender_domain = sender_email.split('@')[-1]
-
-            # Parse the date using email.utils.parsedate_to_datetime
-            received_date = None
-            if date_header:
-                try:
-                    # This handles various email date formats including UTC
-                    received_date = email.utils.parsedate_to_datetime(date_header['value'])
-                except Exception as e:
-                    print(f"Error parsing date: {date_header['value']} - {str(e)}")
-                    received_date = None
-
-            return EmailMessage(
-                id=msg_data['id'],
-                sender_name=sender_name,
-                sender_email=sender_email,
-                sender_domain=sender_domain,
-                subject=subject_header['value'] if subject_header else None,
-                received_date=received_date
-            )
+        """Returns the email_messages row for a Gmail message resource."""
+        return parse_message(msg_data)
+
+    def parse_messages(self, messages):
+        """Parses a batch of message resources; see ``parse_messages``."""
+        return parse_messages(messages)
+
+
+# Dominant RFC 5322 date shape, e.g. "Mon, 2 Oct 2023 10:00:00 +0000 (UTC)"
+DATE_PATTERN = re.compile(
+    r'(?:\w{3},\s*)?(\d{1,2})\s+(\w{3})\s+(\d{4})\s+(\d{1,2}):(\d{2})(?::(\d{2}))?\s+([+-]\d{4})'
+)
+MONTHS = {
+    name: number
+    for number, name in enumerate(
+        ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'), 1
+    )
+}
+
+
+@lru_cache(maxsize=None)
+def _offset_timezone(offset: str):
+    if offset == '-0000':
+        # RFC 5322: "-0000" means the local time zone is unknown
+        return None
+    minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+    return timezone(timedelta(minutes=-minutes if offset[0] == '-' else minutes))
+
+
+def parse_date(value: str) -> Optional[datetime]:
+    """Parses a Date header, taking a regex fast path before the general parser."""
+    match = DATE_PATTERN.match(value.strip())
+    if match:
+        day, month, year, hour, minute, second, offset = match.groups()
+        month = MONTHS.get(month.lower())
+        if month:
+            try:
+                return datetime(
+                    int(year), month, int(day), int(hour), int(minute), int(second or 0),
+                    tzinfo=_offset_timezone(offset)
+                )
+            except ValueError:
+                pass
+    try:
+        return email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError) as e:
+        logger.debug("Unparseable date %r: %s", value, e)
+        return None
+
+
+@lru_cache(maxsize=65536)
+def parse_sender(value: str) -> Tuple[str, str, str]:
+    """Splits a From header into (name, email, domain), lowercasing the address.
+
+    Handles quoted names, comments and bare addresses per RFC 5322, and
+    decodes RFC 2047 encoded names. Cached since senders repeat heavily.
+    """
+    name, address = email.utils.parseaddr(value)
+    if not address:
+        address = value.strip()
+    if '=?' in name:
+        try:
+            name = str(make_header(decode_header(name)))
+        except (HeaderParseError, LookupError, UnicodeDecodeError):
+            pass
+    address = address.lower()
+    return name or address, address, address.rpartition('@')[2]
+
+
+def parse_message(msg_data) -> Optional[dict]:
+    """Returns the email_messages row for a Gmail message resource, or None without a From."""
+    sender = subject = date = None
+    for header in msg_data['payload']['headers']:
+        # Gmail preserves the sender's header name casing
+        name = header['name'].lower()
+        if name == 'from':
+            if sender is None:
+                sender = header['value']
+        elif name == 'subject':
+            if subject is None:
+                subject = header['value']
+        elif name == 'date':
+            if date is None:
+                date = header['value']
+
+    if sender is None:
         return None
+
+    sender_name, sender_email, sender_domain = parse_sender(sender)
+    return {
+        'id': msg_data['id'],
+        'sender_name': sender_name,
+        'sender_email': sender_email,
+        'sender_domain': sender_domain,
+        'subject': subject,
+        'received_date': parse_date(date) if date else None,
+    }
+
+
+def parse_messages(messages) -> Tuple[List[dict], List[str]]:
+    """Parses a batch of message resources into rows.
+
+    Returns the rows and the IDs of messages that failed to parse; messages
+    without a From header are skipped silently.
+    """
+    rows = []
+    failed = []
+    for msg_data in messages:
+        try:
+            row = parse_message(msg_data)
+        except (KeyError, TypeError, AttributeError) as e:
+            logger.warning("Error processing message %s: %s", msg_data.get('id'), e)
+            failed.append(msg_data.get('id'))
+            continue
+        if row is not None:
+            rows.append(row)
+    return rows, failed
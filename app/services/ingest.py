@@ -0,0 +1,87 @@
+from typing import Iterable, List
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+from ..database import dialect_insert
+from ..models import EmailMessage
+from .dimensions import dimensions_for
+from .sketches import SketchService
+from .stats import StatsService
+
+class IngestService:
+    """Set-based writes of one account's parsed messages into ``email_messages``.
+
+    Sender addresses, domains and names are interned to their dimension
+    IDs on the way in.
+    """
+
+    def __init__(self, db: Session, account_id: int):
+        self.db = db
+        self.account_id = account_id
+        self.stats = StatsService(db)
+        self.sketches = SketchService(db)
+        self.dimensions = dimensions_for(db)
+
+    def new_ids(self, message_ids: Iterable[str]) -> List[str]:
+        """Returns the IDs not yet stored, in their original order, using one query."""
+        message_ids = list(message_ids)
+        if not message_ids:
+            return []
+        existing = set(self.db.scalars(
+            select(EmailMessage.id)
+            .where(EmailMessage.account_id == self.account_id, EmailMessage.id.in_(message_ids))
+        ))
+        return [message_id for message_id in message_ids if message_id not in existing]
+
+    def insert_messages(self, rows: List[dict]) -> int:
+        """Bulk inserts parsed message rows, ignoring IDs that already exist.
+
+        Rows that were actually inserted are counted into the sender and
+        domain aggregates and sketches.
+        """
+        if not rows:
+            return 0
+        rows = self.dimensions.encode(self.db, rows)
+        for row in rows:
+            row['account_id'] = self.account_id
+
+        conflict_insert = dialect_insert(self.db.get_bind())
+        if conflict_insert is not None:
+            stmt = (
+                conflict_insert(EmailMessage.__table__)
+                .on_conflict_do_nothing(index_elements=['account_id', 'id'])
+                .returning(EmailMessage.id)
+            )
+            inserted_ids = set(self.db.scalars(stmt, rows))
+            rows = [row for row in rows if row['id'] in inserted_ids]
+        else:
+            # Without ON CONFLICT support, rely on new_ids() having filtered the rows
+            self.db.execute(insert(EmailMessage.__table__), rows)
+
+        self.stats.add(rows)
+        self.sketches.add(rows)
+        return len(rows)
+
+    def delete_messages(self, message_ids: Iterable[str]) -> int:
+        """Deletes the given message IDs, returning how many rows were removed."""
+        message_ids = list(message_ids)
+        deleted = 0
+        sender_ids = set()
+        domain_ids = set()
+        days = set()
+        for start in range(0, len(message_ids), 500):
+            chunk = message_ids[start:start + 500]
+            keys = self.db.execute(
+                select(EmailMessage.sender_id, EmailMessage.domain_id, EmailMessage.received_date)
+                .where(EmailMessage.account_id == self.account_id, EmailMessage.id.in_(chunk))
+            ).all()
+            sender_ids.update(key.sender_id for key in keys)
+            domain_ids.update(key.domain_id for key in keys)
+            days.update(key.received_date.date() for key in keys if key.received_date)
+            deleted += self.db.execute(
+                delete(EmailMessage)
+                .where(EmailMessage.account_id == self.account_id, EmailMessage.id.in_(chunk))
+            ).rowcount
+
+        self.stats.refresh(self.account_id, sender_ids, domain_ids, days)
+        self.sketches.refresh(self.account_id, days)
+        return deleted
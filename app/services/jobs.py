@@ -0,0 +1,232 @@
+import logging
+import multiprocessing
+import queue
+import threading
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import select
+from ..cache import response_cache
+from ..config import settings
+from ..database import SessionLocal, WriterSessionLocal
+from ..models import Account, SyncJob
+from .columnar import columnar_snapshot
+from .sync import SyncService
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ('pending', 'running')
+FINISHED_STATUSES = ('succeeded', 'failed')
+# Per-account SyncStats fields summed into the job's counters
+COUNTERS = ('listed', 'fetched', 'inserted', 'skipped', 'deleted', 'errors', 'rate')
+EVENT_POLL_INTERVAL = 0.2
+
+
+def job_to_dict(job: SyncJob) -> dict:
+    return {
+        "job_id": job.id,
+        "account_id": job.account_id,
+        "status": job.status,
+        "full": job.full,
+        "mode": job.mode,
+        "listed": job.listed,
+        "fetched": job.fetched,
+        "inserted": job.inserted,
+        "skipped": job.skipped,
+        "deleted": job.deleted,
+        "errors": job.errors,
+        "rate": job.rate or 0.0,
+        "error": job.error,
+        "created_at": job.created_at,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+    }
+
+
+def sync_account(account_id: int, full: bool, events) -> dict:
+    """Syncs one account on a pool worker, reporting to ``events`` as it goes.
+
+    Puts ``(account_id, 'committed', None)`` after each commit that changed
+    data, so the server process can invalidate its cache, and
+    ``(account_id, 'progress', stats)`` after every commit. Returns the
+    final stats.
+    """
+    with WriterSessionLocal() as db:
+        stats = SyncService(
+            db,
+            account_id,
+            on_progress=lambda stats: events.put((account_id, 'progress', stats.as_dict())),
+            on_commit=lambda: events.put((account_id, 'committed', None)),
+        ).run(full=full)
+        return stats.as_dict()
+
+
+class SyncJobRunner:
+    """Runs syncs on a background thread, one job at a time.
+
+    A job syncs one account or all of them. Accounts are synced in parallel,
+    each in its own worker process with its own Gmail client and fetch
+    pool, so an account's API quota is only ever spent by one sync. With
+    ``processes=0`` they run one after another on the job thread instead.
+
+    Each job is a ``sync_jobs`` row whose counters, summed over its
+    accounts, are written as workers report progress. Progress of jobs
+    started by this process is also mirrored in memory, per account too, so
+    polling it never touches the database.
+    """
+
+    def __init__(self, session_factory=SessionLocal, processes: int = settings.SYNC_PROCESSES):
+        self.session_factory = session_factory
+        self.processes = processes
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sync-job')
+        self._lock = threading.Lock()
+        self._progress = {}
+
+    def submit(self, full: bool = False, account_id: Optional[int] = None) -> dict:
+        """Queues a sync job, or returns the active one if a sync is already underway.
+
+        Raises ``ValueError`` for an unknown account.
+        """
+        with self._lock, self.session_factory() as db:
+            if account_id is not None and db.get(Account, account_id) is None:
+                raise ValueError(f"Unknown account {account_id}")
+
+            active = db.scalars(
+                select(SyncJob).where(SyncJob.status.in_(ACTIVE_STATUSES))
+            ).first()
+            if active:
+                return job_to_dict(active)
+
+            job = SyncJob(
+                id=uuid.uuid4().hex,
+                account_id=account_id,
+                status='pending',
+                full=full,
+                created_at=datetime.utcnow()
+            )
+            db.add(job)
+            db.commit()
+            self._progress[job.id] = job_to_dict(job)
+
+        self._executor.submit(self._run, job.id, full, account_id)
+        return self._progress[job.id]
+
+    def status(self, job_id: str) -> Optional[dict]:
+        progress = self._progress.get(job_id)
+        if progress is not None:
+            return dict(progress)
+        with self.session_factory() as db:
+            job = db.get(SyncJob, job_id)
+            return job_to_dict(job) if job else None
+
+    def fail_interrupted(self):
+        """Marks jobs left active by a previous process as failed."""
+        with self.session_factory() as db:
+            for job in db.scalars(select(SyncJob).where(SyncJob.status.in_(ACTIVE_STATUSES))):
+                job.status = 'failed'
+                job.error = 'Interrupted by server restart'
+                job.finished_at = datetime.utcnow()
+            db.commit()
+
+    def _run(self, job_id: str, full: bool, account_id: Optional[int]):
+        # Workers commit from other connections while the job's counters are
+        # written, so its transactions must write without reading first: a
+        # write after a stale read fails instead of waiting for the lock
+        with self.session_factory(expire_on_commit=False) as db:
+            job = db.get(SyncJob, job_id)
+            if account_id is None:
+                account_ids = list(db.scalars(select(Account.id).order_by(Account.id)))
+            else:
+                account_ids = [account_id]
+            accounts = {}
+
+            def on_progress(sync_account_id, stats):
+                accounts[sync_account_id] = stats
+                for counter in COUNTERS:
+                    setattr(job, counter, sum(account[counter] for account in accounts.values()))
+                modes = {account['mode'] for account in accounts.values()}
+                job.mode = modes.pop() if len(modes) == 1 else 'mixed'
+                self._progress[job_id] = dict(job_to_dict(job), accounts=dict(accounts))
+
+            job.status = 'running'
+            job.started_at = datetime.utcnow()
+            db.commit()
+            self._progress[job_id] = job_to_dict(job)
+
+            try:
+                errors = self._sync_accounts(db, account_ids, full, on_progress)
+                job.status = 'failed' if errors else 'succeeded'
+                job.error = '; '.join(errors) or None
+            except Exception as e:
+                logger.exception("Sync job %s failed", job_id)
+                db.rollback()
+                job.status = 'failed'
+                job.error = str(e)
+
+            if job.deleted and columnar_snapshot is not None:
+                # The snapshot only picks up appended rows by itself
+                columnar_snapshot.invalidate()
+            job.finished_at = datetime.utcnow()
+            db.commit()
+            self._progress[job_id] = dict(job_to_dict(job), accounts=dict(accounts))
+
+    def _sync_accounts(self, db, account_ids, full: bool, on_progress) -> list:
+        """Syncs the accounts on the worker pool, returning an error message per failed account."""
+        if not account_ids:
+            return []
+
+        if self.processes > 0:
+            # Spawned rather than forked: this process already runs threads
+            # and holds pooled database connections that a fork would copy
+            context = multiprocessing.get_context('spawn')
+            manager = context.Manager()
+            events = manager.Queue()
+            pool = ProcessPoolExecutor(max_workers=min(len(account_ids), self.processes), mp_context=context)
+        else:
+            # Threads share this process's single writer connection, so take turns
+            manager = None
+            events = queue.Queue()
+            pool = ThreadPoolExecutor(max_workers=1)
+
+        errors = []
+        try:
+            with pool:
+                pending = {
+                    pool.submit(sync_account, account_id, full, events): account_id
+                    for account_id in account_ids
+                }
+                while pending:
+                    done, _ = wait(pending, timeout=EVENT_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                    changed = self._apply_events(events, on_progress)
+                    for future in done:
+                        account_id = pending.pop(future)
+                        try:
+                            on_progress(account_id, future.result())
+                        except Exception as e:
+                            logger.error("Sync of account %d failed: %s", account_id, e)
+                            errors.append(f"Account {account_id}: {e}")
+                    if changed or done:
+                        db.commit()
+        finally:
+            if manager is not None:
+                manager.shutdown()
+        return errors
+
+    def _apply_events(self, events, on_progress) -> bool:
+        """Applies the events workers have queued, returning whether any reported progress."""
+        changed = False
+        while True:
+            try:
+                account_id, kind, stats = events.get_nowait()
+            except queue.Empty:
+                return changed
+            if kind == 'committed':
+                # Workers commit from their own processes, so invalidate this one's cache
+                response_cache.bump_version()
+            else:
+                on_progress(account_id, stats)
+                changed = True
+
+
+sync_jobs = SyncJobRunner()
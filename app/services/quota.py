@@ -0,0 +1,117 @@
+"""Client-side pacing of Gmail API calls to the per-user quota.
+
+Gmail charges every call quota units (``QUOTA_UNITS``) against a limit of
+250 units per user per second, and answers calls over it with 429
+``rateLimitExceeded``. Each account's sync spends its units through one
+``QuotaLimiter``, so its fetch threads stay under the limit together
+instead of discovering it through rejected batches.
+"""
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+# Units per call, from Gmail's usage limits
+QUOTA_UNITS = {
+    'getProfile': 1,
+    'messages.list': 5,
+    'messages.get': 5,
+    'history.list': 2,
+}
+# Backoff delays are drawn from [0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 32.0
+# The rate never drops below this fraction of the configured one after throttling
+MIN_RATE_FRACTION = 0.1
+# Fraction of the configured rate won back by each call that was not throttled
+RECOVERY_FRACTION = 0.05
+
+
+def backoff_delay(attempt: int, error=None) -> float:
+    """Seconds to wait before retry ``attempt`` (from 0) of a throttled or failed call.
+
+    Honours a ``Retry-After`` header on ``error``; otherwise exponential
+    backoff with full jitter, so threads throttled together spread out
+    rather than retrying in lockstep.
+    """
+    retry_after = retry_after_seconds(error)
+    if retry_after is not None:
+        return min(retry_after, BACKOFF_MAX)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def retry_after_seconds(error) -> Optional[float]:
+    headers = getattr(error, 'resp', None)
+    value = headers.get('retry-after') if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class QuotaLimiter:
+    """Thread-safe token bucket of quota units, refilled at ``units_per_second``.
+
+    The bucket holds at most one second of units. A call costing more than
+    that, like a batch of 100 gets, waits for a full bucket and borrows the
+    rest, which the calls after it wait off. The rate adapts to 429s, since
+    other clients of the same mailbox spend the same quota: ``throttled()``
+    halves it and every ``succeeded()`` call wins a little back (AIMD).
+    A rate of 0 or less disables the limiter.
+    """
+
+    def __init__(self, units_per_second: float):
+        self.max_rate = units_per_second
+        self.rate = units_per_second
+        self.waited = 0.0
+        self._tokens = max(units_per_second, 0.0)
+        self._refilled_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_rate > 0
+
+    def acquire(self, units: float):
+        """Blocks until ``units`` can be spent without exceeding the rate, then spends them."""
+        if not self.enabled:
+            return
+        while True:
+            with self._lock:
+                self._refill()
+                needed = min(units, self.rate)
+                if self._tokens >= needed:
+                    self._tokens -= units
+                    return
+                delay = (needed - self._tokens) / self.rate
+                self.waited += delay
+            time.sleep(delay)
+
+    def throttled(self):
+        """Backs off after Gmail rejected a call for exceeding the quota."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._refill()
+            self.rate = max(self.rate / 2, self.max_rate * MIN_RATE_FRACTION)
+            # Whatever the bucket held was evidently not available upstream
+            self._tokens = min(self._tokens, 0.0)
+
+    def succeeded(self):
+        if not self.enabled or self.rate >= self.max_rate:
+            return
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY_FRACTION)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
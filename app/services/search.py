@@ -0,0 +1,116 @@
+import logging
+import re
+from typing import Optional
+from sqlalchemy import column, select, table, text
+from sqlalchemy.exc import OperationalError
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'email_messages_fts'
+# The searchable text of each message, with the sender resolved from its
+# dimension tables; the index reads it from here when rebuilt
+SEARCH_VIEW = 'email_messages_search'
+SENDER_EMAIL = "(SELECT email FROM senders WHERE id = {row}.sender_id)"
+SENDER_NAME = "(SELECT name FROM sender_names WHERE id = {row}.sender_name_id)"
+
+# External-content FTS5 index over the searchable columns, keyed on the
+# email_messages rowid and kept current by triggers, so bulk Core inserts
+# and deletes are indexed without any application code. Dimension rows
+# never change, so a trigger can resolve a deleted row's sender too.
+SEARCH_INDEX_DDL = [
+    f"""
+    CREATE VIEW IF NOT EXISTS {SEARCH_VIEW} AS
+    SELECT
+        m.rowid AS message_rowid,
+        {SENDER_EMAIL.format(row='m')} AS sender_email,
+        {SENDER_NAME.format(row='m')} AS sender_name,
+        m.subject AS subject
+    FROM email_messages AS m
+    """,
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        sender_email, sender_name, subject,
+        content='{SEARCH_VIEW}', content_rowid='message_rowid',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON email_messages BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, sender_email, sender_name, subject)
+        VALUES (new.rowid, {SENDER_EMAIL.format(row='new')}, {SENDER_NAME.format(row='new')}, new.subject);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON email_messages BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, sender_email, sender_name, subject)
+        VALUES ('delete', old.rowid, {SENDER_EMAIL.format(row='old')}, {SENDER_NAME.format(row='old')}, old.subject);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE ON email_messages BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, sender_email, sender_name, subject)
+        VALUES ('delete', old.rowid, {SENDER_EMAIL.format(row='old')}, {SENDER_NAME.format(row='old')}, old.subject);
+        INSERT INTO {FTS_TABLE}(rowid, sender_email, sender_name, subject)
+        VALUES (new.rowid, {SENDER_EMAIL.format(row='new')}, {SENDER_NAME.format(row='new')}, new.subject);
+    END
+    """,
+]
+
+fts = table(FTS_TABLE, column('rowid'), column('rank'), column(FTS_TABLE))
+
+_enabled = False
+
+
+def search_index_enabled() -> bool:
+    return _enabled
+
+
+def ensure_search_index(engine):
+    """Creates the FTS5 index and its triggers on SQLite, backfilling it on first creation.
+
+    Other databases, or SQLite builds without FTS5, keep using ILIKE search.
+    """
+    global _enabled
+    if engine.dialect.name != 'sqlite':
+        return
+
+    try:
+        with engine.begin() as conn:
+            exists = conn.execute(
+                text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                {"name": FTS_TABLE}
+            ).first()
+            for statement in SEARCH_INDEX_DDL:
+                conn.execute(text(statement))
+            if not exists:
+                conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+    except OperationalError as e:
+        logger.warning("Full-text search unavailable, falling back to ILIKE: %s", e)
+        return
+
+    _enabled = True
+
+
+def rebuild_search_index(conn):
+    """Reindexes every message; needed after a VACUUM, which may renumber rowids."""
+    conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+
+
+def to_match_query(term: str) -> Optional[str]:
+    """Turns free text into an FTS5 query matching every word as a prefix."""
+    words = re.findall(r'\w+', term)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def search_matches(term: str):
+    """Returns a (rowid, rank) subquery of messages matching ``term``, or None if unusable."""
+    match_query = to_match_query(term)
+    if not _enabled or match_query is None:
+        return None
+    return (
+        select(fts.c.rowid, fts.c.rank)
+        .where(fts.c[FTS_TABLE].op('MATCH')(match_query))
+        .subquery('search_matches')
+    )
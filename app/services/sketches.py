@@ -0,0 +1,467 @@
+"""Mergeable sketches of the senders and domains of each year, month and day.
+
+For every account, each period with dated messages has a HyperLogLog of
+its sender and domain IDs, for distinct counts, and a Space-Saving
+summary of them, for the heaviest senders and domains. Both merge
+without losing their guarantees, so a date range, over one account or
+several, is answered by merging the years it covers, the months at its
+edges and then the days: a few dozen sketches, however many messages
+the range holds.
+
+Sketches are updated as sync inserts messages. They cannot forget a
+message, so deletions rebuild the months they touched from
+``email_messages``, and re-merge their years from the months.
+"""
+import math
+import zlib
+from array import array
+from collections import Counter
+from datetime import date, timedelta
+from itertools import chain
+from operator import itemgetter
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import and_, delete, event, insert, or_, select, tuple_, update
+from sqlalchemy.orm import Session
+from ..models import EmailMessage, Sketch
+
+CHUNK_SIZE = 500
+# Session.info key of the message rows added by its open transaction, sketched when it commits
+PENDING_KEY = 'pending_sketch_rows'
+HLL_PRECISION = 12
+HLL_REGISTERS = 1 << HLL_PRECISION
+# Bits of the hash left after the register index, whose leading zeros are counted
+HLL_RANK_BITS = 64 - HLL_PRECISION
+HLL_ALPHA = 0.7213 / (1 + 1.079 / HLL_REGISTERS)
+HLL_POWERS = [2.0 ** -rank for rank in range(HLL_RANK_BITS + 2)]
+# Set registers up to which a HyperLogLog is stored sparse
+HLL_SPARSE_LIMIT = HLL_REGISTERS // 4
+TOP_COUNTERS = 256
+# Relative standard error of a distinct count
+DISTINCT_ERROR = 1.04 / math.sqrt(HLL_REGISTERS)
+# Most a top count can exceed the true count by, relative to the messages counted
+COUNT_ERROR = 1 / TOP_COUNTERS
+MASK64 = (1 << 64) - 1
+# Periods each account's messages are sketched over, longest first
+BUCKETS = ('year', 'month', 'day')
+SKETCH_COLUMNS = (Sketch.sender_hll, Sketch.domain_hll, Sketch.top_senders, Sketch.top_domains)
+
+
+def within(max_error: Optional[float]) -> bool:
+    """Whether sketches are accurate enough for a request accepting ``max_error`` relative error."""
+    return max_error is not None and max(DISTINCT_ERROR, COUNT_ERROR) <= max_error
+
+
+def hash_id(value: int) -> int:
+    """Spreads a dimension ID over 64 bits (SplitMix64's finalizer); IDs are sequential."""
+    value = (value + 0x9E3779B97F4A7C15) & MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+
+def next_month(day: date) -> date:
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+class HyperLogLog:
+    """Distinct count estimate of integer IDs, within DISTINCT_ERROR relative standard error.
+
+    While few registers are set, as for most days, they are kept as a
+    {register: rank} dict, which is smaller to store and quicker to merge.
+    """
+
+    def __init__(self, registers: Optional[bytearray] = None, sparse: Optional[Dict[int, int]] = None):
+        self.registers = registers
+        self.sparse = {} if registers is None and sparse is None else sparse
+
+    def add(self, value: int):
+        hashed = hash_id(value)
+        index = hashed >> HLL_RANK_BITS
+        rank = HLL_RANK_BITS - (hashed & ((1 << HLL_RANK_BITS) - 1)).bit_length() + 1
+        if self.sparse is None:
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+        elif rank > self.sparse.get(index, 0):
+            self.sparse[index] = rank
+            if len(self.sparse) > HLL_SPARSE_LIMIT:
+                self._densify()
+
+    def _densify(self):
+        registers = bytearray(HLL_REGISTERS)
+        for index, rank in self.sparse.items():
+            registers[index] = rank
+        self.registers, self.sparse = registers, None
+
+    def estimate(self) -> float:
+        if self.sparse is not None:
+            zeros = HLL_REGISTERS - len(self.sparse)
+            harmonic = zeros + sum(map(HLL_POWERS.__getitem__, self.sparse.values()))
+        else:
+            zeros = self.registers.count(0)
+            harmonic = sum(map(HLL_POWERS.__getitem__, self.registers))
+        raw = HLL_ALPHA * HLL_REGISTERS * HLL_REGISTERS / harmonic
+        if raw <= 2.5 * HLL_REGISTERS and zeros:
+            # Linear counting, which is more accurate while most registers are empty
+            return HLL_REGISTERS * math.log(HLL_REGISTERS / zeros)
+        return raw
+
+    @classmethod
+    def union(cls, sketches: List['HyperLogLog']) -> 'HyperLogLog':
+        dense = [sketch.registers for sketch in sketches if sketch.sparse is None]
+        if not dense:
+            if not sketches:
+                return cls()
+            base = max(sketches, key=lambda sketch: len(sketch.sparse))
+            merged = cls(sparse=dict(base.sparse))
+            for sketch in sketches:
+                if sketch is base:
+                    continue
+                for index, rank in sketch.sparse.items():
+                    if rank > merged.sparse.get(index, 0):
+                        merged.sparse[index] = rank
+            if len(merged.sparse) > HLL_SPARSE_LIMIT:
+                merged._densify()
+            return merged
+
+        registers = bytearray(map(max, *dense)) if len(dense) > 1 else bytearray(dense[0])
+        for sketch in sketches:
+            if sketch.sparse is not None:
+                for index, rank in sketch.sparse.items():
+                    if rank > registers[index]:
+                        registers[index] = rank
+        return cls(registers)
+
+    def to_bytes(self) -> bytes:
+        if self.sparse is not None:
+            return b's' + array('H', self.sparse).tobytes() + bytes(self.sparse.values())
+        return b'd' + zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'HyperLogLog':
+        if data[:1] == b'd':
+            return cls(bytearray(zlib.decompress(data[1:])))
+        count = (len(data) - 1) // 3
+        indexes = array('H')
+        indexes.frombytes(data[1:1 + 2 * count])
+        return cls(sparse=dict(zip(indexes, data[1 + 2 * count:])))
+
+
+class SpaceSaving:
+    """The TOP_COUNTERS most frequent IDs, with counts that may overestimate by a tracked error.
+
+    Each counter is an ID's (count, error): its true count is at most
+    ``count`` and at least ``count - error``. IDs without a counter were
+    counted at most ``floor`` times.
+    """
+
+    def __init__(self, counters: Optional[Dict[int, Tuple[int, int]]] = None, floor: int = 0):
+        self.counters = counters if counters is not None else {}
+        self.floor = floor
+
+    @classmethod
+    def of_counts(cls, counts: Dict[int, int]) -> 'SpaceSaving':
+        summary = cls({id: (count, 0) for id, count in counts.items()})
+        summary._prune()
+        return summary
+
+    @classmethod
+    def union(cls, summaries: List['SpaceSaving']) -> 'SpaceSaving':
+        """Merges summaries of disjoint sets of messages.
+
+        An ID missing from a summary is counted as that summary's floor,
+        in both its count and its error.
+        """
+        if not summaries:
+            return cls()
+        floor = sum(summary.floor for summary in summaries)
+        # Start from the largest summary, usually a month or year merged with a batch
+        base = max(summaries, key=lambda summary: len(summary.counters))
+        others_floor = floor - base.floor
+        if others_floor:
+            counters = {
+                id: (count + others_floor, error + others_floor) for id, (count, error) in base.counters.items()
+            }
+        else:
+            counters = dict(base.counters)
+        for summary in summaries:
+            if summary is base:
+                continue
+            for id, (count, error) in summary.counters.items():
+                total_count, total_error = counters.get(id, (floor, floor))
+                counters[id] = (total_count + count - summary.floor, total_error + error - summary.floor)
+        merged = cls(counters, floor)
+        merged._prune()
+        return merged
+
+    def _prune(self):
+        if len(self.counters) <= TOP_COUNTERS:
+            return
+        ranked = sorted(self.counters.items(), key=itemgetter(1), reverse=True)
+        self.floor = max(self.floor, ranked[TOP_COUNTERS][1][0])
+        self.counters = dict(ranked[:TOP_COUNTERS])
+
+    def top(self, limit: int) -> List[Tuple[int, int]]:
+        """The ``limit`` (ID, count) pairs with the highest counts, ties by ID."""
+        ranked = sorted(self.counters.items(), key=lambda item: (-item[1][0], item[0]))
+        return [(id, count) for id, (count, _) in ranked[:limit]]
+
+    def error(self, ids: Iterable[int]) -> int:
+        """Most any of the counts of ``ids`` may exceed the true count by."""
+        return max((self.counters[id][1] for id in ids), default=0)
+
+    def to_bytes(self) -> bytes:
+        values = array('i', [self.floor])
+        values.extend(chain.from_iterable((id, count, error) for id, (count, error) in self.counters.items()))
+        return values.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'SpaceSaving':
+        values = array('i')
+        values.frombytes(data)
+        counters = {
+            values[index]: (values[index + 1], values[index + 2])
+            for index in range(1, len(values), 3)
+        }
+        return cls(counters, values[0])
+
+
+class BucketSketch:
+    """The sender and domain sketches of one account's messages over a day, a month or a merged range."""
+
+    def __init__(self, senders=None, domains=None, top_senders=None, top_domains=None):
+        self.senders = senders or HyperLogLog()
+        self.domains = domains or HyperLogLog()
+        self.top_senders = top_senders or SpaceSaving()
+        self.top_domains = top_domains or SpaceSaving()
+
+    @classmethod
+    def of_counts(cls, sender_counts: Dict[int, int], domain_counts: Dict[int, int]) -> 'BucketSketch':
+        sketch = cls(top_senders=SpaceSaving.of_counts(sender_counts), top_domains=SpaceSaving.of_counts(domain_counts))
+        for sender_id in sender_counts:
+            sketch.senders.add(sender_id)
+        for domain_id in domain_counts:
+            sketch.domains.add(domain_id)
+        return sketch
+
+    @classmethod
+    def union(cls, sketches: List['BucketSketch']) -> 'BucketSketch':
+        return cls(
+            HyperLogLog.union([sketch.senders for sketch in sketches]),
+            HyperLogLog.union([sketch.domains for sketch in sketches]),
+            SpaceSaving.union([sketch.top_senders for sketch in sketches]),
+            SpaceSaving.union([sketch.top_domains for sketch in sketches]),
+        )
+
+    @classmethod
+    def from_row(cls, row) -> 'BucketSketch':
+        return cls(
+            HyperLogLog.from_bytes(row.sender_hll),
+            HyperLogLog.from_bytes(row.domain_hll),
+            SpaceSaving.from_bytes(row.top_senders),
+            SpaceSaving.from_bytes(row.top_domains),
+        )
+
+    def to_row(self) -> dict:
+        return {
+            'sender_hll': self.senders.to_bytes(),
+            'domain_hll': self.domains.to_bytes(),
+            'top_senders': self.top_senders.to_bytes(),
+            'top_domains': self.top_domains.to_bytes(),
+        }
+
+
+def bucket_floor(bucket: str, day: date) -> date:
+    """Start of the year, month or day containing ``day``."""
+    if bucket == 'year':
+        return day.replace(month=1, day=1)
+    if bucket == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def bucket_ceil(bucket: str, day: date) -> date:
+    """Start of the first year, month or day beginning on or after ``day``."""
+    start = bucket_floor(bucket, day)
+    if start == day:
+        return day
+    if bucket == 'year':
+        return start.replace(year=start.year + 1)
+    return next_month(start)
+
+
+def cover(low: Optional[date], high: Optional[date], buckets=BUCKETS) -> list:
+    """SQL for the fewest sketches exactly covering the days from ``low`` until ``high``, exclusive.
+
+    Whole years are taken first, then whole months at the edges, then days.
+    """
+    if len(buckets) == 1:
+        return [bucket_range(buckets[0], low, high)]
+    bucket = buckets[0]
+    first = None if low is None else bucket_ceil(bucket, low)
+    last = None if high is None else bucket_floor(bucket, high)
+    if first is not None and last is not None and first >= last:
+        return cover(low, high, buckets[1:])
+
+    criteria = [bucket_range(bucket, first, last)]
+    if low is not None and low < first:
+        criteria += cover(low, first, buckets[1:])
+    if high is not None and last < high:
+        criteria += cover(last, high, buckets[1:])
+    return criteria
+
+
+def bucket_range(bucket: str, low: Optional[date], high: Optional[date]):
+    criteria = [Sketch.bucket == bucket]
+    if low is not None:
+        criteria.append(Sketch.start >= low)
+    if high is not None:
+        criteria.append(Sketch.start < high)
+    return and_(*criteria)
+
+
+class SketchService:
+    """Maintains the ``sketches`` table and merges it to answer date ranges approximately.
+
+    Only per-account sketches are stored; ranges over every account
+    merge them, so syncs of different accounts never update the same rows.
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def add(self, rows: List[dict]):
+        """Queues newly inserted message rows, keyed by dimension IDs, to be sketched.
+
+        They are folded in when the transaction commits, so a sync rewrites
+        each month and year it touches once per commit rather than once per
+        batch.
+        """
+        self.db.info.setdefault(PENDING_KEY, []).extend(rows)
+
+    def flush(self):
+        """Folds the rows queued by ``add`` into their sketches."""
+        rows = self.db.info.pop(PENDING_KEY, None)
+        if rows:
+            self._fold(rows)
+
+    def _fold(self, rows, buckets=BUCKETS):
+        """Counts message rows into the sketches of their periods."""
+        counts = {}
+        for row in rows:
+            if row['received_date'] is None:
+                continue
+            day = row['received_date'].date()
+            for bucket in buckets:
+                key = (row['account_id'], bucket, bucket_floor(bucket, day))
+                entry = counts.get(key)
+                if entry is None:
+                    entry = counts[key] = (Counter(), Counter())
+                sender_counts, domain_counts = entry
+                if row['sender_id'] is not None:
+                    sender_counts[row['sender_id']] += 1
+                if row['domain_id'] is not None:
+                    domain_counts[row['domain_id']] += 1
+        if not counts:
+            return
+
+        keys = list(counts)
+        existing = {}
+        for start in range(0, len(keys), CHUNK_SIZE):
+            for row in self.db.execute(
+                select(Sketch.account_id, Sketch.bucket, Sketch.start, *SKETCH_COLUMNS)
+                .where(tuple_(Sketch.account_id, Sketch.bucket, Sketch.start).in_(keys[start:start + CHUNK_SIZE]))
+            ):
+                existing[(row.account_id, row.bucket, row.start)] = BucketSketch.from_row(row)
+
+        updates, inserts = [], []
+        for key, (sender_counts, domain_counts) in counts.items():
+            sketch = BucketSketch.of_counts(sender_counts, domain_counts)
+            if key in existing:
+                sketch = BucketSketch.union([existing[key], sketch])
+            account_id, bucket, start = key
+            row = dict(sketch.to_row(), account_id=account_id, bucket=bucket, start=start)
+            (updates if key in existing else inserts).append(row)
+        if updates:
+            self.db.execute(update(Sketch), updates)
+        if inserts:
+            self.db.execute(insert(Sketch), inserts)
+
+    def refresh(self, account_id: int, days: Iterable[date]):
+        """Rebuilds the sketches of the months containing ``days`` from email_messages.
+
+        Their years are then re-merged from the year's month sketches.
+        """
+        # Queued rows are already in email_messages, so must not be counted again after
+        self.flush()
+        months = {bucket_floor('month', day) for day in days}
+        for month in months:
+            end = next_month(month)
+            self.db.execute(
+                delete(Sketch)
+                .where(
+                    Sketch.account_id == account_id, Sketch.bucket != 'year',
+                    Sketch.start >= month, Sketch.start < end
+                )
+            )
+            self._fold(self.db.execute(
+                select(EmailMessage.account_id, EmailMessage.sender_id, EmailMessage.domain_id, EmailMessage.received_date)
+                .where(
+                    EmailMessage.account_id == account_id,
+                    EmailMessage.received_date >= month,
+                    EmailMessage.received_date < end
+                )
+            ).mappings().all(), buckets=('month', 'day'))
+
+        for year in {bucket_floor('year', month) for month in months}:
+            self.db.execute(
+                delete(Sketch)
+                .where(Sketch.account_id == account_id, Sketch.bucket == 'year', Sketch.start == year)
+            )
+            rows = self.db.execute(
+                select(*SKETCH_COLUMNS)
+                .where(Sketch.account_id == account_id, bucket_range('month', year, year.replace(year=year.year + 1)))
+            ).all()
+            if rows:
+                sketch = BucketSketch.union([BucketSketch.from_row(row) for row in rows])
+                self.db.execute(insert(Sketch), [dict(sketch.to_row(), account_id=account_id, bucket='year', start=year)])
+
+    def rebuild(self):
+        """Recomputes every sketch from scratch, one account's month at a time."""
+        self.db.info.pop(PENDING_KEY, None)
+        self.db.execute(delete(Sketch))
+        result = self.db.execute(
+            select(EmailMessage.account_id, EmailMessage.sender_id, EmailMessage.domain_id, EmailMessage.received_date)
+            .where(EmailMessage.received_date.is_not(None))
+            .order_by(EmailMessage.account_id, EmailMessage.received_date)
+            .execution_options(yield_per=10000)
+        ).mappings()
+        month_rows, current = [], None
+        for row in result:
+            key = (row['account_id'], bucket_floor('month', row['received_date'].date()))
+            if key != current and month_rows:
+                self._fold(month_rows)
+                month_rows = []
+            current = key
+            month_rows.append(row)
+        self._fold(month_rows)
+
+    def merged(self, account_id: Optional[int], start: Optional[date], end: Optional[date]) -> BucketSketch:
+        """The sketch of the messages in the inclusive date range, of one account or all of them."""
+        criteria = [or_(*cover(start, None if end is None else end + timedelta(days=1)))]
+        if account_id is not None:
+            criteria.append(Sketch.account_id == account_id)
+        rows = self.db.execute(select(*SKETCH_COLUMNS).where(*criteria)).all()
+        return BucketSketch.union([BucketSketch.from_row(row) for row in rows])
+
+
+@event.listens_for(Session, 'before_commit')
+def _fold_pending(session):
+    SketchService(session).flush()
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _discard_pending(session, transaction):
+    # Rows still queued when the outermost transaction ends were not
+    # committed: it was rolled back, or the session closed with it open
+    if transaction.parent is None:
+        session.info.pop(PENDING_KEY, None)
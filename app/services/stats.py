@@ -0,0 +1,273 @@
+from datetime import date, datetime, timedelta
+from typing import Iterable, List
+from sqlalchemy import Date, case, delete, func, insert, literal, select
+from sqlalchemy.orm import Session
+from ..database import dialect_insert
+from ..models import (
+    ALL_ACCOUNTS, DailyStat, DomainDailyStat, DomainStat, EmailMessage, SenderDailyStat, SenderStat
+)
+
+CHUNK_SIZE = 500
+# Each daily rollup table with the message column it is keyed on, if any
+DAILY_STATS = (
+    (DailyStat, None),
+    (SenderDailyStat, 'sender_id'),
+    (DomainDailyStat, 'domain_id'),
+)
+
+
+def _later(current, candidate):
+    """SQL for whether ``candidate`` is a newer date than ``current`` (NULL sorts oldest)."""
+    return current.is_(None) | (candidate > current)
+
+
+def _aggregate(rows, key):
+    """Folds rows into count, latest date and the sender name ID of the latest row.
+
+    Each row is counted for its own account and for ALL_ACCOUNTS.
+    """
+    totals = {}
+    for row in rows:
+        # Compare as stored: SQLite DateTime columns drop the UTC offset
+        date = row['received_date'] and row['received_date'].replace(tzinfo=None)
+        for account_id in (row['account_id'], ALL_ACCOUNTS):
+            entry = totals.get((account_id, row[key]))
+            if entry is None:
+                totals[(account_id, row[key])] = entry = {
+                    'account_id': account_id, key: row[key], 'count': 0, 'latest_date': None
+                }
+                if key == 'sender_id':
+                    entry['sender_name_id'] = row['sender_name_id']
+            entry['count'] += 1
+            if date is not None and (entry['latest_date'] is None or date > entry['latest_date']):
+                entry['latest_date'] = date
+                if key == 'sender_id':
+                    entry['sender_name_id'] = row['sender_name_id']
+    return list(totals.values())
+
+
+def _daily_counts(rows, key):
+    """Folds dated rows into per-day counts of each account and key, plus ALL_ACCOUNTS."""
+    counts = {}
+    for row in rows:
+        if row['received_date'] is None:
+            continue
+        day = row['received_date'].date()
+        for account_id in (row['account_id'], ALL_ACCOUNTS):
+            group = (account_id, row[key] if key else None, day)
+            counts[group] = counts.get(group, 0) + 1
+
+    totals = []
+    for (account_id, value, day), count in counts.items():
+        entry = {'account_id': account_id, 'day': day, 'count': count}
+        if key:
+            entry[key] = value
+        totals.append(entry)
+    return totals
+
+
+class StatsService:
+    """Maintains the ``sender_stats`` and ``domain_stats`` aggregate tables,
+    and the daily rollups behind the analytics time series.
+
+    Inserts are folded in with an upsert per batch; deletions recompute the
+    affected keys, since a latest date cannot be decremented. Every change
+    is applied to the message's account and to the ALL_ACCOUNTS totals.
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def add(self, rows: List[dict]):
+        """Counts newly inserted message rows, keyed by dimension IDs, into the aggregates."""
+        if not rows:
+            return
+
+        conflict_insert = dialect_insert(self.db.get_bind())
+        if conflict_insert is None:
+            for account_id in {row['account_id'] for row in rows}:
+                account_rows = [row for row in rows if row['account_id'] == account_id]
+                self.refresh(
+                    account_id,
+                    {row['sender_id'] for row in account_rows},
+                    {row['domain_id'] for row in account_rows},
+                    {row['received_date'].date() for row in account_rows if row['received_date']}
+                )
+            return
+
+        senders = SenderStat.__table__
+        stmt = conflict_insert(senders)
+        newer = _later(senders.c.latest_date, stmt.excluded.latest_date)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[senders.c.account_id, senders.c.sender_id],
+            set_={
+                'count': senders.c['count'] + stmt.excluded['count'],
+                'latest_date': case((newer, stmt.excluded.latest_date), else_=senders.c.latest_date),
+                'sender_name_id': case((newer, stmt.excluded.sender_name_id), else_=senders.c.sender_name_id),
+            }
+        )
+        self.db.execute(stmt, _aggregate(rows, 'sender_id'))
+
+        domains = DomainStat.__table__
+        stmt = conflict_insert(domains)
+        newer = _later(domains.c.latest_date, stmt.excluded.latest_date)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[domains.c.account_id, domains.c.domain_id],
+            set_={
+                'count': domains.c['count'] + stmt.excluded['count'],
+                'latest_date': case((newer, stmt.excluded.latest_date), else_=domains.c.latest_date),
+            }
+        )
+        self.db.execute(stmt, _aggregate(rows, 'domain_id'))
+
+        for model, key in DAILY_STATS:
+            counts = _daily_counts(rows, key)
+            if not counts:
+                continue
+            table = model.__table__
+            stmt = conflict_insert(table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=list(table.primary_key.columns),
+                set_={'count': table.c['count'] + stmt.excluded['count']}
+            )
+            self.db.execute(stmt, counts)
+
+    def refresh(
+        self,
+        account_id: int,
+        sender_ids: Iterable[int],
+        domain_ids: Iterable[int],
+        days: Iterable[date] = ()
+    ):
+        """Recomputes the aggregates of the given senders, domains and days from email_messages."""
+        accounts = (account_id, ALL_ACCOUNTS)
+        sender_ids = list(sender_ids)
+        for start in range(0, len(sender_ids), CHUNK_SIZE):
+            chunk = sender_ids[start:start + CHUNK_SIZE]
+            self.db.execute(
+                delete(SenderStat)
+                .where(SenderStat.account_id.in_(accounts), SenderStat.sender_id.in_(chunk))
+            )
+            self.db.execute(
+                delete(SenderDailyStat)
+                .where(SenderDailyStat.account_id.in_(accounts), SenderDailyStat.sender_id.in_(chunk))
+            )
+            for stats_account_id in accounts:
+                self._insert_sender_totals(stats_account_id, EmailMessage.sender_id.in_(chunk))
+                self._insert_daily_totals(
+                    SenderDailyStat, 'sender_id', stats_account_id, EmailMessage.sender_id.in_(chunk)
+                )
+
+        domain_ids = list(domain_ids)
+        for start in range(0, len(domain_ids), CHUNK_SIZE):
+            chunk = domain_ids[start:start + CHUNK_SIZE]
+            self.db.execute(
+                delete(DomainStat)
+                .where(DomainStat.account_id.in_(accounts), DomainStat.domain_id.in_(chunk))
+            )
+            self.db.execute(
+                delete(DomainDailyStat)
+                .where(DomainDailyStat.account_id.in_(accounts), DomainDailyStat.domain_id.in_(chunk))
+            )
+            for stats_account_id in accounts:
+                self._insert_domain_totals(stats_account_id, EmailMessage.domain_id.in_(chunk))
+                self._insert_daily_totals(
+                    DomainDailyStat, 'domain_id', stats_account_id, EmailMessage.domain_id.in_(chunk)
+                )
+
+        for day in set(days):
+            self.db.execute(delete(DailyStat).where(DailyStat.account_id.in_(accounts), DailyStat.day == day))
+            # A range on received_date, unlike date(received_date), can use its indexes
+            start = datetime.combine(day, datetime.min.time())
+            for stats_account_id in accounts:
+                self._insert_daily_totals(
+                    DailyStat, None, stats_account_id,
+                    EmailMessage.received_date >= start,
+                    EmailMessage.received_date < start + timedelta(days=1)
+                )
+
+    def rebuild(self):
+        """Recomputes the aggregate tables from scratch."""
+        self.db.execute(delete(SenderStat))
+        self.db.execute(delete(DomainStat))
+        account_ids = list(self.db.scalars(select(EmailMessage.account_id).distinct()))
+        for account_id in account_ids + [ALL_ACCOUNTS]:
+            self._insert_sender_totals(account_id)
+            self._insert_domain_totals(account_id)
+        self.rebuild_daily()
+
+    def rebuild_daily(self):
+        """Recomputes the daily rollup tables from scratch."""
+        account_ids = list(self.db.scalars(select(EmailMessage.account_id).distinct()))
+        for model, key in DAILY_STATS:
+            self.db.execute(delete(model))
+            for account_id in account_ids + [ALL_ACCOUNTS]:
+                self._insert_daily_totals(model, key, account_id)
+
+    def _insert_sender_totals(self, account_id: int, *criteria):
+        if account_id != ALL_ACCOUNTS:
+            criteria += (EmailMessage.account_id == account_id,)
+        # One pass over the sender's rows, rather than a per-sender lookup of
+        # the latest name, which on an account's rows cannot use the sender index
+        by_sender = {'partition_by': EmailMessage.sender_id}
+        ranked = (
+            select(
+                EmailMessage.sender_id,
+                EmailMessage.sender_name_id,
+                func.row_number().over(**by_sender, order_by=EmailMessage.received_date.desc()).label('position'),
+                func.count().over(**by_sender).label('count'),
+                func.max(EmailMessage.received_date).over(**by_sender).label('latest_date')
+            )
+            .where(*criteria)
+            .subquery()
+        )
+        totals = (
+            select(
+                literal(account_id),
+                ranked.c.sender_id,
+                ranked.c.sender_name_id,
+                ranked.c['count'],
+                ranked.c.latest_date
+            )
+            .where(ranked.c.position == 1)
+        )
+        self.db.execute(
+            insert(SenderStat).from_select(
+                ['account_id', 'sender_id', 'sender_name_id', 'count', 'latest_date'], totals
+            )
+        )
+
+    def _insert_domain_totals(self, account_id: int, *criteria):
+        if account_id != ALL_ACCOUNTS:
+            criteria += (EmailMessage.account_id == account_id,)
+        totals = (
+            select(
+                literal(account_id),
+                EmailMessage.domain_id,
+                func.count(),
+                func.max(EmailMessage.received_date)
+            )
+            .where(*criteria)
+            .group_by(EmailMessage.domain_id)
+        )
+        self.db.execute(
+            insert(DomainStat).from_select(
+                ['account_id', 'domain_id', 'count', 'latest_date'], totals
+            )
+        )
+
+    def _insert_daily_totals(self, model, key, account_id: int, *criteria):
+        keys = [getattr(EmailMessage, key)] if key else []
+        if account_id != ALL_ACCOUNTS:
+            criteria += (EmailMessage.account_id == account_id,)
+        day = func.date(EmailMessage.received_date, type_=Date)
+        totals = (
+            select(literal(account_id), *keys, day, func.count())
+            .where(EmailMessage.received_date.is_not(None), *criteria)
+            .group_by(*keys, day)
+        )
+        self.db.execute(
+            insert(model).from_select(
+                ['account_id'] + ([key] if key else []) + ['day', 'count'], totals
+            )
+        )
@@ -0,0 +1,490 @@
+import logging
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import datetime
+from googleapiclient.errors import HttpError
+from sqlalchemy.orm import Session
+from ..cache import response_cache
+from ..config import settings
+from ..models import Account, SyncState
+from .gmail import GmailService
+from .ingest import IngestService
+from .quota import QUOTA_UNITS, QuotaLimiter, backoff_delay
+
+logger = logging.getLogger(__name__)
+
+# Gmail rejects batch requests carrying more than 100 calls
+MAX_BATCH_SIZE = 100
+LIST_PAGE_SIZE = 500
+METADATA_HEADERS = ['From', 'Subject', 'Date']
+# Partial-response masks: just the fields sync reads. Every call also
+# passes prettyPrint=False, since Gmail indents its JSON by default
+PROFILE_FIELDS = 'emailAddress,historyId'
+LIST_FIELDS = 'messages/id,nextPageToken'
+HISTORY_FIELDS = 'history(messagesAdded/message(id,labelIds),messagesDeleted/message/id),historyId,nextPageToken'
+MESSAGE_FIELDS = 'id,payload/headers'
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Gmail also reports an exhausted quota as 403 with one of these reasons
+RATE_LIMIT_REASONS = (b'rateLimitExceeded', b'userRateLimitExceeded')
+# messages().list leaves these out by default, so incremental sync does too
+SKIPPED_LABELS = {'SPAM', 'TRASH'}
+
+
+def is_rate_limited(error):
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    content = error.content if isinstance(error.content, bytes) else str(error.content or '').encode()
+    return error.resp.status == 403 and any(reason in content for reason in RATE_LIMIT_REASONS)
+
+
+def is_retryable(error):
+    return is_rate_limited(error) or (isinstance(error, HttpError) and error.resp.status in RETRYABLE_STATUSES)
+
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+@dataclass
+class SyncStats:
+    listed: int = 0
+    fetched: int = 0
+    inserted: int = 0
+    skipped: int = 0
+    deleted: int = 0
+    errors: int = 0
+    bytes_received: int = 0
+    mode: str = 'full'
+    started_at: float = field(default_factory=time.monotonic)
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    @property
+    def rate(self) -> float:
+        """Fetched messages per second since the sync started."""
+        elapsed = self.elapsed
+        return self.fetched / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def bytes_per_message(self) -> float:
+        """Response bytes received, listings included, per fetched message."""
+        return self.bytes_received / self.fetched if self.fetched else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "mode": self.mode,
+            "listed": self.listed,
+            "fetched": self.fetched,
+            "inserted": self.inserted,
+            "skipped": self.skipped,
+            "deleted": self.deleted,
+            "errors": self.errors,
+            "rate": round(self.rate, 1),
+            "bytes_received": self.bytes_received,
+            "bytes_per_message": round(self.bytes_per_message, 1),
+        }
+
+
+class SyncService:
+    """Copies one account's Gmail message metadata into the local database.
+
+    Message IDs from each ``messages().list`` page are grouped into Gmail
+    batch requests which a bounded pool of worker threads executes
+    concurrently. ``service_factory`` is called before each batch and must
+    return a client for the calling thread, since the underlying
+    ``httplib2`` transport is not thread-safe; by default it is the
+    thread's pooled client from ``gmail_clients``. Pass a factory returning
+    a stand-in client to exercise the pipeline offline.
+
+    After a complete run the mailbox historyId is stored in ``sync_state``
+    so the next run only replays ``history().list`` changes, falling back
+    to a full listing once Gmail has expired that history. A full listing
+    stores its page token as its pages are stored, so a run that fails or
+    is interrupted is resumed by the next one rather than listed again.
+
+    Every call is paced by a ``QuotaLimiter`` to
+    ``quota_units_per_second``, and calls rejected with 429/5xx are
+    retried after a jittered exponential backoff.
+
+    Fetched messages are buffered and stored together with the listing
+    position at each commit, and no transaction is left open while waiting
+    on Gmail: on SQLite, other accounts' syncs write from processes of
+    their own, and a transaction holds the write lock until it ends.
+    ``on_commit`` is called after each commit that changed stored messages;
+    by default it invalidates this process's response cache.
+
+    Calls ask only for the fields sync reads. The response bytes they
+    received are reported in the stats, read from ``transfer``, which
+    defaults to the account's counter in ``gmail_clients``.
+    """
+
+    def __init__(
+        self,
+        db: Session,
+        account_id: int,
+        service_factory=None,
+        batch_size: int = settings.SYNC_BATCH_SIZE,
+        workers: int = settings.SYNC_WORKERS,
+        max_retries: int = settings.SYNC_MAX_RETRIES,
+        quota_units_per_second: float = settings.GMAIL_QUOTA_UNITS_PER_SECOND,
+        on_progress=None,
+        on_commit=None,
+        transfer=None,
+    ):
+        self.db = db
+        self.account = db.get(Account, account_id)
+        if self.account is None:
+            raise ValueError(f"Unknown account {account_id}")
+        self.ingest = IngestService(db, account_id)
+        self.gmail_service = GmailService(self.account.token_file)
+        self.service_factory = service_factory or self.gmail_service.service_factory()
+        self.transfer = transfer or self.gmail_service.transfer()
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.workers = max(1, workers)
+        self.max_in_flight = self.workers * 2
+        self.max_retries = max_retries
+        self.limiter = QuotaLimiter(quota_units_per_second)
+        self.on_progress = on_progress
+        self.on_commit = on_commit or response_cache.bump_version
+        self.stats = SyncStats()
+        self._bytes_at_start = self.transfer.bytes
+        self._executor = None
+        self._in_flight = {}
+        self._fetch_failures = 0
+        self._committed_changes = (0, 0)
+        # Parsed rows of fetched messages, stored by the next commit
+        self._rows = []
+        # Position of the running full listing: its sync_state row, the next
+        # page's number, the first page not yet stored in full, outstanding
+        # batches per page, and the token following each listed page
+        self._listing = None
+        self._listed_pages = 0
+        self._stored_pages = 0
+        self._page_batches = {}
+        self._next_tokens = {}
+        self._failed_pages = set()
+
+    def run(self, full: bool = False) -> SyncStats:
+        """Syncs the mailbox, incrementally from the stored historyId when possible."""
+        service = self.service_factory()
+        self._release()
+        profile = self._execute(
+            service.users().getProfile(userId='me', fields=PROFILE_FIELDS, prettyPrint=False), 'getProfile'
+        )
+        account = profile['emailAddress']
+        if self.account.email is None:
+            self.account.email = account
+        elif self.account.email != account:
+            raise ValueError(
+                f"Token {self.account.token_file} is for {account}, not account {self.account.email}"
+            )
+        state = self.db.get(SyncState, account)
+        if state is None:
+            state = SyncState(account=account)
+            self.db.add(state)
+        self._release()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as self._executor:
+            if state.listing_page_token:
+                history_id = self._resume_full(service, state, profile['historyId'])
+            elif state.history_id and not full:
+                try:
+                    history_id = self._sync_history(service, state.history_id)
+                except HttpError as e:
+                    if e.resp.status != 404:
+                        raise
+                    # Gmail keeps roughly a week of history; older IDs return 404
+                    logger.info("History %s expired for %s, running a full sync", state.history_id, account)
+                    history_id = self._sync_full(service, state, profile['historyId'])
+            else:
+                history_id = self._sync_full(service, state, profile['historyId'])
+
+            self._collect(self._in_flight)
+
+        # Messages that failed to fetch would be lost by moving the checkpoint past them
+        if not self._fetch_failures:
+            self._save_checkpoint(state, history_id)
+        self._commit()
+        if self.stats.fetched:
+            logger.info(
+                "Received %d bytes from Gmail for %s, %.0f per message",
+                self.stats.bytes_received, account, self.stats.bytes_per_message
+            )
+        return self.stats
+
+    def _resume_full(self, service, state: SyncState, history_id: str) -> str:
+        """Continues an interrupted full listing, starting over if Gmail rejects its page token."""
+        logger.info("Resuming the full listing of %s", state.account)
+        try:
+            return self._sync_full(service, state, state.listing_history_id, state.listing_page_token)
+        except HttpError as e:
+            if e.resp.status != 400 or self._listed_pages:
+                raise
+            logger.warning("Stored page token for %s was rejected, listing from the start: %s", state.account, e)
+            state.listing_page_token = None
+            return self._sync_full(service, state, history_id)
+
+    def _sync_full(self, service, state: SyncState, history_id: str, page_token: str = None) -> str:
+        """Lists every message from ``page_token``, queueing unseen ones, and returns the checkpoint to store.
+
+        The checkpoint is the historyId read before listing began, so changes
+        made while the listing runs are picked up by the next incremental sync.
+        """
+        self.stats.mode = 'resumed' if page_token else 'full'
+        state.listing_history_id = history_id
+        self._listing = state
+
+        while True:
+            results = self._execute(
+                service.users().messages().list(
+                    userId='me',
+                    pageToken=page_token,
+                    maxResults=LIST_PAGE_SIZE,
+                    fields=LIST_FIELDS,
+                    prettyPrint=False
+                ),
+                'messages.list'
+            )
+
+            messages = results.get('messages', [])
+            self.stats.listed += len(messages)
+            page = self._listed_pages
+            self._queue((message['id'] for message in messages), page)
+            page_token = results.get('nextPageToken')
+            self._next_tokens[page] = page_token
+            self._listed_pages += 1
+            self._advance_listing()
+            self._commit()
+
+            if not page_token:
+                return history_id
+
+    def _sync_history(self, service, start_history_id: str) -> str:
+        """Applies messages added or deleted since ``start_history_id``.
+
+        Raises ``HttpError`` 404 when the start ID is too old to replay.
+        """
+        self.stats.mode = 'incremental'
+        added = {}
+        deleted = set()
+        page_token = None
+
+        while True:
+            results = self._execute(
+                service.users().history().list(
+                    userId='me',
+                    startHistoryId=start_history_id,
+                    historyTypes=['messageAdded', 'messageDeleted'],
+                    pageToken=page_token,
+                    maxResults=LIST_PAGE_SIZE,
+                    fields=HISTORY_FIELDS,
+                    prettyPrint=False
+                ),
+                'history.list'
+            )
+
+            # Records arrive oldest first, so a later deletion cancels an earlier add
+            for record in results.get('history', []):
+                for change in record.get('messagesAdded', []):
+                    message = change['message']
+                    if SKIPPED_LABELS.isdisjoint(message.get('labelIds', [])):
+                        added[message['id']] = True
+                        deleted.discard(message['id'])
+                for change in record.get('messagesDeleted', []):
+                    added.pop(change['message']['id'], None)
+                    deleted.add(change['message']['id'])
+
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+        self.stats.listed += len(added)
+        self.stats.deleted += self.ingest.delete_messages(deleted)
+        self._commit()
+        self._queue(added)
+        self._commit()
+        return results['historyId']
+
+    def _queue(self, message_ids, page: int = None):
+        """Dedups IDs against the database and submits the new ones in batches.
+
+        ``page`` is the number of the full listing page the IDs came from.
+        """
+        message_ids = list(message_ids)
+        new_ids = self.ingest.new_ids(message_ids)
+        self._release()
+        self.stats.skipped += len(message_ids) - len(new_ids)
+
+        for batch_ids in chunked(new_ids, self.batch_size):
+            # Backpressure: stop listing until a batch slot frees up
+            while len(self._in_flight) >= self.max_in_flight:
+                self._collect(self._in_flight, FIRST_COMPLETED)
+            self._in_flight[self._executor.submit(self._fetch_batch, batch_ids)] = (batch_ids, page)
+            if page is not None:
+                self._page_batches[page] = self._page_batches.get(page, 0) + 1
+
+    def _advance_listing(self):
+        """Moves the stored listing position past the leading pages whose messages are all stored.
+
+        Batches finish out of order, so the position only passes a page
+        once every page before it has finished too; a page with messages
+        that failed to fetch holds it back, to be listed again next run.
+        It is committed along with the messages it covers.
+        """
+        state = self._listing
+        if state is None:
+            return
+        page = self._stored_pages
+        while page in self._next_tokens and not self._page_batches.get(page) and page not in self._failed_pages:
+            state.listing_page_token = self._next_tokens.pop(page)
+            state.updated_at = datetime.utcnow()
+            page += 1
+        self._stored_pages = page
+
+    def _save_checkpoint(self, state: SyncState, history_id: str):
+        state.history_id = history_id
+        state.listing_page_token = None
+        state.listing_history_id = None
+        state.updated_at = datetime.utcnow()
+
+    def _collect(self, in_flight, return_when=ALL_COMPLETED):
+        """Stores the results of finished batches and returns the unfinished ones."""
+        done, _ = wait(in_flight, return_when=return_when)
+        for future in done:
+            batch_ids, page = in_flight.pop(future)
+            if page is not None:
+                self._page_batches[page] -= 1
+            try:
+                messages, failed = future.result()
+            except Exception as e:
+                logger.error("Error fetching batch of %d messages: %s", len(batch_ids), e)
+                messages, failed = [], batch_ids
+
+            self.stats.fetched += len(messages)
+            self.stats.errors += len(failed)
+            self._fetch_failures += len(failed)
+            if failed and page is not None:
+                self._failed_pages.add(page)
+            rows, unparsed = self.gmail_service.parse_messages(messages)
+            self.stats.errors += len(unparsed)
+            self._rows.extend(rows)
+        self._advance_listing()
+        return in_flight
+
+    def _release(self):
+        """Ends the transaction reads began, so the write lock is not held while waiting on Gmail."""
+        self.db.commit()
+
+    def _commit(self):
+        """Stores the buffered messages, commits, and reports progress."""
+        rows, self._rows = self._rows, []
+        try:
+            inserted = self.ingest.insert_messages(rows)
+            self.db.commit()
+        except Exception as e:
+            self.db.rollback()
+            logger.error("Error storing %d messages: %s", len(rows), e)
+            # The rolled back messages are as good as never fetched, so
+            # neither checkpoint may move past them
+            self.stats.errors += len(rows)
+            self._fetch_failures += 1
+            self._failed_pages.add(self._stored_pages)
+        else:
+            self.stats.inserted += inserted
+            changes = (self.stats.inserted, self.stats.deleted)
+            if changes != self._committed_changes:
+                self._committed_changes = changes
+                self.on_commit()
+
+        self.stats.bytes_received = self.transfer.bytes - self._bytes_at_start
+        if self.on_progress:
+            self.on_progress(self.stats)
+
+    def _execute(self, request, method: str):
+        """Executes one API call within the quota, retrying it on 429/5xx."""
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(QUOTA_UNITS[method])
+            try:
+                response = request.execute()
+            except HttpError as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                if is_rate_limited(e):
+                    self.limiter.throttled()
+                delay = backoff_delay(attempt, e)
+                logger.info("%s failed with %s, retrying in %.1fs", method, e.resp.status, delay)
+                time.sleep(delay)
+            else:
+                self.limiter.succeeded()
+                return response
+
+    def _fetch_batch(self, message_ids):
+        """Fetches one batch of messages, retrying calls rejected with 429/5xx.
+
+        Returns the fetched message resources and the IDs that could not be
+        fetched.
+        """
+        service = self.service_factory()
+        fetched = []
+        failed = []
+        pending = list(message_ids)
+
+        for attempt in range(self.max_retries + 1):
+            retry = []
+            throttled = []
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    fetched.append(response)
+                elif is_retryable(exception):
+                    retry.append(request_id)
+                    if is_rate_limited(exception):
+                        throttled.append(exception)
+                else:
+                    logger.warning("Error fetching message %s: %s", request_id, exception)
+                    failed.append(request_id)
+
+            batch = service.new_batch_http_request(callback=callback)
+            for message_id in pending:
+                batch.add(
+                    service.users().messages().get(
+                        userId='me',
+                        id=message_id,
+                        format='metadata',
+                        metadataHeaders=METADATA_HEADERS,
+                        fields=MESSAGE_FIELDS,
+                        prettyPrint=False
+                    ),
+                    request_id=message_id
+                )
+
+            self.limiter.acquire(QUOTA_UNITS['messages.get'] * len(pending))
+            try:
+                batch.execute()
+            except HttpError as e:
+                if not is_retryable(e):
+                    raise
+                # The whole batch was rejected before any call ran
+                retry = pending
+                if is_rate_limited(e):
+                    throttled.append(e)
+
+            if throttled:
+                self.limiter.throttled()
+            else:
+                self.limiter.succeeded()
+            pending = retry
+            if not pending:
+                break
+            if attempt < self.max_retries:
+                time.sleep(backoff_delay(attempt, throttled[0] if throttled else None))
+
+        if pending:
+            logger.warning("Giving up on %d messages after %d retries", len(pending), self.max_retries)
+        return fetched, failed + pending
@@ -0,0 +1,93 @@
+"""Benchmark of the SQL and columnar analytics engines, run as ``python -m bench.analytics``.
+
+Builds a throwaway SQLite database holding a synthetic mailbox, then times top senders and domains over date
+ranges, grouped in SQL, scanned from the in-memory columnar snapshot and
+estimated from the sketches, with the sketches' distinct count error.
+Unbounded requests are always read from the aggregate tables, so the
+widest case is a range that covers every date.
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from datetime import date
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from app.database import Base
+from app.services.analytics import AnalyticsService
+from app.services.columnar import ColumnarSnapshot, np
+from app.services.sketches import DISTINCT_ERROR
+from .mailbox import SyntheticMailbox, populate
+
+ACCOUNTS = 3
+# Relative error accepted from the sketches
+MAX_ERROR = 0.05
+
+
+def build_database(url, messages):
+    engine = create_engine(url)
+    Base.metadata.create_all(bind=engine)
+    populate(engine, SyntheticMailbox(messages), ACCOUNTS)
+    return engine
+
+
+def measure(compute, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        compute()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args(argv)
+    if np is None:
+        parser.error("the columnar engine requires numpy")
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        started = time.perf_counter()
+        engine = build_database(url, args.messages)
+        print(f"built {args.messages:,} messages in {time.perf_counter() - started:.1f}s")
+
+        with Session(engine) as db:
+            snapshot = ColumnarSnapshot()
+            started = time.perf_counter()
+            snapshot.refresh(db)
+            print(f"loaded snapshot in {time.perf_counter() - started:.1f}s")
+
+            sql = AnalyticsService(db, None)
+            columnar = AnalyticsService(db, snapshot)
+            cases = [
+                # A range, however wide, is what the totals tables cannot answer
+                ('every date', None, date(1970, 1, 1), None),
+                ('one year', None, date(2023, 1, 1), date(2023, 12, 31)),
+                ('one year, one account', 2, date(2023, 1, 1), date(2023, 12, 31)),
+                ('one month', None, date(2023, 6, 1), date(2023, 6, 30)),
+                ('since a year ago', None, date(2023, 12, 31), None),
+            ]
+            print(f"sketch distinct counts have {DISTINCT_ERROR:.2%} relative standard error")
+            print(
+                f"{'range':>22} {'sql ms':>10} {'columnar ms':>12} {'speedup':>8} {'sketch ms':>10} {'speedup':>8}"
+                f" {'senders':>8} {'estimate':>9}"
+            )
+            for label, account_id, start, end in cases:
+                sql_ms = measure(lambda: sql.get_analytics(account_id, start, end), args.repeat)
+                columnar_ms = measure(lambda: columnar.get_analytics(account_id, start, end), args.repeat)
+                sketch_ms = measure(lambda: sql.get_analytics(account_id, start, end, MAX_ERROR), args.repeat)
+                exact = sql.get_analytics(account_id, start, end).distinct_senders
+                estimate = sql.get_analytics(account_id, start, end, MAX_ERROR).distinct_senders
+                print(
+                    f"{label:>22} {sql_ms:10.1f} {columnar_ms:12.1f} {sql_ms / columnar_ms:7.1f}x"
+                    f" {sketch_ms:10.1f} {sql_ms / sketch_ms:7.1f}x {exact:8} {estimate:9}"
+                )
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+"""A local stand-in for the Gmail API client, serving a synthetic mailbox.
+
+Implements the calls sync makes: ``getProfile``, ``messages().list``,
+``messages().get``, ``history().list`` and batch requests. Every HTTP
+round trip sleeps ``latency`` seconds, plus ``call_latency`` per call in
+a batch, and calls are charged Gmail quota units against a per-user
+token bucket of ``quota_per_second``. Calls over quota fail with 429
+like Gmail's ``rateLimitExceeded``.
+
+Responses honour the ``fields`` partial-response mask and
+``prettyPrint``, and the size of the JSON Gmail would have sent for
+each is added to ``transfer``.
+"""
+import json
+import threading
+import time
+import httplib2
+from googleapiclient.errors import HttpError
+from app.services.gmail import TransferCounter
+from app.services.quota import QUOTA_UNITS
+from .mailbox import SyntheticMailbox
+
+# Gmail's per-user rate limit, in quota units
+GMAIL_QUOTA_PER_SECOND = 250
+MAX_BATCH_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+def http_error(status: int, reason: str) -> HttpError:
+    return HttpError(httplib2.Response({'status': status, 'reason': reason}), reason.encode())
+
+
+def parse_fields(fields: str) -> dict:
+    """Parses a ``fields`` mask, like ``a,b/c,d(e,f)``, into {name: sub-mask, or None for all of it}."""
+    mask, rest = _parse_field_list(fields.replace(' ', ''))
+    if rest:
+        raise http_error(400, 'Invalid field selection')
+    return mask
+
+
+def _parse_field_list(text: str):
+    mask = {}
+    while True:
+        item, text = _parse_field(text)
+        _merge_fields(mask, item)
+        if not text.startswith(','):
+            return mask, text
+        text = text[1:]
+
+
+def _parse_field(text: str):
+    end = next((i for i, char in enumerate(text) if char in ',/()'), len(text))
+    name, text = text[:end], text[end:]
+    if not name:
+        raise http_error(400, 'Invalid field selection')
+    sub = None
+    if text.startswith('/'):
+        sub, text = _parse_field(text[1:])
+    elif text.startswith('('):
+        sub, text = _parse_field_list(text[1:])
+        if not text.startswith(')'):
+            raise http_error(400, 'Invalid field selection')
+        text = text[1:]
+    return {name: sub}, text
+
+
+def _merge_fields(mask: dict, item: dict):
+    for name, sub in item.items():
+        if name not in mask:
+            mask[name] = sub
+        elif mask[name] is None or sub is None:
+            mask[name] = None
+        else:
+            _merge_fields(mask[name], sub)
+
+
+def select_fields(value, mask):
+    """The parts of ``value`` that ``mask`` selects, applied to each element of lists."""
+    if mask is None:
+        return value
+    if isinstance(value, list):
+        return [select_fields(element, mask) for element in value]
+    if not isinstance(value, dict):
+        return value
+    return {name: select_fields(value[name], sub) for name, sub in mask.items() if name in value}
+
+
+class FakeGmail:
+    """Thread-safe fake Gmail client; one instance serves every sync thread.
+
+    Records each round trip's duration in ``round_trips`` and counts
+    ``requests``, ``calls`` and ``throttled`` calls, and response bytes
+    in ``transfer``.
+    """
+
+    def __init__(
+        self,
+        mailbox: SyntheticMailbox,
+        email: str = 'bench@example.com',
+        latency: float = 0.0,
+        call_latency: float = 0.0,
+        quota_per_second: float = None,
+    ):
+        self.mailbox = mailbox
+        self.email = email
+        self.latency = latency
+        self.call_latency = call_latency
+        self.quota_per_second = quota_per_second
+        self.history_id = str(mailbox.size)
+        self.requests = 0
+        self.calls = 0
+        self.throttled = 0
+        self.round_trips = []
+        self.transfer = TransferCounter()
+        self._lock = threading.Lock()
+        self._tokens = quota_per_second or 0
+        self._refilled_at = time.monotonic()
+
+    def service_factory(self):
+        return lambda: self
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return _Messages(self)
+
+    def history(self):
+        return _History(self)
+
+    def getProfile(self, userId, **kwargs):
+        return _Request(self, 'getProfile', lambda: {
+            'emailAddress': self.email,
+            'messagesTotal': self.mailbox.size,
+            'threadsTotal': self.mailbox.size,
+            'historyId': self.history_id,
+        }, **kwargs)
+
+    def new_batch_http_request(self, callback=None):
+        return _Batch(self, callback)
+
+    def _round_trip(self, calls: int):
+        started = time.perf_counter()
+        delay = self.latency + self.call_latency * calls
+        if delay:
+            time.sleep(delay)
+        with self._lock:
+            self.requests += 1
+            self.calls += calls
+            self.round_trips.append(time.perf_counter() - started)
+
+    def _take_quota(self, units: int) -> bool:
+        """Spends ``units`` from the token bucket, returning False if it holds too few."""
+        if not self.quota_per_second:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.quota_per_second,
+                self._tokens + (now - self._refilled_at) * self.quota_per_second
+            )
+            self._refilled_at = now
+            if self._tokens < units:
+                self.throttled += 1
+                return False
+            self._tokens -= units
+            return True
+
+
+class _Request:
+    def __init__(self, gmail: FakeGmail, method: str, respond, fields: str = None, prettyPrint: bool = True, **kwargs):
+        self.gmail = gmail
+        self.method = method
+        self.respond = respond
+        self.mask = parse_fields(fields) if fields else None
+        self.pretty = prettyPrint
+
+    def call(self):
+        """Runs the call as part of a batch, which has already paid the round trip."""
+        if not self.gmail._take_quota(QUOTA_UNITS[self.method]):
+            raise http_error(429, 'Rate Limit Exceeded')
+        response = select_fields(self.respond(), self.mask)
+        # Gmail indents with two spaces unless told not to
+        body = json.dumps(response, indent=2 if self.pretty else None, separators=None if self.pretty else (',', ':'))
+        self.gmail.transfer.add(len(body.encode()))
+        return response
+
+    def execute(self, **kwargs):
+        self.gmail._round_trip(1)
+        return self.call()
+
+
+class _Batch:
+    def __init__(self, gmail: FakeGmail, callback):
+        self.gmail = gmail
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request, callback or self.callback, request_id or str(len(self.requests))))
+
+    def execute(self, http=None):
+        if len(self.requests) > MAX_BATCH_SIZE:
+            raise http_error(400, 'Too many requests in batch')
+        self.gmail._round_trip(len(self.requests))
+        for request, callback, request_id in self.requests:
+            try:
+                response = request.call()
+            except HttpError as e:
+                callback(request_id, None, e)
+            else:
+                callback(request_id, response, None)
+
+
+class _Messages:
+    def __init__(self, gmail: FakeGmail):
+        self.gmail = gmail
+
+    def list(self, userId, pageToken=None, maxResults=100, **kwargs):
+        mailbox = self.gmail.mailbox
+        start = int(pageToken or 0)
+        end = min(start + min(maxResults, MAX_PAGE_SIZE), mailbox.size)
+
+        def respond():
+            # Newest first, like Gmail
+            page = {'messages': [
+                {'id': message_id, 'threadId': message_id}
+                for message_id in map(mailbox.message_id, range(mailbox.size - 1 - start, mailbox.size - 1 - end, -1))
+            ]}
+            if end < mailbox.size:
+                page['nextPageToken'] = str(end)
+            page['resultSizeEstimate'] = end - start
+            return page
+
+        return _Request(self.gmail, 'messages.list', respond, **kwargs)
+
+    def get(self, userId, id, **kwargs):
+        mailbox = self.gmail.mailbox
+
+        def respond():
+            index = mailbox.index_of(id)
+            if not 0 <= index < mailbox.size:
+                raise http_error(404, 'Not Found')
+            return mailbox.message(index)
+
+        return _Request(self.gmail, 'messages.get', respond, **kwargs)
+
+
+class _History:
+    def __init__(self, gmail: FakeGmail):
+        self.gmail = gmail
+
+    def list(self, userId, startHistoryId, **kwargs):
+        # The synthetic mailbox never changes after it is generated
+        return _Request(self.gmail, 'history.list', lambda: {'historyId': self.gmail.history_id}, **kwargs)
@@ -0,0 +1,157 @@
+"""Reproducible synthetic mailboxes for the benchmarks.
+
+Senders follow a Zipf distribution, as in real mailboxes, where a few
+newsletters and notification services account for most messages, and
+so do the domains senders are drawn from. Messages are generated on
+demand from a compact per-message index, so a 5M message mailbox costs
+a few tens of MB until it is materialized.
+"""
+import email.utils
+import random
+from array import array
+from datetime import datetime, timedelta, timezone
+from email.header import Header
+from itertools import accumulate
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+from app.models import Account, EmailMessage
+from app.services.dimensions import dimensions_for
+from app.services.gmail import parse_sender
+from app.services.sketches import SketchService
+from app.services.stats import StatsService
+
+START = datetime(2020, 1, 1)
+DAYS = 5 * 365
+INSERT_BATCH_SIZE = 10000
+NAMES = ['Alice Example', 'Newsletter', 'Doe, John', 'Støre Team', 'no-reply', 'Billing', 'GitHub']
+SUBJECTS = [
+    'Your weekly digest', 'Order confirmation', 'Re: lunch?', 'Invitation',
+    'Security alert', '[project] New pull request', 'Receipt for your payment',
+]
+# Gmail snippets are the start of the body, up to about 200 characters
+SNIPPET = (
+    "Hi there, here is a quick summary of what happened since we last wrote. "
+    "Read the full message online, or manage your email preferences at any time"
+)
+
+
+def zipf_cum_weights(count: int, exponent: float):
+    return list(accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+class SyntheticMailbox:
+    """``size`` messages from Zipf-distributed senders, spread over five years.
+
+    Message ``i`` is the ``i``-th oldest; IDs increase with age like
+    Gmail's, and ``ids()`` lists them newest first, as ``messages().list``
+    does. The same ``seed`` always produces the same mailbox.
+    """
+
+    def __init__(self, size: int, seed: int = 0, senders: int = None, domains: int = None, exponent: float = 1.1):
+        rng = random.Random(seed)
+        # Distinct senders grow sublinearly with mailbox size
+        senders = senders or max(50, int(size ** 0.75))
+        domains = domains or max(10, senders // 8)
+
+        domain_names = [f"{rng.choice(['mail', 'news', 'corp', 'shop'])}{rank}.example.com" for rank in range(domains)]
+        domain_of = rng.choices(range(domains), cum_weights=zipf_cum_weights(domains, exponent), k=senders)
+        # (From header, and the name, address and domain parsed from it) per sender rank
+        self.senders = []
+        for rank in range(senders):
+            address = f"user{rank}@{domain_names[domain_of[rank]]}"
+            name = rng.choice(NAMES)
+            header = rng.choice([
+                f'"{name}" <{address}>',
+                f'{Header(name, "utf-8").encode()} <{address.upper()}>',
+                address,
+                f'{address} ({name})',
+            ])
+            self.senders.append((header,) + parse_sender(header))
+
+        self.size = size
+        self.sender_of = array('i', rng.choices(range(senders), cum_weights=zipf_cum_weights(senders, exponent), k=size))
+        offsets = sorted(rng.randrange(DAYS * 86400) for _ in range(size))
+        self.timestamps = array('q', offsets)
+        self.subject_seed = seed
+
+    def message_id(self, index: int) -> str:
+        return f"{0x18000000000 + index:016x}"
+
+    def ids(self):
+        """Message IDs, newest first."""
+        return [self.message_id(index) for index in range(self.size - 1, -1, -1)]
+
+    def index_of(self, message_id: str) -> int:
+        return int(message_id, 16) - 0x18000000000
+
+    def received_date(self, index: int) -> datetime:
+        return START + timedelta(seconds=self.timestamps[index])
+
+    def subject(self, index: int) -> str:
+        return f"{SUBJECTS[(index * 7 + self.subject_seed) % len(SUBJECTS)]} #{index % 1000}"
+
+    def message(self, index: int) -> dict:
+        """The ``format=metadata`` Gmail resource of message ``index``, with every field Gmail returns."""
+        sender = self.senders[self.sender_of[index]][0]
+        received = self.received_date(index).replace(tzinfo=timezone.utc)
+        return {
+            'id': self.message_id(index),
+            'threadId': self.message_id(index),
+            'labelIds': ['UNREAD', 'CATEGORY_UPDATES', 'INBOX'],
+            'snippet': SNIPPET,
+            'sizeEstimate': 20000 + index % 40000,
+            'historyId': str(1000 + index),
+            'internalDate': str(int(received.timestamp() * 1000)),
+            'payload': {
+                'partId': '',
+                'mimeType': 'multipart/alternative',
+                'filename': '',
+                'headers': [
+                    {'name': 'From', 'value': sender},
+                    {'name': 'Subject', 'value': self.subject(index)},
+                    {'name': 'Date', 'value': email.utils.format_datetime(received)},
+                ],
+                'body': {'size': 0},
+            },
+        }
+
+    def row(self, index: int, account_id: int = 1) -> dict:
+        """The parsed row sync would store for message ``index``, before its sender is interned."""
+        _, name, address, domain = self.senders[self.sender_of[index]]
+        return {
+            'account_id': account_id,
+            'id': self.message_id(index),
+            'sender_name': name,
+            'sender_email': address,
+            'sender_domain': domain,
+            'subject': self.subject(index),
+            'received_date': self.received_date(index),
+        }
+
+
+def populate(engine, mailbox: SyntheticMailbox, accounts: int = 1):
+    """Stores the mailbox in ``engine``'s database, round-robin across ``accounts``, and builds the stats and sketches.
+
+    The tables must already exist; accounts 1 to ``accounts`` are created
+    if missing.
+    """
+    with Session(engine) as db:
+        existing = set(db.scalars(select(Account.id)))
+        for account_id in range(1, accounts + 1):
+            if account_id not in existing:
+                db.add(Account(
+                    id=account_id,
+                    email=f"account{account_id}@example.com",
+                    token_file='',
+                    created_at=datetime.utcnow()
+                ))
+        db.flush()
+        dimensions = dimensions_for(db)
+        for start in range(0, mailbox.size, INSERT_BATCH_SIZE):
+            db.execute(insert(EmailMessage), dimensions.encode(db, [
+                mailbox.row(index, 1 + index % accounts)
+                for index in range(start, min(start + INSERT_BATCH_SIZE, mailbox.size))
+            ]))
+        StatsService(db).rebuild()
+        SketchService(db).rebuild()
+        db.commit()
@@ -0,0 +1,91 @@
+"""Microbenchmark for header parsing, run as ``python -m bench.parse_message``.
+
+Compares the previous three-scan parser against ``parse_messages`` on a
+synthetic corpus of Gmail metadata resources.
+"""
+import argparse
+import email.utils
+import random
+import time
+from app.services.gmail import parse_messages
+
+NAMES = ['Alice Example', 'Newsletter', 'Doe, John', 'Støre Team', 'no-reply']
+DOMAINS = ['example.com', 'News.Example.org', 'mail.shop.co.uk', 'substack.com']
+SUBJECTS = ['Your weekly digest', 'Order confirmation', 'Re: lunch?', 'Invitation']
+
+
+def synthetic_messages(count, seed=0):
+    rng = random.Random(seed)
+    senders = []
+    for i in range(2000):
+        name = rng.choice(NAMES)
+        address = f"user{i}@{rng.choice(DOMAINS)}"
+        senders.append(rng.choice([
+            f'"{name}" <{address}>',
+            f'{name} <{address}>',
+            address,
+            f'{address} ({name})',
+        ]))
+    # Skewed, like real mailboxes: a few senders account for most messages
+    weights = [1 / (rank + 1) for rank in range(len(senders))]
+    chosen = rng.choices(senders, weights=weights, k=count)
+    base = 1_600_000_000
+    return [
+        {
+            'id': f'{i:016x}',
+            'payload': {'headers': [
+                {'name': 'Date', 'value': email.utils.formatdate(base + i * 37)},
+                {'name': 'Subject', 'value': rng.choice(SUBJECTS)},
+                {'name': 'From', 'value': sender},
+            ]},
+        }
+        for i, sender in enumerate(chosen)
+    ]
+
+
+def legacy_parse(msg_data):
+    headers = msg_data['payload']['headers']
+    from_header = next((h for h in headers if h['name'] == 'From'), None)
+    subject_header = next((h for h in headers if h['name'] == 'Subject'), None)
+    date_header = next((h for h in headers if h['name'] == 'Date'), None)
+    if from_header:
+        sender = from_header['value']
+        sender_email = sender.split('<')[-1].strip('>')
+        received_date = None
+        if date_header:
+            try:
+                received_date = email.utils.parsedate_to_datetime(date_header['value'])
+            except Exception:
+                received_date = None
+        return dict(
+            id=msg_data['id'],
+            sender_name=sender.split('<')[0].strip().strip('"'),
+            sender_email=sender_email,
+            sender_domain=sender_email.split('@')[-1],
+            subject=subject_header['value'] if subject_header else None,
+            received_date=received_date
+        )
+    return None
+
+
+def measure(label, parse, messages):
+    started = time.perf_counter()
+    parse(messages)
+    elapsed = time.perf_counter() - started
+    print(f"{label:>8}: {len(messages) / elapsed:12,.0f} messages/sec ({elapsed:.2f}s)")
+    return elapsed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    args = parser.parse_args(argv)
+
+    messages = synthetic_messages(args.messages)
+    legacy = measure('legacy', lambda batch: [legacy_parse(m) for m in batch], messages)
+    current = measure('current', parse_messages, messages)
+    print(f" speedup: {legacy / current:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""Benchmark of building and encoding ``/api/emails`` pages, run as ``python -m bench.serialization``.
+
+Builds a throwaway SQLite database holding a synthetic mailbox, then
+times, per page of 100 emails, the handler building the response body
+and its encoding to JSON: as the response cache encodes it, and with
+``jsonable_encoder`` and ``json.dumps``, FastAPI's default, for
+comparison. Frequency pages hold 10 groups of 10 emails each.
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from app.api.routes import list_emails
+from app.migrations import migrate
+from app.serialization import encode_json, orjson
+from app.services.search import ensure_search_index
+from .mailbox import SyntheticMailbox, populate
+
+# (label, sort_by, search, page_size, emails_per_group)
+CASES = [
+    ('by date', 'date', None, 100, 0),
+    ('search by date', 'date', 'digest', 100, 0),
+    ('by sender frequency', 'sender_frequency', None, 10, 10),
+    ('by domain frequency', 'domain_frequency', None, 10, 10),
+]
+
+
+def measure(compute, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        compute()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings) * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        migrate(engine)
+        populate(engine, SyntheticMailbox(args.messages), 1)
+        ensure_search_index(engine)
+        print(f"encoding with {'orjson' if orjson is not None else 'json'}")
+
+        with Session(engine) as db:
+            print(f"{'page':>22} {'build ms':>10} {'encode ms':>10} {'default ms':>11} {'KB':>6}")
+            for label, sort_by, search, page_size, emails_per_group in CASES:
+                def build():
+                    return list_emails(db, 1, page_size, search, None, sort_by, emails_per_group, None, True)
+
+                body = build()
+                build_ms = measure(build, args.repeat)
+                encode_ms = measure(lambda: encode_json(body), args.repeat)
+                default_ms = measure(lambda: json.dumps(jsonable_encoder(body)).encode(), args.repeat)
+                size = len(encode_json(body)) / 1024
+                print(f"{label:>22} {build_ms:10.2f} {encode_ms:10.3f} {default_ms:11.3f} {size:6.1f}")
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+"""Benchmark suite for the hot paths, run as ``python -m bench.suite``.
+
+Measures header parsing, a full sync against the fake Gmail service,
+and each read endpoint over a synthetic mailbox, reporting throughput
+and p50/p95/p99 latency. Results are written as JSON; pass an earlier
+run's file as ``--compare`` to diff against it, e.g.::
+
+    python -m bench.suite --messages 100000 --output before.json
+    python -m bench.suite --messages 100000 --output after.json --compare before.json
+
+Responses are not cached unless ``--cache`` is given, so every request
+reaches the database.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# (name, path) of each endpoint benchmark; {sender} is the busiest sender
+ENDPOINTS = [
+    ('emails, by domain frequency', '/api/emails?sort_by=domain_frequency'),
+    ('emails, by sender frequency', '/api/emails?sort_by=sender_frequency'),
+    ('emails, by date', '/api/emails?sort_by=date'),
+    ('emails, by date without total', '/api/emails?sort_by=date&include_total=false'),
+    ('emails, search by date', '/api/emails?sort_by=date&search=digest'),
+    ('emails, search by relevance', '/api/emails?sort_by=relevance&search=digest'),
+    ('emails, after date', '/api/emails?sort_by=sender_frequency&after_date=2024-01-01'),
+    ('sender group', '/api/emails/group/sender/{sender}'),
+    ('analytics', '/api/analytics'),
+    ('analytics, one year', '/api/analytics?start=2023-01-01&end=2023-12-31'),
+    ('timeseries, monthly', '/api/analytics/timeseries?bucket=month'),
+    ('timeseries, sender weekly', '/api/analytics/timeseries?bucket=week&sender={sender}'),
+]
+PARSE_BATCH_SIZE = 100
+WARMUP_REQUESTS = 2
+# Metrics compared between runs, with whether a higher value is better
+COMPARED_METRICS = (('throughput', True), ('p50_ms', False), ('p95_ms', False), ('p99_ms', False))
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, round(fraction * len(sorted_values) + 0.5))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(unit: str, count: int, seconds: float, latencies) -> dict:
+    """Throughput of ``count`` units over ``seconds``, with latency percentiles in milliseconds."""
+    latencies = sorted(latencies)
+    return {
+        'unit': unit,
+        'count': count,
+        'seconds': round(seconds, 4),
+        'throughput': round(count / seconds, 2) if seconds else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def bench_parse(mailbox) -> dict:
+    from app.services.gmail import parse_messages, parse_sender
+
+    messages = [mailbox.message(index) for index in range(mailbox.size)]
+    parse_sender.cache_clear()
+    latencies = []
+    started = time.perf_counter()
+    for start in range(0, len(messages), PARSE_BATCH_SIZE):
+        batch_started = time.perf_counter()
+        parse_messages(messages[start:start + PARSE_BATCH_SIZE])
+        latencies.append(time.perf_counter() - batch_started)
+    return summarize('messages', len(messages), time.perf_counter() - started, latencies)
+
+
+def bench_sync(mailbox, directory: str, args) -> dict:
+    """Fully syncs ``mailbox`` from the fake Gmail into a fresh database; latencies are Gmail round trips."""
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+    from app.database import tune_engine
+    from app.migrations import migrate
+    from app.services.search import ensure_search_index
+    from app.services.sync import SyncService
+    from .fake_gmail import FakeGmail
+
+    engine = tune_engine(create_engine(f"sqlite:///{os.path.join(directory, 'sync.db')}"))
+    migrate(engine)
+    ensure_search_index(engine)
+    gmail = FakeGmail(mailbox, latency=args.latency, call_latency=args.call_latency, quota_per_second=args.quota)
+    client_quota = args.quota if args.client_quota is None else args.client_quota
+    with Session(engine) as db:
+        started = time.perf_counter()
+        sync = SyncService(
+            db, 1,
+            service_factory=gmail.service_factory(),
+            quota_units_per_second=client_quota or 0,
+            on_commit=lambda: None,
+            transfer=gmail.transfer,
+        )
+        stats = sync.run(full=True)
+        seconds = time.perf_counter() - started
+    engine.dispose()
+
+    result = summarize('messages', stats.inserted, seconds, gmail.round_trips)
+    result.update(
+        requests=gmail.requests, throttled=gmail.throttled, errors=stats.errors,
+        quota_wait_s=round(sync.limiter.waited, 2), bytes_per_message=round(stats.bytes_per_message, 1),
+    )
+    return result
+
+
+def bench_endpoints(args) -> dict:
+    """Times each endpoint over the mailbox stored at DATABASE_URL."""
+    from fastapi.testclient import TestClient
+    from sqlalchemy import select
+    from app.database import SessionLocal
+    from app.main import app
+    from app.models import ALL_ACCOUNTS, Sender, SenderStat
+
+    with SessionLocal() as db:
+        sender = db.scalar(
+            select(Sender.email)
+            .join(SenderStat, SenderStat.sender_id == Sender.id)
+            .where(SenderStat.account_id == ALL_ACCOUNTS)
+            .order_by(SenderStat.count.desc())
+            .limit(1)
+        )
+
+    results = {}
+    with TestClient(app) as client:
+        for name, path in ENDPOINTS:
+            path = path.format(sender=sender)
+            for _ in range(WARMUP_REQUESTS):
+                client.get(path).raise_for_status()
+            latencies = []
+            for _ in range(args.requests):
+                started = time.perf_counter()
+                client.get(path).raise_for_status()
+                latencies.append(time.perf_counter() - started)
+            results[f"GET {name}"] = dict(summarize('requests', len(latencies), sum(latencies), latencies), path=path)
+    return results
+
+
+def metadata(args) -> dict:
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'started_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'arguments': vars(args),
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Prints each metric's change from the baseline and returns the regressions beyond ``threshold``."""
+    regressions = []
+    print(f"\n{'benchmark':<42} {'metric':<10} {'baseline':>12} {'current':>12} {'change':>8}")
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS:
+            old, new = previous[metric], result[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            flag = ' !' if worse > threshold else ''
+            if flag:
+                regressions.append(f"{name} {metric}")
+            print(f"{name:<42} {metric:<10} {old:12.2f} {new:12.2f} {change:+7.1%}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=100_000, help="mailbox size for the read endpoints")
+    parser.add_argument('--sync-messages', type=int, default=20_000, help="mailbox size for the sync benchmark")
+    parser.add_argument('--accounts', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=50, help="timed requests per endpoint")
+    parser.add_argument('--latency', type=float, default=0.02, help="fake Gmail round trip, in seconds")
+    parser.add_argument('--call-latency', type=float, default=0.001, help="fake Gmail time per batched call")
+    parser.add_argument('--quota', type=float, default=None, help="quota units per second; Gmail allows 250 per user")
+    parser.add_argument(
+        '--client-quota', type=float, default=None,
+        help="units per second sync paces itself to; defaults to --quota, 0 disables pacing"
+    )
+    parser.add_argument('--only', nargs='+', choices=('parse', 'sync', 'endpoints'), default=('parse', 'sync', 'endpoints'))
+    parser.add_argument('--cache', action='store_true', help="serve repeated requests from the response cache")
+    parser.add_argument('--output', default='bench-results.json')
+    parser.add_argument('--compare', metavar='BASELINE', help="results file of an earlier run")
+    parser.add_argument('--threshold', type=float, default=0.10, help="relative change reported as a regression")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        # The app reads its settings when first imported, so point it at the
+        # benchmark database before importing anything from it
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+        if not args.cache:
+            os.environ['RESPONSE_CACHE_SIZE'] = '0'
+        from app.database import writer_engine
+        from app.migrations import migrate
+        from app.services.search import ensure_search_index
+        from .mailbox import SyntheticMailbox, populate
+
+        results = {}
+        if 'parse' in args.only or 'sync' in args.only:
+            mailbox = SyntheticMailbox(args.sync_messages, seed=args.seed)
+            if 'parse' in args.only:
+                results['parse_messages'] = bench_parse(mailbox)
+            if 'sync' in args.only:
+                results['sync, full'] = bench_sync(mailbox, directory, args)
+
+        if 'endpoints' in args.only:
+            started = time.perf_counter()
+            mailbox = SyntheticMailbox(args.messages, seed=args.seed)
+            migrate(writer_engine)
+            populate(writer_engine, mailbox, args.accounts)
+            ensure_search_index(writer_engine)
+            print(f"built {args.messages:,} message mailbox in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+            results.update(bench_endpoints(args))
+
+    print(f"{'benchmark':<42} {'throughput':>14} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}")
+    for name, result in results.items():
+        throughput = f"{result['throughput']:,.1f}/s"
+        print(f"{name:<42} {throughput:>14} {result['p50_ms']:10.2f} {result['p95_ms']:10.2f} {result['p99_ms']:10.2f}")
+
+    with open(args.output, 'w') as output:
+        json.dump({'meta': metadata(args), 'results': results}, output, indent=2)
+    print(f"\nwrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline)['results'], args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} metrics regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,7 @@ function Dashboard() {
   const [analytics, setAnalytics] = useState(null);
   const [isLoading, setIsLoading] = useState(false);
   const [error, setError] = useState(null);
+  const [progress, setProgress] = useState(null);
 
   useEffect(() => {
     loadAnalytics();
@@ -24,12 +25,13 @@ function Dashboard() {
   const handleSync = async () => {
     setIsLoading(true);
     try {
-      await syncEmails();
+      await syncEmails(setProgress);
       await loadAnalytics();
     } catch (err) {
       setError(err.message);
     } finally {
       setIsLoading(false);
+      setProgress(null);
     }
   };
 
@@ -43,7 +45,13 @@ function Dashboard() {
 
   return (
     <div className="space-y-6">
-      <div className="flex justify-end">
+      <div className="flex justify-end items-center space-x-4">
+        {progress && (
+          <div className="text-sm text-gray-500">
+            {progress.fetched} fetched, {progress.inserted} new, {progress.skipped} skipped
+            {progress.errors > 0 && `, ${progress.errors} errors`} ({progress.rate}/s)
+          </div>
+        )}
         <button
           onClick={handleSync}
           disabled={isLoading}
@@ -5,6 +5,8 @@ import { ChevronRight, ChevronDown } from 'lucide-react';
 export default function EmailBrowser() {
   const [results, setResults] = useState([]);
   const [page, setPage] = useState(1);
+  // cursors[n] is the keyset cursor that fetches page n + 1
+  const [cursors, setCursors] = useState([null]);
   const [pageSize] = useState(50);
   const [total, setTotal] = useState(0);
   const [isLoading, setIsLoading] = useState(true);
@@ -14,10 +16,12 @@ export default function EmailBrowser() {
   const [sortBy, setSortBy] = useState('domain_frequency');
   const [debouncedSearch, setDebouncedSearch] = useState('');
   const [expandedGroups, setExpandedGroups] = useState(new Set());
+  const [groupEmails, setGroupEmails] = useState({});
 
   useEffect(() => {
     const timer = setTimeout(() => {
       setDebouncedSearch(searchTerm);
+      resetPaging();
     }, 500);
     return () => clearTimeout(timer);
   }, [searchTerm]);
@@ -26,13 +30,21 @@ export default function EmailBrowser() {
     fetchEmails();
   }, [page, debouncedSearch, afterDate, sortBy]);
 
+  const resetPaging = () => {
+    setPage(1);
+    setCursors([null]);
+  };
+
   const fetchEmails = async () => {
     setIsLoading(true);
     try {
+      const cursor = cursors[page - 1];
       const searchParams = new URLSearchParams({
         page: page,
         page_size: pageSize,
         sort_by: sortBy,
+        include_total: page === 1,
+        ...(cursor && { cursor }),
         ...(debouncedSearch && { search: debouncedSearch }),
         ...(afterDate && { after_date: afterDate })
       });
@@ -42,7 +54,15 @@ export default function EmailBrowser() {
       
       const data = await response.json();
       setResults(data.results);
-      setTotal(data.total);
+      if (data.total !== null) setTotal(data.total);
+      if (data.next_cursor) {
+        setCursors(prev => {
+          const next = prev.slice(0, page);
+          next[page] = data.next_cursor;
+          return next;
+        });
+      }
+      setGroupEmails({});
     } catch (err) {
       setError(err.message);
     } finally {
@@ -62,9 +82,40 @@ export default function EmailBrowser() {
     });
   };
 
+  const loadMoreGroupEmails = async (group) => {
+    const groupId = group.email || group.domain;
+    const loaded = groupEmails[groupId];
+    const nextPage = loaded ? loaded.page + 1 : 1;
+    try {
+      const searchParams = new URLSearchParams({
+        page: nextPage,
+        page_size: pageSize,
+        ...(debouncedSearch && { search: debouncedSearch }),
+        ...(afterDate && { after_date: afterDate })
+      });
+
+      const response = await fetch(
+        `http://localhost:8000/api/emails/group/${group.type}/${encodeURIComponent(groupId)}?${searchParams}`
+      );
+      if (!response.ok) throw new Error('Failed to fetch emails');
+
+      const data = await response.json();
+      setGroupEmails(prev => ({
+        ...prev,
+        [groupId]: {
+          page: nextPage,
+          emails: [...(loaded ? loaded.emails : []), ...data.results]
+        }
+      }));
+    } catch (err) {
+      setError(err.message);
+    }
+  };
+
   const renderGroupRow = (group) => {
     const isExpanded = expandedGroups.has(group.email || group.domain);
     const groupId = group.email || group.domain;
+    const emails = groupEmails[groupId] ? groupEmails[groupId].emails : group.emails;
 
     return (
       <React.Fragment key={groupId}>
@@ -94,7 +145,7 @@ export default function EmailBrowser() {
             {group.latest_date && format(new Date(group.latest_date), 'MMM d, yyyy HH:mm')}
           </td>
         </tr>
-        {isExpanded && group.emails.map(email => (
+        {isExpanded && emails.map(email => (
           <tr key={email.id} className="bg-gray-50">
             <td className="px-6 py-4 pl-14">
               <div className="text-sm text-gray-900">{email.subject}</div>
@@ -109,11 +160,24 @@ export default function EmailBrowser() {
             </td>
           </tr>
         ))}
+        {isExpanded && emails.length < group.count && (
+          <tr className="bg-gray-50">
+            <td colSpan={3} className="px-6 py-2 pl-14">
+              <button
+                onClick={() => loadMoreGroupEmails(group)}
+                className="text-sm font-medium text-indigo-600 hover:text-indigo-800"
+              >
+                Show more ({group.count - emails.length} remaining)
+              </button>
+            </td>
+          </tr>
+        )}
       </React.Fragment>
     );
   };
 
   const totalPages = Math.ceil(total / pageSize);
+  const isEmailList = sortBy === "date" || sortBy === "relevance";
 
   return (
     <div className="space-y-4">
@@ -131,17 +195,24 @@ export default function EmailBrowser() {
           <input
             type="date"
             value={afterDate}
-            onChange={(e) => setAfterDate(e.target.value)}
+            onChange={(e) => {
+              setAfterDate(e.target.value);
+              resetPaging();
+            }}
             className="px-4 py-2 rounded-md border border-gray-300 focus:outline-none focus:ring-2 focus:ring-blue-500"
           />
           <select
             value={sortBy}
-            onChange={(e) => setSortBy(e.target.value)}
+            onChange={(e) => {
+              setSortBy(e.target.value);
+              resetPaging();
+            }}
             className="pr-8 py-2 rounded-md border border-gray-300 focus:outline-none focus:ring-2 focus:ring-blue-500"
           >
             <option value="domain_frequency">Domain</option>
             <option value="sender_frequency">Sender</option>
             <option value="date">Date</option>
+            <option value="relevance">Relevance</option>
           </select>
         </div>
       </div>
@@ -198,17 +269,17 @@ export default function EmailBrowser() {
                   {sortBy === "domain_frequency" ? "Domain" : "Sender"}
                 </th>
                 <th className="px-6 py-3 text-left text-xs font-medium text-gray-500 uppercase tracking-wider">
-                  {sortBy === "date" ? "Subject" : "Count"}
+                  {isEmailList ? "Subject" : "Count"}
                 </th>
                 <th className="px-6 py-3 text-left text-xs font-medium text-gray-500 uppercase tracking-wider">
-                  {sortBy === "date" ? "From Sender" : "Latest"}
+                  {isEmailList ? "From Sender" : "Latest"}
                 </th>
-                {sortBy === "date" && (
+                {isEmailList && (
                   <th className="px-6 py-3 text-left text-xs font-medium text-gray-500 uppercase tracking-wider">
                     From Domain
                   </th>
                 )}
-                {sortBy === "date" && (
+                {isEmailList && (
                   <th className="px-6 py-3 text-left text-xs font-medium text-gray-500 uppercase tracking-wider">
                     Date
                   </th>
@@ -216,7 +287,7 @@ export default function EmailBrowser() {
               </tr>
             </thead>
             <tbody className="bg-white divide-y divide-gray-200">
-              {sortBy === "date" ? (
+              {isEmailList ? (
                 // Regular email rows for date sorting
                 results.map((email) => (
                   <tr key={email.id} className="hover:bg-gray-50">
@@ -8,12 +8,35 @@ export async function fetchAnalytics() {
   return response.json();
 }
 
-export async function syncEmails() {
+export async function syncEmails(onProgress) {
   const response = await fetch(`${API_BASE_URL}/sync`, {
     method: 'POST',
   });
   if (!response.ok) {
     throw new Error('Failed to sync emails');
   }
-  return response.json();
+  const job = await response.json();
+  return watchSyncJob(job.job_id, onProgress);
+}
+
+export function watchSyncJob(jobId, onProgress) {
+  return new Promise((resolve, reject) => {
+    const events = new EventSource(`${API_BASE_URL}/sync/${jobId}/events`);
+    events.addEventListener('progress', (event) => {
+      if (onProgress) onProgress(JSON.parse(event.data));
+    });
+    events.addEventListener('done', (event) => {
+      events.close();
+      const job = JSON.parse(event.data);
+      if (job.status === 'failed') {
+        reject(new Error(job.error || 'Failed to sync emails'));
+      } else {
+        resolve(job);
+      }
+    });
+    events.onerror = () => {
+      events.close();
+      reject(new Error('Lost connection to sync job'));
+    };
+  });
 }
@@ -0,0 +1,20 @@
+import os
+import tempfile
+
+# app.database builds its engines from the settings on import
+_directory = tempfile.mkdtemp(prefix='gmail_analyzer_tests_')
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(_directory, 'test.db')}")
+
+import pytest
+from sqlalchemy import create_engine
+from app.database import tune_engine
+from app.migrations import migrate
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """A migrated, instrumented SQLite database of its own."""
+    engine = tune_engine(create_engine(f"sqlite:///{tmp_path / 'test.db'}"))
+    migrate(engine)
+    yield engine
+    engine.dispose()
@@ -0,0 +1,28 @@
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from app.models import Domain
+from app.services.dimensions import dimensions_for
+
+
+def test_ids_of_a_session_closed_without_commit_are_forgotten(engine):
+    with pytest.raises(RuntimeError):
+        with Session(engine) as db:
+            dimensions_for(db).domains.intern(db, ['ghost.example'])
+            raise RuntimeError
+
+    with Session(engine) as db:
+        domains = dimensions_for(db).domains
+        assert domains.find(db, 'ghost.example') is None
+        domain_id = domains.intern(db, ['ghost.example'])['ghost.example']
+        db.commit()
+        assert db.scalar(select(Domain.name).where(Domain.id == domain_id)) == 'ghost.example'
+        assert db.scalar(select(func.count()).select_from(Domain)) == 1
+
+
+def test_ids_of_a_rolled_back_transaction_are_forgotten(engine):
+    with Session(engine) as db:
+        domains = dimensions_for(db).domains
+        domains.intern(db, ['ghost.example'])
+        db.rollback()
+        assert domains.find(db, 'ghost.example') is None
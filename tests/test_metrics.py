@@ -0,0 +1,13 @@
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+
+def test_failed_statement_raises_its_own_error(engine):
+    with engine.connect() as conn:
+        with pytest.raises(OperationalError, match='no such table'):
+            conn.execute(text("SELECT * FROM no_such_table"))
+        # The failed statement's timer was popped, so the next one is timed normally
+        assert conn.info.get('query_started_at') == []
+        assert conn.execute(text("SELECT 1")).scalar() == 1
+        assert conn.info['query_started_at'] == []
@@ -0,0 +1,8 @@
+import pytest
+from app.manage import query_plan, query_plan_checks
+
+
+@pytest.mark.parametrize('name, statement, index', query_plan_checks(), ids=[check[0] for check in query_plan_checks()])
+def test_hot_query_uses_its_index(engine, name, statement, index):
+    with engine.connect() as conn:
+        assert index in query_plan(conn, statement)
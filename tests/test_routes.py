@@ -0,0 +1,60 @@
+import json
+from datetime import datetime
+from sqlalchemy.orm import Session, sessionmaker
+from app.api import routes
+from app.api.routes import list_emails
+from app.services.ingest import IngestService
+
+
+def message(id: str, name: str, email: str, received_date: datetime) -> dict:
+    return {
+        'id': id,
+        'sender_name': name,
+        'sender_email': email,
+        'sender_domain': email.split('@')[1],
+        'subject': id,
+        'received_date': received_date,
+    }
+
+
+def test_filtered_sender_groups_show_the_latest_name(engine):
+    with Session(engine) as db:
+        IngestService(db, 1).insert_messages([
+            message('a1', 'Ann Old', 'ann@example.com', datetime(2024, 2, 1)),
+            message('a2', 'Ann New', 'ann@example.com', datetime(2024, 3, 1)),
+            message('a3', 'Ann Older', 'ann@example.com', datetime(2023, 1, 1)),
+            message('b1', 'Bob', 'bob@example.org', datetime(2024, 2, 15)),
+        ])
+        db.commit()
+
+        for emails_per_group in (0, 1):
+            body = list_emails(db, 1, 10, None, '2024-01-01', 'sender_frequency', emails_per_group, None, True)
+            assert [(group['email'], group['name'], group['count']) for group in body['results']] == [
+                ('ann@example.com', 'Ann New', 2),
+                ('bob@example.org', 'Bob', 1),
+            ]
+            assert body['total'] == 2
+
+
+def test_ndjson_export_encodes_rows_like_the_other_responses(engine, monkeypatch):
+    with Session(engine) as db:
+        IngestService(db, 1).insert_messages([
+            message('a1', 'Ann', 'ann@example.com', datetime(2024, 3, 1, 9, 30, 15, 250000)),
+            message('b1', 'Bob', 'bob@example.org', datetime(2024, 2, 15)),
+        ])
+        db.commit()
+
+    monkeypatch.setattr(routes, 'SessionLocal', sessionmaker(bind=engine))
+    chunks = list(routes.export_rows('ndjson', None, None, 'date', None))
+    assert all(isinstance(chunk, bytes) for chunk in chunks)
+    lines = b''.join(chunks).splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {
+            'account_id': 1, 'id': 'a1', 'sender_name': 'Ann', 'sender_email': 'ann@example.com',
+            'sender_domain': 'example.com', 'subject': 'a1', 'received_date': '2024-03-01T09:30:15.250000',
+        },
+        {
+            'account_id': 1, 'id': 'b1', 'sender_name': 'Bob', 'sender_email': 'bob@example.org',
+            'sender_domain': 'example.org', 'subject': 'b1', 'received_date': '2024-02-15T00:00:00',
+        },
+    ]
@@ -0,0 +1,30 @@
+import json
+from datetime import datetime
+from fastapi.testclient import TestClient
+from app.main import app
+from app.services.jobs import sync_jobs
+
+ACCOUNT_PROGRESS = {"mode": "full", "listed": 5, "fetched": 5, "inserted": 5, "errors": 0}
+
+
+def test_sync_job_with_per_account_progress_is_encoded():
+    job_id = 'regression-job'
+    sync_jobs._progress[job_id] = {
+        "job_id": job_id,
+        "status": "succeeded",
+        "finished_at": datetime(2024, 5, 1, 12, 30),
+        "accounts": {1: ACCOUNT_PROGRESS, 2: ACCOUNT_PROGRESS},
+    }
+    try:
+        with TestClient(app) as client:
+            response = client.get(f'/api/sync/{job_id}')
+            assert response.status_code == 200
+            assert response.json()['accounts'] == {'1': ACCOUNT_PROGRESS, '2': ACCOUNT_PROGRESS}
+
+            response = client.get(f'/api/sync/{job_id}/events')
+            assert response.status_code == 200
+            event, data = response.text.strip().split('\n')
+            assert event == 'event: done'
+            assert json.loads(data[len('data: '):])['accounts'] == {'1': ACCOUNT_PROGRESS, '2': ACCOUNT_PROGRESS}
+    finally:
+        del sync_jobs._progress[job_id]
@@ -0,0 +1,28 @@
+from datetime import date, datetime
+from sqlalchemy.orm import Session
+from app.services.ingest import IngestService
+from app.services.sketches import SketchService
+
+
+def message(id: str, email: str) -> dict:
+    return {
+        'id': id,
+        'sender_name': None,
+        'sender_email': email,
+        'sender_domain': email.split('@')[1],
+        'subject': id,
+        'received_date': datetime(2024, 5, 1),
+    }
+
+
+def test_rows_of_a_session_closed_without_commit_are_not_sketched(engine):
+    db = Session(engine)
+    IngestService(db, 1).insert_messages([message('lost', 'lost@example.com')])
+    db.close()
+
+    IngestService(db, 1).insert_messages([message('kept', 'kept@example.com')])
+    db.commit()
+    sketch = SketchService(db).merged(1, date(2024, 1, 1), date(2024, 12, 31))
+    db.close()
+    assert round(sketch.senders.estimate()) == 1
+    assert [count for _, count in sketch.top_senders.top(10)] == [1]
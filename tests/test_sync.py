@@ -0,0 +1,90 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from sqlalchemy import func, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from app.models import Account, EmailMessage, SyncState
+from app.services.sync import SyncService
+from bench.fake_gmail import FakeGmail
+from bench.mailbox import SyntheticMailbox
+
+ACCOUNTS = (1, 2, 3)
+MESSAGES = 1000
+# Gmail's per-user quota, which paces each account to 50 messages per second
+QUOTA = 250
+
+
+def sync_fake_account(account_id: int) -> dict:
+    """``jobs.sync_account``, against a fake Gmail serving a mailbox of the account's own."""
+    from app.database import WriterSessionLocal
+
+    gmail = FakeGmail(
+        SyntheticMailbox(MESSAGES, seed=account_id), email=f"account{account_id}@example.com", quota_per_second=QUOTA
+    )
+    with WriterSessionLocal() as db:
+        return SyncService(
+            db, account_id,
+            service_factory=gmail.service_factory(),
+            quota_units_per_second=QUOTA,
+            on_commit=lambda: None,
+            transfer=gmail.transfer,
+        ).run(full=True).as_dict()
+
+
+def test_paced_accounts_sync_in_parallel_processes(engine, monkeypatch):
+    with Session(engine) as db:
+        for account_id in ACCOUNTS:
+            if db.get(Account, account_id) is None:
+                db.add(Account(
+                    id=account_id, email=f"account{account_id}@example.com", token_file='', created_at=datetime.utcnow()
+                ))
+        db.commit()
+
+    # Spawned workers build their engines from the environment, like sync's
+    monkeypatch.setenv('DATABASE_URL', str(engine.url))
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=len(ACCOUNTS), mp_context=context) as pool:
+        stats = list(pool.map(sync_fake_account, ACCOUNTS))
+
+    assert [(account['inserted'], account['errors']) for account in stats] == [(MESSAGES, 0)] * len(ACCOUNTS)
+    with Session(engine) as db:
+        counts = dict(db.execute(
+            select(EmailMessage.account_id, func.count()).group_by(EmailMessage.account_id)
+        ).all())
+    assert counts == {account_id: MESSAGES for account_id in ACCOUNTS}
+
+
+def test_failed_insert_holds_back_the_checkpoints(engine):
+    gmail = FakeGmail(SyntheticMailbox(MESSAGES), email='account1@example.com')
+    with Session(engine) as db:
+        def sync():
+            return SyncService(
+                db, 1,
+                service_factory=gmail.service_factory(),
+                quota_units_per_second=0,
+                on_commit=lambda: None,
+                transfer=gmail.transfer,
+            )
+
+        service = sync()
+        insert_messages = service.ingest.insert_messages
+        lost = []
+
+        def fail_first_batch(rows):
+            if rows and not lost:
+                lost.extend(rows)
+                raise OperationalError('INSERT', {}, Exception('database is locked'))
+            return insert_messages(rows)
+
+        service.ingest.insert_messages = fail_first_batch
+        stats = service.run(full=True)
+        assert stats.errors == len(lost) > 0
+        assert stats.inserted == MESSAGES - len(lost)
+        state = db.get(SyncState, 'account1@example.com')
+        assert state.history_id is None and state.listing_page_token is None
+
+        # The next run lists the mailbox again and stores the lost messages
+        assert sync().run().inserted == len(lost)
+        assert db.scalar(select(func.count()).select_from(EmailMessage)) == MESSAGES
+        assert db.get(SyncState, 'account1@example.com').history_id == gmail.history_id